@@ -8,6 +8,9 @@ MAX_BATCH_EPISODES = 100
 MAX_BATCH_STEPS = 10000
 NOISE_STD = 0.01
 LEARNING_RATE = 0.001
+# Adam on the flat parameters instead of the plain SGD update
+USE_ADAM = False
+ADAM_LEARNING_RATE = 0.01
 
 
 class Net(tf.keras.Model):
@@ -28,108 +31,179 @@ class Net(tf.keras.Model):
         return self.seq(inputs)
 
 
-def evaluate(env, net):
-    obs = env.reset()
-    reward = 0.0
-    steps = 0
+@tf.function
+def population_forward(net, params, obs):
+    """
+    Forward pass of the whole population at once, member i gets observation obs[i]
+    :param net: Net, used for the layers structure only
+    :param params: list of stacked parameters in the order of net.trainable_variables,
+    every tensor has shape (population,) + variable shape
+    :param obs: (population, obs_size) tensor
+    :return: (population, action_size) probabilities
+    """
+    x = obs
+    params = iter(params)
+    for layer in net.seq.layers:
+        if isinstance(layer, layers.Dense):
+            kernel, bias = next(params), next(params)
+            x = tf.einsum('pi,pio->po', x, kernel) + bias
+        else:
+            x = layer(x)
+    return x
+
+
+def evaluate_population(envs, net, params, max_steps=None, group=1):
+    """
+    Play one episode in every env, env i is played by the population member i.
+    All members do the step together, finished envs stay on their last observation until the rest are done
+    :param params: stacked parameters, see population_forward
+    :param max_steps: steps budget, members are accounted by groups of consecutive ones as if the groups were played
+    one by one: the group is played only if the groups before it took no more than max_steps in total.
+    Episodes of the groups which are known to be over the budget are stopped. None for no budget
+    :param group: size of the groups, for example 2 for antithetic pairs
+    :return: tuple of arrays (rewards, steps, played), (population,) each, rewards are valid only for played members
+    """
+    population = len(envs)
+    assert population % group == 0
+    obs = np.array([env.reset() for env in envs], dtype=np.float32)
+    rewards = np.zeros(population, dtype=np.float32)
+    steps = np.zeros(population, dtype=np.int64)
+    done = np.zeros(population, dtype=bool)
+    played = np.ones(population, dtype=bool)
     while True:
-        obs_v = tf.convert_to_tensor([obs])
-        acts = net(obs_v)
-        acts = tf.argmax(acts, axis=1)
-        obs, r, done, _ = env.step(acts.numpy()[0])
-        reward += r
-        steps += 1
-        if done:
+        if max_steps is not None:
+            # steps of the groups before are the lower bound until they are done, so the dropped group never returns
+            group_steps = steps.reshape(-1, group).sum(axis=1)
+            played = np.repeat(np.cumsum(group_steps) - group_steps <= max_steps, group)
+        running = ~done & played
+        if not running.any():
             break
-    return reward, steps
+        acts = tf.argmax(population_forward(net, params, tf.convert_to_tensor(obs)), axis=1).numpy()
+        for idx in np.flatnonzero(running):
+            obs[idx], r, done[idx], _ = envs[idx].step(acts[idx])
+            rewards[idx] += r
+            steps[idx] += 1
+    return rewards, steps, played
 
 
-def sample_noise(net):
-    pos = []
-    neg = []
-    for p in net.trainable_variables:
-        noise_t = tf.random.normal(shape=p.shape, dtype=tf.float32)
-        pos.append(noise_t)
-        neg.append(-noise_t)
-    return pos, neg
+class FlatParams:
+    """
+    Single vector view over net.trainable_variables
+    """
+
+    def __init__(self, net):
+        self.variables = net.trainable_variables
+        self.shapes = [tuple(v.shape) for v in self.variables]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.size = sum(self.sizes)
+
+    def get(self):
+        return np.concatenate([v.numpy().ravel() for v in self.variables])
 
+    def set(self, flat):
+        for v, t in zip(self.variables, self.unflatten(flat)):
+            v.assign(t)
 
-def evaluate_with_noise(env, net, noises):
-    scaled_noises = []
-    for param, noise in zip(net.trainable_variables, noises):
-        scaled_noise = NOISE_STD * noise
-        param.assign_add(scaled_noise)
-        scaled_noises.append(scaled_noise)
-    reward, steps = evaluate(env, net)
-    for param, scaled_noise in zip(net.trainable_variables, scaled_noises):
-        param.assign_sub(scaled_noise)
-    return reward, steps
+    def unflatten(self, flat):
+        """
+        Split vectors into tensors of variables shapes
+        :param flat: (..., size) array, leading dimensions are kept, for example population
+        :return: list of (...) + variable shape tensors in the order of net.trainable_variables
+        """
+        lead = tuple(flat.shape[:-1])
+        parts = np.split(flat, np.cumsum(self.sizes)[:-1], axis=-1)
+        return [tf.reshape(tf.convert_to_tensor(part, dtype=tf.float32), lead + shape)
+                for part, shape in zip(parts, self.shapes)]
 
 
-def train_step(net, batch_noise, batch_reward):
+class Adam:
     """
-    Train the net work with objective 0_t+1 = 0_t + a * 1/(n*o) * sum_i=1->n(F_i*e_i)
-    with: 0_t is net parameter, a - alpha or lr, o: std, F_i: fitness value (or reward), e_i: noise
-    :param net:
-    :param batch_noise:
-    :param batch_reward:
-    :param step_idx:
-    :return:
+    Adam for the gradient ascent on the flat parameters vector
     """
-    norm_reward = np.array(batch_reward)
-    norm_reward -= np.mean(norm_reward)
-    std = np.std(norm_reward)
-    if abs(std) > 1e-6:
-        norm_reward /= std
-
-    weighted_noise = None
-    for reward, noise in zip(norm_reward, batch_noise):
-        if weighted_noise is None:
-            weighted_noise = [reward * p_noise for p_noise in noise]
-        else:
-            for w_noise, p_noise in zip(weighted_noise, noise):
-                w_noise += reward * p_noise
 
-    weights_updated = []
-    for param, param_updated in zip(net.trainable_variables, weighted_noise):
-        update = param_updated / (len(batch_reward) * NOISE_STD)
-        param.assign_add(LEARNING_RATE * update)
-        weights_updated.append(param)
-    # net.set_weights(weights_updated)
+    def __init__(self, size, learning_rate=ADAM_LEARNING_RATE, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.m = np.zeros(size, dtype=np.float32)
+        self.v = np.zeros(size, dtype=np.float32)
+        self.t = 0
+
+    def step(self, grad):
+        """
+        :return: update to be added to the parameters
+        """
+        self.t += 1
+        self.m = self.beta1 * self.m + (1 - self.beta1) * grad
+        self.v = self.beta2 * self.v + (1 - self.beta2) * grad * grad
+        lr = self.learning_rate * np.sqrt(1 - self.beta2 ** self.t) / (1 - self.beta1 ** self.t)
+        return lr * self.m / (np.sqrt(self.v) + self.epsilon)
+
+
+def centered_ranks(x):
+    """
+    Replace values by their ranks scaled into [-0.5, 0.5], the update doesn't depend on the scale of the rewards
+    and outliers
+    """
+    ranks = np.empty(len(x), dtype=np.float32)
+    ranks[np.argsort(x)] = np.arange(len(x), dtype=np.float32)
+    return ranks / max(len(x) - 1, 1) - 0.5
+
+
+def sample_population_noise(size, pairs, interleaved=False):
+    """
+    Antithetic noise for the population of 2 * pairs members: member i + pairs has the noise of member i negated
+    :param interleaved: pairs are members 2 * i and 2 * i + 1 instead
+    :return: (2 * pairs, size) matrix
+    """
+    noise = np.random.normal(size=(pairs, size)).astype(np.float32)
+    if interleaved:
+        return np.stack([noise, -noise], axis=1).reshape(2 * pairs, size)
+    return np.concatenate([noise, -noise])
+
+
+def train_step(flat_params, batch_noise, batch_reward, optimizer=None):
+    """
+    Train the net work with objective 0_t+1 = 0_t + a * 1/(n*o) * sum_i=1->n(F_i*e_i)
+    with: 0_t is net parameter, a - alpha or lr, o: std, F_i: fitness value (centered rank of the reward), e_i: noise
+    Sum is done as the single product of the noise matrix and fitness vector
+    :param flat_params: FlatParams of the net
+    :param batch_noise: (population, size) noise matrix
+    :param batch_reward: (population,) rewards
+    :param optimizer: Adam, plain SGD with LEARNING_RATE if None
+    """
+    fitness = centered_ranks(np.asarray(batch_reward))
+    grad = fitness @ batch_noise / (len(fitness) * NOISE_STD)
+    update = LEARNING_RATE * grad if optimizer is None else optimizer.step(grad)
+    flat_params.set(flat_params.get() + update)
 
 
 if __name__ == '__main__':
-    env = gym.make("CartPole-v0")
+    envs = [gym.make("CartPole-v0") for _ in range(2 * MAX_BATCH_EPISODES)]
 
-    net = Net(env.action_space.n)
-    net.build(input_shape=tf.convert_to_tensor([env.reset()]).shape)
+    net = Net(envs[0].action_space.n)
+    net(tf.convert_to_tensor([envs[0].reset()]))
+
+    flat_params = FlatParams(net)
+    optimizer = Adam(flat_params.size) if USE_ADAM else None
 
     step_idx = 0
     while True:
         t_start = time.time()
-        batch_noise = []
-        batch_reward = []
-        batch_steps = 0
-        for _ in range(MAX_BATCH_EPISODES):
-            pos_noise, neg_noise = sample_noise(net)
-            batch_noise.append(pos_noise)
-            batch_noise.append(neg_noise)
-            reward, steps = evaluate_with_noise(env, net, pos_noise)
-            batch_reward.append(reward)
-            batch_steps += steps
-            reward, steps = evaluate_with_noise(env, net, neg_noise)
-            batch_reward.append(reward)
-            batch_steps += steps
-            if batch_steps > MAX_BATCH_STEPS:
-                break
-        
+        # pairs are played as in the sequence pos_1, neg_1, pos_2, ... until the batch is over MAX_BATCH_STEPS
+        batch_noise = sample_population_noise(flat_params.size, MAX_BATCH_EPISODES, interleaved=True)
+        population = flat_params.unflatten(flat_params.get() + NOISE_STD * batch_noise)
+        batch_reward, steps, played = evaluate_population(envs, net, population, max_steps=MAX_BATCH_STEPS, group=2)
+        batch_noise, batch_reward = batch_noise[played], batch_reward[played]
+        batch_steps = np.sum(steps)
+
         step_idx += 1
         mean_reward = np.mean(batch_reward)
         if mean_reward > 199:
             print(f"Solved in {step_idx} steps!")
             break
 
-        train_step(net, batch_noise, batch_reward)
+        train_step(flat_params, batch_noise, batch_reward, optimizer)
         speed = batch_steps / (time.time() - t_start)
         print("%d: reward=%.2f, speed=%.2f f/s" % (step_idx, mean_reward, speed))
-
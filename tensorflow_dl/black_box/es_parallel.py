@@ -0,0 +1,129 @@
+"""
+Evolution strategies for CartPole evaluated by the pool of worker processes.
+All the processes share one table of gaussian noise, so the perturbation is identified by its offset in the table:
+master sends the current parameters to the workers, workers return only (offset, reward) pairs and the master
+restores the noise from the table to do the update.
+"""
+import multiprocessing as mp
+import time
+
+import gym
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_dl.black_box import es_cartpole
+
+WORKERS = mp.cpu_count()
+SEEDS_PER_WORKER = 10
+NOISE_TABLE_SIZE = 10000000
+NOISE_TABLE_SEED = 123
+NOISE_STD = es_cartpole.NOISE_STD
+
+
+class NoiseTable:
+    """
+    Gaussian noise in the shared memory. Pass it to the worker process as an argument, the memory is not copied
+    """
+
+    def __init__(self, size, seed=NOISE_TABLE_SEED, raw=None):
+        self.size = size
+        if raw is None:
+            raw = mp.RawArray('f', size)
+            np.frombuffer(raw, dtype=np.float32)[:] = np.random.RandomState(seed).randn(size)
+        self.raw = raw
+        self.noise = np.frombuffer(raw, dtype=np.float32)
+
+    def __reduce__(self):
+        return NoiseTable, (self.size, None, self.raw)
+
+    def sample_offsets(self, rng, dim, count):
+        return rng.randint(0, self.size - dim + 1, size=count)
+
+    def get(self, offset, dim):
+        return self.noise[offset:offset + dim]
+
+    def get_batch(self, offsets, dim):
+        """
+        :return: (len(offsets), dim) matrix of noise vectors
+        """
+        return self.noise[np.asarray(offsets)[:, np.newaxis] + np.arange(dim)]
+
+
+def make_net(env):
+    net = es_cartpole.Net(env.action_space.n)
+    # run once to create the variables
+    net(np.zeros((1,) + env.observation_space.shape, dtype=np.float32))
+    return net
+
+
+def worker_func(worker_idx, noise_table, params_queue, result_queue):
+    """
+    Evaluate antithetic pairs of perturbations for every parameters vector received, the whole population of
+    the worker plays at once. Results are lists of tuples (offset, positive reward, negative reward, steps)
+    """
+    # every worker uses the single core, parallelism comes from the processes
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    envs = [gym.make("CartPole-v0") for _ in range(2 * SEEDS_PER_WORKER)]
+    net = make_net(envs[0])
+    flat_params = es_cartpole.FlatParams(net)
+    rng = np.random.RandomState(worker_idx)
+
+    while True:
+        params = params_queue.get()
+        if params is None:
+            break
+        offsets = noise_table.sample_offsets(rng, len(params), SEEDS_PER_WORKER)
+        noise = NOISE_STD * noise_table.get_batch(offsets, len(params))
+        population = flat_params.unflatten(np.concatenate([params + noise, params - noise]))
+        rewards, steps, _ = es_cartpole.evaluate_population(envs, net, population)
+        result = list(zip(offsets, rewards[:SEEDS_PER_WORKER], rewards[SEEDS_PER_WORKER:],
+                          steps[:SEEDS_PER_WORKER] + steps[SEEDS_PER_WORKER:]))
+        result_queue.put(result)
+
+
+if __name__ == '__main__':
+    # tensorflow is not fork safe, workers are started in the fresh interpreters
+    ctx = mp.get_context('spawn')
+    noise_table = NoiseTable(NOISE_TABLE_SIZE)
+    params_queues = [ctx.Queue(maxsize=1) for _ in range(WORKERS)]
+    result_queue = ctx.Queue(maxsize=WORKERS)
+    workers = []
+    for idx, params_queue in enumerate(params_queues):
+        w = ctx.Process(target=worker_func, args=(idx, noise_table, params_queue, result_queue), daemon=True)
+        w.start()
+        workers.append(w)
+
+    flat_params = es_cartpole.FlatParams(make_net(gym.make("CartPole-v0")))
+    optimizer = es_cartpole.Adam(flat_params.size) if es_cartpole.USE_ADAM else None
+    print("Parameters: %d, workers: %d" % (flat_params.size, WORKERS))
+
+    step_idx = 0
+    while True:
+        t_start = time.time()
+        params = flat_params.get()
+        for params_queue in params_queues:
+            params_queue.put(params)
+        batch = []
+        for _ in range(WORKERS):
+            batch.extend(result_queue.get())
+        offsets, rewards_pos, rewards_neg, steps = map(np.array, zip(*batch))
+
+        step_idx += 1
+        mean_reward = np.mean(np.concatenate([rewards_pos, rewards_neg]))
+        if mean_reward > 199:
+            print(f"Solved in {step_idx} steps!")
+            break
+
+        # noise matrix of the antithetic pairs is restored from the table, negative members have the noise -e
+        noise = noise_table.get_batch(offsets, flat_params.size)
+        es_cartpole.train_step(flat_params, np.concatenate([noise, -noise]),
+                               np.concatenate([rewards_pos, rewards_neg]), optimizer)
+        speed = np.sum(steps) / (time.time() - t_start)
+        print("%d: reward=%.2f, speed=%.2f f/s" % (step_idx, mean_reward, speed))
+
+    for params_queue in params_queues:
+        params_queue.put(None)
+    for w in workers:
+        w.join()
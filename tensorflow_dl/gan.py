@@ -1,4 +1,8 @@
+import multiprocessing as mp
+import queue
 import random
+import threading
+import time
 
 import gym
 import numpy as np
@@ -21,6 +25,12 @@ LEARNING_RATE = 0.0001
 REPORT_EVERY_ITER = 100
 SAVE_IMAGE_EVERY_ITER = 1000
 
+ENV_NAMES = ('Breakout-v0', 'AirRaid-v0', 'Pong-v0')
+# frames kept in the shared ring buffer
+RING_CAPACITY = 4096
+PREFETCH_BATCHES = 4
+MIXED_PRECISION = False
+
 
 class InputWrapper(gym.ObservationWrapper):
     def __init__(self, *args):
@@ -28,14 +38,14 @@ class InputWrapper(gym.ObservationWrapper):
         assert isinstance(self.observation_space, gym.spaces.Box)
         old_space = self.observation_space
         self.observation_space = gym.spaces.Box(self.observation(old_space.low), self.observation(old_space.high),
-                                                dtype=np.float32)
+                                                dtype=np.uint8)
 
     def observation(self, observation):
-        # resize to image shape
-        new_obs = cv2.resize(observation, (IMAGE_SIZE, IMAGE_SIZE))
+        # resize to image shape, frames are kept in uint8 until the batch is normalized
+        new_obs = cv2.resize(observation, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_AREA)
         # reshape (210, 160, 3) -> (3, 210, 160) for CNN
         # new_obs = np.transpose(new_obs, [2, 0, 1])
-        return new_obs.astype(dtype=np.float32)
+        return new_obs
 
 
 class Discriminator(tf.keras.models.Model):
@@ -115,64 +125,224 @@ def iterate_batches(envs, batch_size=BATCH_SIZE):
             e.reset()
 
 
+class FrameRingBuffer:
+    """
+    Ring buffer of uint8 frames in the shared memory, filled by the producer processes.
+    Pass it to the process as an argument, the memory is not copied
+    """
+
+    def __init__(self, capacity, frame_shape, ctx=mp, shared=None):
+        """
+        :param ctx: multiprocessing context the producers are started with
+        """
+        self.capacity = capacity
+        self.frame_shape = tuple(frame_shape)
+        if shared is None:
+            frame_size = int(np.prod(frame_shape))
+            shared = (ctx.RawArray('B', capacity * frame_size), ctx.RawValue('q', 0), ctx.Lock())
+        self.shared = shared
+        raw, self.written, self.lock = shared
+        self.frames = np.frombuffer(raw, dtype=np.uint8).reshape((capacity,) + self.frame_shape)
+
+    def __reduce__(self):
+        return FrameRingBuffer, (self.capacity, self.frame_shape, None, self.shared)
+
+    def put(self, frame):
+        with self.lock:
+            self.frames[self.written.value % self.capacity] = frame
+            self.written.value += 1
+
+    def batches(self, batch_size):
+        """
+        Yield batches of frames in the order they were written. If the consumer falls behind by more than
+        the capacity, the overwritten frames are skipped
+        :return: generator of (batch_size,) + frame_shape uint8 arrays
+        """
+        read = 0
+        while True:
+            with self.lock:
+                written = self.written.value
+                if written - read >= batch_size:
+                    read = max(read, written - self.capacity)
+                    idx = np.arange(read, read + batch_size) % self.capacity
+                    batch = self.frames[idx]
+                    read += batch_size
+                else:
+                    batch = None
+            if batch is None:
+                time.sleep(0.001)
+                continue
+            yield batch
+
+
+def frame_producer(env_name, ring):
+    """
+    Play the env with random actions and put all the non-blank frames into the ring
+    """
+    env = InputWrapper(gym.make(env_name))
+    env.reset()
+    while True:
+        obs, reward, done, _ = env.step(env.action_space.sample())
+        if np.mean(obs) > 0.01:
+            ring.put(obs)
+        if done:
+            env.reset()
+
+
+def normalize_batch(batch):
+    return tf.cast(batch, tf.float32) * (2.0 / 255.0) - 1.0
+
+
+def stream_batches(env_names, batch_size=BATCH_SIZE, capacity=RING_CAPACITY):
+    """
+    Start producer process for every env and build the prefetching dataset of normalized batches from the shared ring
+    :return: tuple (dataset, producers)
+    """
+    env = InputWrapper(gym.make(env_names[0]))
+    frame_shape = env.observation_space.shape
+    env.close()
+    # tensorflow is not fork safe, producers are started in the fresh interpreters
+    ctx = mp.get_context('spawn')
+    ring = FrameRingBuffer(capacity, frame_shape, ctx)
+    producers = [ctx.Process(target=frame_producer, args=(name, ring), daemon=True) for name in env_names]
+    for p in producers:
+        p.start()
+
+    dataset = tf.data.Dataset.from_generator(
+        lambda: ring.batches(batch_size),
+        output_signature=tf.TensorSpec(shape=(batch_size,) + frame_shape, dtype=tf.uint8))
+    dataset = dataset.map(normalize_batch).prefetch(PREFETCH_BATCHES)
+    return dataset, producers
+
+
+class TrainStep:
+    """
+    Compiled training step doing both discriminator and generator updates in one call.
+    Losses are accumulated in variables on the device, so the host reads them only once per report with result()
+    """
+
+    def __init__(self, net_gener, net_discr, gener_optimizer, discr_optimizer, batch_size=BATCH_SIZE):
+        self.net_gener = net_gener
+        self.net_discr = net_discr
+        self.gener_optimizer = gener_optimizer
+        self.discr_optimizer = discr_optimizer
+        self.batch_size = batch_size
+        self.objective = tf.keras.losses.BinaryCrossentropy()
+        self.sum_gen_loss = tf.Variable(0.0, trainable=False)
+        self.sum_discr_loss = tf.Variable(0.0, trainable=False)
+        self.steps = tf.Variable(0.0, trainable=False)
+        self.step = tf.function(self._step)
+
+    def _step(self, batch_v):
+        """
+        :param batch_v: batch of real images in [-1, 1]
+        :return: generated images
+        """
+        true_labels_v = tf.ones(self.batch_size, dtype=tf.float32)
+        fake_labels_v = tf.zeros(self.batch_size, dtype=tf.float32)
+        gen_input_v = tf.random.normal(shape=(self.batch_size, 1, 1, LATENT_VECTOR_SIZE), dtype=tf.float32)
+
+        with tf.GradientTape() as gener_g, tf.GradientTape() as discr_g:
+            gen_output_v = self.net_gener(gen_input_v, training=True)
+            # with mixed precision outputs are in bfloat16, losses are always computed in float32
+            discr_output_true_v = tf.cast(self.net_discr(batch_v, training=True), tf.float32)
+            discr_output_fake_v = tf.cast(self.net_discr(gen_output_v, training=True), tf.float32)
+            discr_loss = self.objective(true_labels_v, discr_output_true_v) + \
+                self.objective(fake_labels_v, discr_output_fake_v)
+            # the same fake output is used for the generator, every tape takes the gradients of its own net only
+            gen_loss_v = self.objective(true_labels_v, discr_output_fake_v)
+
+        gener_gradients = gener_g.gradient(gen_loss_v, self.net_gener.trainable_variables)
+        discr_gradients = discr_g.gradient(discr_loss, self.net_discr.trainable_variables)
+        self.gener_optimizer.apply_gradients(zip(gener_gradients, self.net_gener.trainable_variables))
+        self.discr_optimizer.apply_gradients(zip(discr_gradients, self.net_discr.trainable_variables))
+
+        self.sum_gen_loss.assign_add(gen_loss_v)
+        self.sum_discr_loss.assign_add(discr_loss)
+        self.steps.assign_add(1.0)
+        return gen_output_v
+
+    def result(self):
+        """
+        :return: mean (gen_loss, discr_loss) since the last call, resets the accumulators
+        """
+        steps = max(self.steps.numpy(), 1.0)
+        res = self.sum_gen_loss.numpy() / steps, self.sum_discr_loss.numpy() / steps
+        for v in (self.sum_gen_loss, self.sum_discr_loss, self.steps):
+            v.assign(0.0)
+        return res
+
+
+class ImageDumper(threading.Thread):
+    """
+    Writes image summaries on the background thread. If the writer is still busy with previous images,
+    the new ones are dropped, so the training loop is never blocked by the disk
+    """
+
+    def __init__(self, summary, max_pending=2):
+        super(ImageDumper, self).__init__(daemon=True)
+        self.summary = summary
+        self.queue = queue.Queue(maxsize=max_pending)
+
+    def dump(self, iter_no, fake_v, real_v):
+        try:
+            self.queue.put_nowait((iter_no, fake_v, real_v))
+        except queue.Full:
+            log.warn("Iter %d: image dump skipped, writer is busy", iter_no)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            iter_no, fake_v, real_v = item
+            with self.summary.as_default():
+                # images are in [-1, 1], summary expects [0, 1]
+                tf.summary.image("fake", (tf.cast(fake_v, tf.float32) + 1.0) / 2.0, iter_no)
+                tf.summary.image("real", (real_v + 1.0) / 2.0, iter_no)
+            self.summary.flush()
+
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+
 if __name__ == '__main__':
-    envs = [InputWrapper(gym.make(name)) for name in ('Breakout-v0', 'AirRaid-v0', 'Pong-v0')]
-    input_shape = envs[0].observation_space.shape
+    if MIXED_PRECISION:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    env = InputWrapper(gym.make(ENV_NAMES[0]))
+    input_shape = env.observation_space.shape
+    env.close()
 
     net_discr = Discriminator(input_shape=input_shape)
     net_gener = Generator(output_shape=input_shape)
 
-    objective = tf.keras.losses.BinaryCrossentropy()
-    gener_optimizer = tf.keras.optimizers.Adam(lr=LEARNING_RATE, beta_1=0.5)
-    discr_optimizer = tf.keras.optimizers.Adam(lr=LEARNING_RATE, beta_1=0.5)
+    gener_optimizer = tf.keras.optimizers.Adam(learning_rate=LEARNING_RATE, beta_1=0.5)
+    discr_optimizer = tf.keras.optimizers.Adam(learning_rate=LEARNING_RATE, beta_1=0.5)
+    train_step = TrainStep(net_gener, net_discr, gener_optimizer, discr_optimizer)
 
     log_dir = "logs/gan"
     summary = tf.summary.create_file_writer(logdir=log_dir)
+    image_dumper = ImageDumper(summary)
+    image_dumper.start()
 
-    gener_losses = []
-    discr_losses = []
     iter_no = 0
-
-    true_labels_v = tf.ones(BATCH_SIZE, dtype=tf.float32)
-    fake_labels_v = tf.zeros(BATCH_SIZE, dtype=tf.float32)
-
-    for batch_v in iterate_batches(envs):
-        gen_input_v = tf.random.normal(shape=(BATCH_SIZE, 1, 1, LATENT_VECTOR_SIZE), dtype=tf.float32)
-
-        with tf.GradientTape() as gener_g, tf.GradientTape() as discr_g:
-            gen_output_v = net_gener(gen_input_v)
-
-            discr_output_true_v = net_discr(batch_v)
-            discr_output_fake_v = net_discr(gen_output_v)
-            discr_loss = objective(true_labels_v, discr_output_true_v) + objective(fake_labels_v, discr_output_fake_v)
-
-            discr_output_v = net_discr(gen_output_v)
-            gen_loss_v = objective(true_labels_v, discr_output_v)
-
-        gener_gradients = gener_g.gradient(gen_loss_v, net_gener.trainable_variables)
-        gener_optimizer.apply_gradients(zip(gener_gradients, net_gener.trainable_variables))
-
-        gener_losses.append(gen_loss_v)
-
-        discr_gradients = discr_g.gradient(discr_loss, net_discr.trainable_variables)
-        discr_optimizer.apply_gradients(zip(discr_gradients, net_discr.trainable_variables))
-
-        discr_losses.append(discr_loss)
+    dataset, producers = stream_batches(ENV_NAMES)
+    for batch_v in dataset:
+        gen_output_v = train_step.step(batch_v)
 
         iter_no += 1
         if iter_no % REPORT_EVERY_ITER == 0:
-            log.info("Iter %d: gen_loss=%.3e, dis_loss=%.3e", iter_no, np.mean(gener_losses), np.mean(discr_losses))
+            gen_loss, discr_loss = train_step.result()
+            log.info("Iter %d: gen_loss=%.3e, dis_loss=%.3e", iter_no, gen_loss, discr_loss)
             with summary.as_default():
-                tf.summary.scalar('gen_loss', np.mean(gener_losses), iter_no)
-                tf.summary.scalar("dis_loss", np.mean(discr_losses), iter_no)
-
-            gener_losses = []
-            discr_losses = []
+                tf.summary.scalar('gen_loss', gen_loss, iter_no)
+                tf.summary.scalar("dis_loss", discr_loss, iter_no)
 
         if iter_no % SAVE_IMAGE_EVERY_ITER == 0:
-            with summary.as_default():
-                tf.summary.image("fake", gen_output_v, iter_no)
-                tf.summary.image("real", batch_v, iter_no)
+            image_dumper.dump(iter_no, gen_output_v, batch_v)
 
 import ptan
 ptan.experience.ExperienceReplayBuffer
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+Evaluation arena: plays many games between two nets at once and stops as soon as the
+promotion decision is statistically settled.
+At every move, searches of all games waiting for the same net are done in lockstep,
+so every MCTS minibatch is a single network call over all the games.
+The decision is taken by the sequential probability ratio test (SPRT) of the win probability of net1
+(draws are ignored) with hypotheses H0: p = threshold - margin, H1: p = threshold + margin.
+"""
+import math as m
+import time
+
+import numpy as np
+
+from tensorflow_dl.mini_alpha import game, mcts
+
+
+class SPRT:
+    def __init__(self, threshold, margin=0.1, alpha=0.05, beta=0.05):
+        """
+        :param threshold: win ratio net1 has to exceed
+        :param margin: half-width of the indifference region around the threshold
+        :param alpha: probability to accept H1 when H0 is true (promote worse net)
+        :param beta: probability to accept H0 when H1 is true (reject better net)
+        """
+        assert 0.0 < threshold - margin and threshold + margin < 1.0
+        self.p0 = threshold - margin
+        self.p1 = threshold + margin
+        self.lower = m.log(beta / (1.0 - alpha))
+        self.upper = m.log((1.0 - beta) / alpha)
+        self.llr = 0.0
+
+    def update(self, won):
+        """
+        :param won: True if net1 won the game, False if lost
+        """
+        if won:
+            self.llr += m.log(self.p1 / self.p0)
+        else:
+            self.llr += m.log((1.0 - self.p1) / (1.0 - self.p0))
+
+    @property
+    def decision(self):
+        """
+        :return: True if H1 accepted, False if H0 accepted, None if more games are needed
+        """
+        if self.llr >= self.upper:
+            return True
+        if self.llr <= self.lower:
+            return False
+        return None
+
+    @property
+    def confidence(self):
+        """
+        Posterior probability of the currently leading hypothesis, assuming equal priors
+        """
+        return 1.0 / (1.0 + m.exp(-abs(self.llr)))
+
+
+class _Game:
+    def __init__(self, net1_plays_first, game_def):
+        self.state = game_def.initial_state
+        self.cur_player = 0 if net1_plays_first else 1
+        # individual tree for every net
+        self.mcts_stores = [mcts.MCTS(game_def=game_def), mcts.MCTS(game_def=game_def)]
+        self.result = None
+
+
+def evaluate(net1, net2, max_rounds, threshold, parallel_games=8, mcts_searches=20, mcts_batch_size=16,
+             margin=0.1, alpha=0.05, beta=0.05, game_def=None):
+    """
+    Play up to max_rounds games between nets, parallel_games at a time
+    :param game_def: game.Game to play, default 6*7 game if None
+    :return: tuple of (better, win_ratio). better is True if net1 is considered stronger than the threshold.
+    If SPRT is not settled after max_rounds, falls back to comparing win ratio with threshold
+    """
+    if game_def is None:
+        game_def = game.DEFAULT_GAME
+    sprt = SPRT(threshold, margin=margin, alpha=alpha, beta=beta)
+    nets = [net1, net2]
+    n1_win = n2_win = 0
+    started = finished = 0
+    active = []
+    t = time.time()
+
+    while sprt.decision is None and finished < max_rounds:
+        while len(active) < parallel_games and started < max_rounds:
+            active.append(_Game(net1_plays_first=started % 2 == 0, game_def=game_def))
+            started += 1
+
+        for net_idx, net in enumerate(nets):
+            moving = [g for g in active if g.cur_player == net_idx]
+            if not moving:
+                continue
+            stores = [g.mcts_stores[net_idx] for g in moving]
+            states = [g.state for g in moving]
+            players = [g.cur_player for g in moving]
+            for _ in range(mcts_searches):
+                mcts.search_minibatch_multi(stores, states, players, mcts_batch_size, net)
+
+        for g in active:
+            probs, _ = g.mcts_stores[g.cur_player].get_policy_value(g.state, tau=0)
+            action = int(np.argmax(probs))
+            g.state, won = game_def.move(g.state, action, g.cur_player)
+            if won:
+                g.result = 1 if g.cur_player == 0 else -1
+                continue
+            g.cur_player = 1 - g.cur_player
+            if len(game_def.possible_moves(g.state)) == 0:
+                g.result = 0
+                continue
+            for mcts_store in g.mcts_stores:
+                mcts_store.promote(g.state, g.cur_player)
+
+        for g in active:
+            if g.result is None:
+                continue
+            finished += 1
+            if g.result > 0:
+                n1_win += 1
+                sprt.update(True)
+            elif g.result < 0:
+                n2_win += 1
+                sprt.update(False)
+        active = [g for g in active if g.result is None]
+
+    win_ratio = n1_win / max(n1_win + n2_win, 1)
+    better = sprt.decision
+    if better is None:
+        better = win_ratio > threshold
+    dt = time.time() - t
+    print("Arena: %d games, %.2f games/s, win ratio %.2f, decision %s, confidence %.3f" % (
+        finished, finished / dt, win_ratio, "promote" if better else "keep", sprt.confidence))
+    return better, win_ratio
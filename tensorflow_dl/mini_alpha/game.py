@@ -39,15 +39,17 @@ In this representation, the field above will be equal to those bits:
     101,
     000
 ]
-All the code is generic, so, in theory you can try to adjust the field size.
-But tests could become broken.
+The field size is a parameter of the Game class: length of the free entries counter grows with the number of rows
+and all the win lines (segments of COUNT_TO_WIN cells) are precomputed as bitmasks of the binary representation,
+so win check is a couple of AND operations for any field size.
+Module-level functions operate on the default 6*7 game.
 """
 import collections
 
 import numpy as np
 import tensorflow as tf
 
-from tensorflow_dl.mini_alpha import mcts
+from tensorflow_dl.mini_alpha import mcts, replay
 from tensorflow_dl.mini_alpha.model import Net
 
 GAME_ROWS = 6
@@ -59,9 +61,6 @@ COUNT_TO_WIN = 4
 OBS_SHAPE = (2, GAME_ROWS, GAME_COLS)
 
 
-# declared after encode_lists
-
-
 def bits_to_int(bits):
     res = 0
     for b in bits:
@@ -82,127 +81,244 @@ def int_to_bits(num, bits):
 #     return f'{num:0{bits}b}'
 
 
-def encode_lists(field_lists):
+class Game:
     """
-    Encode lists representation into the binary numbers
-    :param field_lists: list of GAME_COLS lists with 0s and 1s
-    :return: integer number with encoded game state
+    4-in-a-row game with the field of arbitrary size. States are integers in the binary representation
+    described in the module docstring
     """
-    assert isinstance(field_lists, list)
-    assert len(field_lists) == GAME_COLS
 
-    bits = []
-    len_bits = []
-    for col in field_lists:
-        bits.extend(col)
-        free_len = GAME_ROWS - len(col)
-        bits.extend([0] * free_len)
-        len_bits.extend(int_to_bits(free_len, bits=BITS_IN_LEN))
-    bits.extend(len_bits)
-    return bits_to_int(bits)
+    def __init__(self, rows=GAME_ROWS, cols=GAME_COLS, count_to_win=COUNT_TO_WIN):
+        assert rows > 0 and cols > 0
+        assert 1 < count_to_win <= max(rows, cols)
+        self.rows = rows
+        self.cols = cols
+        self.count_to_win = count_to_win
+        self.bits_in_len = rows.bit_length()
+        self.field_bits = rows * cols
+        self.state_bits = self.field_bits + cols * self.bits_in_len
+        # amount of uint64 words to hold the state in numpy arrays
+        self.words = (self.state_bits + 63) // 64
+        self.obs_shape = (2, rows, cols)
+
+        # offset (from the least significant bit) of every cell, indexed [col][row_from_bottom]
+        cell_offsets = [[self.state_bits - 1 - (col * rows + row) for row in range(rows)] for col in range(cols)]
+        self._cell_bits = [[1 << ofs for ofs in col_offsets] for col_offsets in cell_offsets]
+        # offset of every column's free entries counter
+        self._len_shifts = [self.state_bits - self.field_bits - (col + 1) * self.bits_in_len for col in range(cols)]
+        self._len_mask = (1 << self.bits_in_len) - 1
+        # mask of occupied cells of the column, indexed [col][pieces_in_column]
+        self._occupied = [[sum(self._cell_bits[col][:count]) for count in range(rows + 1)] for col in range(cols)]
+
+        # win lines as masks of cells, all of them and the ones passing through every cell, indexed [col][row]
+        self.win_lines = []
+        self._cell_win_lines = [[[] for _ in range(rows)] for _ in range(cols)]
+        for delta_col, delta_row in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            for col in range(cols):
+                for row in range(rows):
+                    cells = [(col + i * delta_col, row + i * delta_row) for i in range(count_to_win)]
+                    if not all(0 <= c < cols and 0 <= r < rows for c, r in cells):
+                        continue
+                    line = sum(self._cell_bits[c][r] for c, r in cells)
+                    self.win_lines.append(line)
+                    for c, r in cells:
+                        self._cell_win_lines[c][r].append(line)
+
+        # tables for encode_states: word and shift of every cell laid out as the observation (top row first)
+        obs_offsets = np.array([[cell_offsets[col][rows - 1 - row] for col in range(cols)] for row in range(rows)])
+        self._obs_words = obs_offsets // 64
+        self._obs_shifts = (obs_offsets % 64).astype(np.uint64)
+        # every bit of free entries counters, [col, bit] with the most significant bit first
+        len_offsets = np.array([[shift + self.bits_in_len - 1 - bit for bit in range(self.bits_in_len)]
+                                for shift in self._len_shifts])
+        self._len_words = len_offsets // 64
+        self._len_bit_shifts = (len_offsets % 64).astype(np.uint64)
+        self._len_weights = 2 ** np.arange(self.bits_in_len - 1, -1, -1, dtype=np.int64)
+        self._rows_from_bottom = np.arange(rows - 1, -1, -1).reshape(rows, 1)
+
+        self.initial_state = self.encode_lists([[]] * cols)
+
+    def encode_lists(self, field_lists):
+        """
+        Encode lists representation into the binary numbers
+        :param field_lists: list of cols lists with 0s and 1s
+        :return: integer number with encoded game state
+        """
+        assert isinstance(field_lists, list)
+        assert len(field_lists) == self.cols
+
+        bits = []
+        len_bits = []
+        for col in field_lists:
+            bits.extend(col)
+            free_len = self.rows - len(col)
+            bits.extend([0] * free_len)
+            len_bits.extend(int_to_bits(free_len, bits=self.bits_in_len))
+        bits.extend(len_bits)
+        return bits_to_int(bits)
+
+    def decode_binary(self, state_int):
+        """
+        Decode binary representation into the list view
+        :param state_int: integer representing the field
+        :return: list of cols lists
+        """
+        assert isinstance(state_int, int)
+        bits = int_to_bits(state_int, bits=self.state_bits)
+        res = []
+        len_bits = bits[self.field_bits:]
+        for col in range(self.cols):
+            vals = bits[col * self.rows:(col + 1) * self.rows]
+            lens = bits_to_int(len_bits[col * self.bits_in_len:(col + 1) * self.bits_in_len])
+            if lens > 0:
+                vals = vals[:-lens]
+            res.append(vals)
+        return res
+
+    def _column_len(self, state_int, col):
+        return self.rows - ((state_int >> self._len_shifts[col]) & self._len_mask)
+
+    def possible_moves(self, state_int):
+        """
+        :param state_int: field representation
+        :return: the list of columns which we can make a move
+        """
+        assert isinstance(state_int, int)
+        return [col for col in range(self.cols) if self._column_len(state_int, col) < self.rows]
+
+    def move(self, state_int, col, player):
+        """
+        Perform move into given column. Assume the move could be performed, otherwise, assertion will be raised
+        :param state_int: current state
+        :param col: column to make a move
+        :param player: player index (PLAYER_WHITE or PLAYER_BLACK
+        :return: tuple of (state_new, won). Value won is bool, True if this move lead
+        to victory or False otherwise (but it could be a draw)
+        """
+        assert isinstance(state_int, int)
+        assert 0 <= col < self.cols
+        assert player == PLAYER_BLACK or player == PLAYER_WHITE
+        row = self._column_len(state_int, col)
+        assert row < self.rows
+        # one free entry less, white pieces are zero bits
+        state_new = state_int - (1 << self._len_shifts[col])
+        if player == PLAYER_BLACK:
+            state_new |= self._cell_bits[col][row]
+
+        occupied = 0
+        for c in range(self.cols):
+            occupied |= self._occupied[c][self._column_len(state_new, c)]
+        if player == PLAYER_BLACK:
+            pieces = state_new & occupied
+        else:
+            pieces = occupied & ~state_new
+        won = any(pieces & line == line for line in self._cell_win_lines[col][row])
+        return state_new, won
+
+    def render(self, state_int):
+        state_list = self.decode_binary(state_int)
+        data = [[' '] * self.cols for _ in range(self.rows)]
+        for col_idx, col in enumerate(state_list):
+            for rev_row_idx, cell in enumerate(col):
+                row_idx = self.rows - rev_row_idx - 1
+                data[row_idx][col_idx] = str(cell)
+        return [''.join(row) for row in data]
+
+    def state_lists_to_batch(self, state_lists, who_moves_lists):
+        """
+        Convert list of list states to batch for network
+        :param state_lists: list of 'list states'
+        :param who_moves_lists: list of player index who moves
+        :return Variable with observations
+        """
+        assert isinstance(state_lists, list)
+        batch_size = len(state_lists)
+        batch = np.zeros((batch_size,) + self.obs_shape, dtype=np.float32)
+        for idx, (state, who_move) in enumerate(zip(state_lists, who_moves_lists)):
+            self._encode_list_state(batch[idx], state, who_move)
+        return tf.convert_to_tensor(batch)
+
+    def _encode_list_state(self, dest_np, state_list, who_move):
+        """
+        In-place encodes list state into the zero numpy array
+        :param dest_np: dest array, expected to be zero
+        :param state_list: state of the game in the list form
+        :param who_move: player index (game.PLAYER_WHITE or game.PLAYER_BLACK) who to move
+        """
+        assert dest_np.shape == self.obs_shape
+
+        for col_idx, col in enumerate(state_list):
+            for rev_row_idx, cell in enumerate(col):
+                row_idx = self.rows - rev_row_idx - 1
+                if cell == who_move:
+                    dest_np[0, row_idx, col_idx] = 1.0
+                else:
+                    dest_np[1, row_idx, col_idx] = 1.0
+
+    def to_words(self, state_ints):
+        """
+        Convert states into uint64 array of shape (batch, words), word k holds bits [64*k, 64*k+64)
+        :param state_ints: sequence of integer states or array which is already converted
+        """
+        if self.words == 1:
+            return np.asarray(state_ints, dtype=np.uint64).reshape(-1, 1)
+        if isinstance(state_ints, np.ndarray):
+            return state_ints.reshape(-1, self.words)
+        mask = (1 << 64) - 1
+        return np.array([[(state_int >> (64 * word)) & mask for word in range(self.words)]
+                         for state_int in state_ints], dtype=np.uint64)
+
+    def encode_states(self, state_ints, who_moves):
+        """
+        Vectorized version of state_lists_to_batch working directly on the binary states
+        :param state_ints: sequence of integer states or array returned by to_words
+        :param who_moves: sequence or array of player index who moves
+        :return: float32 numpy array of shape (batch,) + obs_shape
+        """
+        words = self.to_words(state_ints)
+        who_moves = np.asarray(who_moves, dtype=np.uint64).reshape(-1, 1, 1)
+        # (batch, cols) amount of pieces in every column
+        len_bits = (words[:, self._len_words] >> self._len_bit_shifts) & np.uint64(1)
+        filled = self.rows - (len_bits.astype(np.int64) * self._len_weights).sum(axis=-1)
+        occupied = self._rows_from_bottom < filled[:, np.newaxis, :]
+        cells = (words[:, self._obs_words] >> self._obs_shifts) & np.uint64(1)
+        own = cells == who_moves
+        batch = np.empty((words.shape[0],) + self.obs_shape, dtype=np.float32)
+        batch[:, 0] = occupied & own
+        batch[:, 1] = occupied & ~own
+        return batch
+
+    def state_ints_to_batch(self, state_ints, who_moves):
+        """
+        Convert binary states to batch for network without decoding them into lists
+        :param state_ints: sequence of integer states
+        :param who_moves: sequence of player index who moves
+        :return: tensor with observations
+        """
+        return tf.convert_to_tensor(self.encode_states(state_ints, who_moves))
+
+
+DEFAULT_GAME = Game(GAME_ROWS, GAME_COLS, COUNT_TO_WIN)
+INITIAL_STATE = DEFAULT_GAME.initial_state
 
 
-INITIAL_STATE = encode_lists([[]] * GAME_COLS)
+def encode_lists(field_lists):
+    return DEFAULT_GAME.encode_lists(field_lists)
 
 
 def decode_binary(state_int):
-    """
-    Decode binary representation into the list view
-    :param state_int: integer representing the field
-    :return: list of GAME_COLS lists
-    """
-    assert isinstance(state_int, int)
-    bits = int_to_bits(state_int, bits=GAME_COLS * GAME_ROWS + GAME_COLS * BITS_IN_LEN)
-    res = []
-    len_bits = bits[GAME_COLS * GAME_ROWS:]
-    for col in range(GAME_COLS):
-        vals = bits[col * GAME_ROWS:(col + 1) * GAME_ROWS]
-        lens = bits_to_int(len_bits[col * BITS_IN_LEN:(col + 1) * BITS_IN_LEN])
-        if lens > 0:
-            vals = vals[:-lens]
-        res.append(vals)
-    return res
+    return DEFAULT_GAME.decode_binary(state_int)
 
 
 def possible_moves(state_int):
-    """
-    This function could be calculated directly from bits, but I'm too lazy
-    :param state_int: field representation
-    :return: the list of columns which we can make a move
-    """
-    assert isinstance(state_int, int)
-    field = decode_binary(state_int)
-    return [idx for idx, col in enumerate(field) if len(col) < GAME_ROWS]
-
-
-def _check_won(field, col, delta_row):
-    """
-    Check for horisontal/diagonal win condition for the last player moved in the column
-    :param field: list of lists
-    :param col: column index
-    :param delta_row: if 0, checks for horisonal won, 1 for rising diagonal, -1 for falling
-    :return: True if won, False if not
-    """
-    player = field[col][-1]
-    coord = len(field[col]) - 1
-    total = 1
-    # negative dir
-    cur_coord = coord - delta_row
-    for c in range(col - 1, -1, -1):
-        if len(field[c]) <= cur_coord or cur_coord < 0 or cur_coord >= GAME_ROWS:
-            break
-        if field[c][cur_coord] != player:
-            break
-        total += 1
-        if total == COUNT_TO_WIN:
-            return True
-        cur_coord -= delta_row
-    # positive dir
-    cur_coord = coord + delta_row
-    for c in range(col + 1, GAME_COLS):
-        if len(field[c]) <= cur_coord or cur_coord < 0 or cur_coord >= GAME_ROWS:
-            break
-        if field[c][cur_coord] != player:
-            break
-        total += 1
-        if total == COUNT_TO_WIN:
-            return True
-        cur_coord += delta_row
-    return False
+    return DEFAULT_GAME.possible_moves(state_int)
 
 
 def move(state_int, col, player):
-    """
-    Perform move into given column. Assume the move could be performed, otherwise, assertion will be raised
-    :param state_int: current state
-    :param col: column to make a move
-    :param player: player index (PLAYER_WHITE or PLAYER_BLACK
-    :return: tuple of (state_new, won). Value won is bool, True if this move lead
-    to victory or False otherwise (but it could be a draw)
-    """
-    assert isinstance(state_int, int)
-    assert 0 <= col < GAME_COLS
-    assert player == PLAYER_BLACK or player == PLAYER_WHITE
-    field = decode_binary(state_int)
-    assert len(field[col]) < GAME_ROWS
-    field[col].append(player)
-    # check for victory: the simplest vertical case
-    suff = field[col][-COUNT_TO_WIN:]
-    won = suff == [player] * COUNT_TO_WIN
-    if not won:
-        won = _check_won(field, col, 0) or _check_won(field, col, 1) or _check_won(field, col, -1)
-    state_new = encode_lists(field)
-    return state_new, won
+    return DEFAULT_GAME.move(state_int, col, player)
 
 
 def render(state_int):
-    state_list = decode_binary(state_int)
-    data = [[' '] * GAME_COLS for _ in range(GAME_ROWS)]
-    for col_idx, col in enumerate(state_list):
-        for rev_row_idx, cell in enumerate(col):
-            row_idx = GAME_ROWS - rev_row_idx - 1
-            data[row_idx][col_idx] = str(cell)
-    return [''.join(row) for row in data]
+    return DEFAULT_GAME.render(state_int)
 
 
 def update_counts(counts_dict, key, counts):
@@ -212,40 +328,19 @@ def update_counts(counts_dict, key, counts):
 
 
 def state_lists_to_batch(state_lists, who_moves_lists):
-    """
-    Convert list of list states to batch for network
-    :param state_lists: list of 'list states'
-    :param who_moves_lists: list of player index who moves
-    :return Variable with observations
-    """
-    assert isinstance(state_lists, list)
-    batch_size = len(state_lists)
-    batch = np.zeros((batch_size,) + OBS_SHAPE, dtype=np.float32)
-    for idx, (state, who_move) in enumerate(zip(state_lists, who_moves_lists)):
-        _encode_list_state(batch[idx], state, who_move)
-    return tf.convert_to_tensor(batch)
+    return DEFAULT_GAME.state_lists_to_batch(state_lists, who_moves_lists)
 
 
-def _encode_list_state(dest_np, state_list, who_move):
-    """
-    In-place encodes list state into the zero numpy array
-    :param dest_np: dest array, expected to be zero
-    :param state_list: state of the game in the list form
-    :param who_move: player index (game.PLAYER_WHITE or game.PLAYER_BLACK) who to move
-    """
-    assert dest_np.shape == OBS_SHAPE
+def encode_states(state_ints, who_moves):
+    return DEFAULT_GAME.encode_states(state_ints, who_moves)
+
 
-    for col_idx, col in enumerate(state_list):
-        for rev_row_idx, cell in enumerate(col):
-            row_idx = GAME_ROWS - rev_row_idx - 1
-            if cell == who_move:
-                dest_np[0, row_idx, col_idx] = 1.0
-            else:
-                dest_np[1, row_idx, col_idx] = 1.0
+def state_ints_to_batch(state_ints, who_moves):
+    return DEFAULT_GAME.state_ints_to_batch(state_ints, who_moves)
 
 
 def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_searches, mcts_batch_size,
-              net1_plays_first=None):
+              net1_plays_first=None, game_def=None):
     """
         Play one single game, memorizing transitions into the replay buffer
         :param mcts_batch_size: mcts batch size for running search
@@ -256,9 +351,10 @@ def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_s
         :param replay_buffer: queue with (state, probs, values), if None, nothing is stored
         :param net1: player1
         :param net2: player2
+        :param game_def: Game to play, default 6*7 game if None
         :return: value for the game in respect to player1 (+1 if p1 won, -1 if lost, 0 if draw)
     """
-    assert isinstance(replay_buffer, (collections.deque, type(None)))
+    assert isinstance(replay_buffer, (collections.deque, replay.ReplayBuffer, type(None)))
     assert isinstance(mcts_stores, (mcts.MCTS, type(None), list))
     assert isinstance(net1, Net)
     assert isinstance(net2, Net)
@@ -266,12 +362,15 @@ def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_s
     assert isinstance(mcts_searches, int) and mcts_searches > 0
     assert isinstance(mcts_batch_size, int) and mcts_batch_size > 0
 
+    if game_def is None:
+        game_def = DEFAULT_GAME
     if mcts_stores is None:
-        mcts_stores = [mcts.MCTS(), mcts.MCTS()]
+        mcts_stores = [mcts.MCTS(game_def=game_def), mcts.MCTS(game_def=game_def)]
     elif isinstance(mcts_stores, mcts.MCTS):
         mcts_stores = [mcts_stores, mcts_stores]
 
-    state = INITIAL_STATE
+    unique_stores = mcts_stores[:1] if mcts_stores[0] is mcts_stores[1] else mcts_stores
+    state = game_def.initial_state
     nets = [net1, net2]
 
     if net1_plays_first is None:
@@ -291,11 +390,11 @@ def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_s
 
         probs, _ = mcts_stores[cur_player].get_policy_value(state, tau)
         game_history.append((state, cur_player, probs))
-        action = np.random.choice(GAME_COLS, p=probs)
-        if action not in possible_moves(state):
+        action = np.random.choice(game_def.cols, p=probs)
+        if action not in game_def.possible_moves(state):
             print("Select impossible action")
 
-        state, won = move(state, action, cur_player)
+        state, won = game_def.move(state, action, cur_player)
         if won:
             result = 1
             net1_result = 1 if cur_player == 0 else -1
@@ -303,11 +402,15 @@ def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_s
         cur_player = 1 - cur_player
 
         # check draw
-        if len(possible_moves(state)) == 0:
+        if len(game_def.possible_moves(state)) == 0:
             result = 0
             net1_result = 0
             break
 
+        # reuse the subtree of the move made, the rest of the tree couldn't be reached anymore
+        for mcts_store in unique_stores:
+            mcts_store.promote(state, cur_player)
+
         step += 1
         if step >= steps_before_tau_0:
             tau = 0
@@ -1,4 +1,7 @@
+import heapq
 import math as m
+import sys
+
 import numpy as np
 import tensorflow as tf
 
@@ -6,8 +9,20 @@ from tensorflow_dl.mini_alpha import game
 
 
 class MCTS:
-    def __init__(self, c_puct=1.0):
+    def __init__(self, c_puct=1.0, node_budget=None, game_def=None):
+        """
+        :param c_puct: exploration constant
+        :param node_budget: max amount of nodes kept in the tree, None for unlimited. When the tree grows over
+        the budget, the least visited nodes are evicted
+        :param game_def: game.Game to search in, default 6*7 game if None
+        """
+        assert node_budget is None or node_budget > 0
+        self.game_def = game.DEFAULT_GAME if game_def is None else game_def
         self.c_puct = c_puct
+        self.node_budget = node_budget
+        # total amount of nodes created and removed, used to report the search speed
+        self.nodes_created = 0
+        self.nodes_removed = 0
         self.visit_count = {}
         # total value of the state's action, state_int -> [W(s, a)]
         self.value = {}
@@ -15,16 +30,123 @@ class MCTS:
         self.value_avg = {}
         # prior probability of actions, state_int -> [P(s,a)]
         self.probs = {}
+        # (state_int, player) of the roots searched since the last promote, every node is in the subtree of one of them
+        self.roots = set()
 
     def clear(self):
         self.visit_count.clear()
         self.value.clear()
         self.value_avg.clear()
         self.probs.clear()
+        self.roots.clear()
 
     def __len__(self):
         return len(self.value)
 
+    def nbytes(self):
+        """
+        Approximate memory occupied by the tree: dicts plus per-node lists and arrays
+        """
+        total = sum(sys.getsizeof(d) for d in (self.visit_count, self.value, self.value_avg, self.probs))
+        for state_int, probs in self.probs.items():
+            total += sys.getsizeof(state_int) + probs.nbytes
+            total += sys.getsizeof(self.visit_count[state_int]) + sys.getsizeof(self.value[state_int]) + \
+                sys.getsizeof(self.value_avg[state_int])
+        return total
+
+    def _remove(self, state_int):
+        del self.visit_count[state_int]
+        del self.value[state_int]
+        del self.value_avg[state_int]
+        del self.probs[state_int]
+        self.nodes_removed += 1
+
+    def _walk(self, roots, skip=()):
+        """
+        Walk the tree from the roots over the visited edges
+        :param roots: list of (state_int, player)
+        :param skip: nodes not entered, with their subtrees
+        :return: tuple of (players, children)
+        1. players: dict of the nodes walked -> player to move
+        2. children: dict of the nodes walked -> list of expanded children
+        """
+        players = {}
+        children = {}
+        queue = []
+        for root_state, root_player in roots:
+            if root_state not in skip and not self.is_leaf(root_state) and root_state not in players:
+                players[root_state] = root_player
+                queue.append(root_state)
+        while queue:
+            cur_state = queue.pop()
+            cur_children = []
+            for action, count in enumerate(self.visit_count[cur_state]):
+                if count == 0:
+                    continue
+                child, won = self.game_def.move(cur_state, action, players[cur_state])
+                if won or child in skip or self.is_leaf(child):
+                    continue
+                cur_children.append(child)
+                if child not in players:
+                    players[child] = 1 - players[cur_state]
+                    queue.append(child)
+            children[cur_state] = cur_children
+        return players, children
+
+    def promote(self, state_int, player):
+        """
+        Make the state a new root of the tree: all the nodes which are not reachable from it are dropped.
+        Only visited edges are followed: the kept subtree is walked to find the nodes shared by transpositions,
+        then the rest of the tree is walked from the old roots to remove the dropped nodes, so the cost is
+        proportional to the size of the tree before the move and nodes are never scanned in the dicts
+        :param state_int: state after the move was made
+        :param player: player to move in this state
+        :return: amount of nodes removed
+        """
+        old_roots = list(self.roots)
+        self.roots = {(state_int, player)}
+        if self.is_leaf(state_int):
+            removed = len(self)
+            self.clear()
+            self.roots.add((state_int, player))
+            self.nodes_removed += removed
+            return removed
+
+        reachable, _ = self._walk([(state_int, player)])
+        dropped, _ = self._walk(old_roots, skip=reachable)
+        for s in dropped:
+            self._remove(s)
+        return len(dropped)
+
+    def evict(self, root_state):
+        """
+        Enforce the node budget by evicting the least visited nodes with their subtrees, root is always kept.
+        Tree is shrinked to 90% of the budget to not repeat the eviction on every minibatch
+        :param root_state: root of the current search
+        :return: amount of nodes evicted
+        """
+        if self.node_budget is None or len(self) <= self.node_budget:
+            return 0
+        to_evict = len(self) - int(self.node_budget * 0.9)
+        _, children = self._walk(list(self.roots))
+        # every candidate removes at least one node: itself or as a part of the subtree evicted before
+        candidates = heapq.nsmallest(to_evict + 1, self.visit_count.items(), key=lambda item: sum(item[1]))
+        evicted = 0
+        for state_int, _ in candidates:
+            if evicted >= to_evict:
+                break
+            if state_int == root_state:
+                continue
+            subtree = [state_int]
+            while subtree:
+                cur_state = subtree.pop()
+                if self.is_leaf(cur_state) or cur_state == root_state:
+                    continue
+                subtree.extend(children[cur_state])
+                self._remove(cur_state)
+                evicted += 1
+        return evicted
+
     def is_leaf(self, state_int):
         return state_int not in self.probs
 
@@ -56,17 +178,17 @@ class MCTS:
 
             # choose action to take, in the root node add the Dirichlet noise to the probs
             if cur_state == state_int:
-                noises = np.random.dirichlet([0.03] * game.GAME_COLS)
+                noises = np.random.dirichlet([0.03] * self.game_def.cols)
                 probs = [0.75 * prob + 0.25 * noise for prob, noise in zip(probs, noises)]
             score = [value + self.c_puct * prob * total_sqrt / (1 + count) for value, prob, count in
                      zip(values_avg, probs, counts)]
-            invalid_actions = set(range(game.GAME_COLS)) - set(game.possible_moves(cur_state))
+            invalid_actions = set(range(self.game_def.cols)) - set(self.game_def.possible_moves(cur_state))
             for invalid in invalid_actions:
                 score[invalid] = -np.inf
             action = np.argmax(score)
             actions.append(action)
 
-            cur_state, won = game.move(cur_state, action, cur_player)
+            cur_state, won = self.game_def.move(cur_state, action, cur_player)
 
             if won:
                 # if somebody won the game, the value of the final state is -1 (as it is on opponent's turn)
@@ -74,23 +196,23 @@ class MCTS:
 
             cur_player = 1 - cur_player
             # check for the draw
-            if value is None and len(game.possible_moves(cur_state)) == 0:
+            if value is None and len(self.game_def.possible_moves(cur_state)) == 0:
                 value = 0.0
 
         return value, cur_state, cur_player, states, actions
 
-    def search_minibatch(self, count, state_int, player, net):
+    def collect_leaves(self, count, state_int, player):
         """
-        Perform MCTS searches
-        :param count:
-        :param state_int:
-        :param player:
-        :param net:
-        :return:
+        Selection phase of the search: find up to count leaves to be expanded
+        :param count: amount of tree traversals
+        :param state_int: root state
+        :param player: player to move at the root
+        :return: tuple of (backup_queue, expand_queue)
+        1. backup_queue: list of (value, states, actions) for the traversals finished in the terminal state
+        2. expand_queue: list of (leaf_state, leaf_player, states, actions) for unique leaves to evaluate
         """
+        self.roots.add((state_int, player))
         backup_queue = []
-        expand_states = []
-        expand_players = []
         expand_queue = []
         planned = set()
 
@@ -101,36 +223,49 @@ class MCTS:
             else:
                 if leaf_state not in planned:
                     planned.add(leaf_state)
-                    leaf_state_lists = game.decode_binary(leaf_state)
-                    expand_states.append(leaf_state_lists)
-                    expand_players.append(leaf_player)
-                    expand_queue.append((leaf_state, states, actions))
-
-        # Expansion
-        if expand_queue:
-            batch_v = game.state_lists_to_batch(expand_states, expand_players)
-            logits_v, values_v = net(batch_v)
-            values = values_v.numpy()[:, 0]
-            probs = tf.nn.softmax(logits_v, axis=1).numpy()
-
-            # create nodes
-            for (leaf_state, states, actions), value, prob in zip(expand_queue, values, probs):
-                self.probs[leaf_state] = prob
-                self.value[leaf_state] = [0.0] * game.GAME_COLS
-                self.value_avg[leaf_state] = [0.0] * game.GAME_COLS
-                self.visit_count[leaf_state] = [0] * game.GAME_COLS
-                backup_queue.append((value, states, actions))
+                    expand_queue.append((leaf_state, leaf_player, states, actions))
+        return backup_queue, expand_queue
+
+    def expand_and_backup(self, backup_queue, expand_queue, probs, values):
+        """
+        Expansion and backup phases of the search
+        :param backup_queue: terminal traversals returned by collect_leaves
+        :param expand_queue: leaves returned by collect_leaves
+        :param probs: prior probabilities for every leaf in expand_queue
+        :param values: values for every leaf in expand_queue
+        """
+        # create nodes
+        for (leaf_state, _, states, actions), value, prob in zip(expand_queue, values, probs):
+            self.probs[leaf_state] = prob
+            self.value[leaf_state] = [0.0] * self.game_def.cols
+            self.value_avg[leaf_state] = [0.0] * self.game_def.cols
+            self.visit_count[leaf_state] = [0] * self.game_def.cols
+            self.nodes_created += 1
+            backup_queue.append((value, states, actions))
 
         # Backup search
         for value, states, actions in backup_queue:
             # leaf state is not stored in states and actions, so the value of the leaf will be the value of the opponent
             cur_value = -value
-            for state_int, action in zip(states[::-1], actions[::-1]):
-                self.visit_count[state_int][action] += 1
-                self.value[state_int][action] += cur_value
-                self.value_avg[state_int][action] = self.value[state_int][action] / self.visit_count[state_int][action]
+            for state, action in zip(states[::-1], actions[::-1]):
+                self.visit_count[state][action] += 1
+                self.value[state][action] += cur_value
+                self.value_avg[state][action] = self.value[state][action] / self.visit_count[state][action]
                 cur_value = -cur_value
 
+    def search_minibatch(self, count, state_int, player, net):
+        """
+        Perform MCTS searches
+        :param count: amount of tree traversals
+        :param state_int: root state
+        :param player: player to move at the root
+        :param net: network to evaluate the leaves
+        """
+        backup_queue, expand_queue = self.collect_leaves(count, state_int, player)
+        probs, values = evaluate_leaves(net, expand_queue, self.game_def)
+        self.expand_and_backup(backup_queue, expand_queue, probs, values)
+        self.evict(state_int)
+
     def search_batch(self, count, batch_size, state_int, player, net):
         for _ in range(count):
             self.search_minibatch(batch_size, state_int, player, net)
@@ -143,7 +278,7 @@ class MCTS:
         """
         counts = self.visit_count[state_int]
         if tau == 0:
-            probs = [0.0] * game.GAME_COLS
+            probs = [0.0] * self.game_def.cols
             probs[int(np.argmax(counts))] = 1.0
         else:
             counts = [count ** (1.0 / tau) for count in counts]
@@ -151,3 +286,36 @@ class MCTS:
             probs = [count / total for count in counts]
         values = self.value_avg[state_int]
         return probs, values
+
+
+def evaluate_leaves(net, expand_queue, game_def):
+    """
+    Run the network on the leaves collected by MCTS.collect_leaves
+    :return: tuple of (probs, values) numpy arrays
+    """
+    if not expand_queue:
+        return [], []
+    batch_v = game_def.state_ints_to_batch([leaf[0] for leaf in expand_queue], [leaf[1] for leaf in expand_queue])
+    logits_v, values_v = net(batch_v)
+    return tf.nn.softmax(logits_v, axis=1).numpy(), values_v.numpy()[:, 0]
+
+
+def search_minibatch_multi(mcts_stores, states, players, count, net):
+    """
+    Perform MCTS searches in several independent trees with one network call for all of them
+    :param mcts_stores: list of MCTS, one per tree
+    :param states: root state for every tree
+    :param players: player to move at every root
+    :param count: amount of traversals in every tree
+    :param net: network to evaluate the leaves
+    """
+    collected = [store.collect_leaves(count, state_int, player)
+                 for store, state_int, player in zip(mcts_stores, states, players)]
+    all_leaves = [leaf for _, expand_queue in collected for leaf in expand_queue]
+    probs, values = evaluate_leaves(net, all_leaves, mcts_stores[0].game_def)
+    ofs = 0
+    for store, state_int, (backup_queue, expand_queue) in zip(mcts_stores, states, collected):
+        size = len(expand_queue)
+        store.expand_and_backup(backup_queue, expand_queue, probs[ofs:ofs + size], values[ofs:ofs + size])
+        store.evict(state_int)
+        ofs += size
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras.layers as layers
 
@@ -58,10 +59,85 @@ class Net(tf.keras.Model):
         ])
 
     def call(self, inputs, training=None, mask=None):
-        v = self.conv_in(inputs)
+        v = self.conv_in(inputs, training=training)
         for block in self.res_blocks:
-            v = v + block(v)
-        val = self.value(v)
-        pol = self.policy(v)
+            v = v + block(v, training=training)
+        val = self.value(v, training=training)
+        pol = self.policy(v, training=training)
 
         return pol, val
+
+    def export_inference(self, obs_shape):
+        """
+        Build inference-only copy of the network with BatchNorm folded into the preceding convolutions
+        and the forward pass compiled for batches of obs_shape observations.
+        The copy doesn't follow further updates of this network, export it again after training
+        :param obs_shape: shape of single observation
+        :return: InferenceNet
+        """
+        dummy = tf.zeros((1,) + tuple(obs_shape), dtype=tf.float32)
+        conv_in = fold_batch_norm(self.conv_in, dummy)
+        v = self.conv_in(dummy)
+        res_blocks = [fold_batch_norm(block, v) for block in self.res_blocks]
+        value = fold_batch_norm(self.value, v)
+        policy = fold_batch_norm(self.policy, v)
+        return InferenceNet(conv_in, res_blocks, value, policy, obs_shape)
+
+
+class InferenceNet(Net):
+    """
+    Net with frozen weights and without BatchNorm layers, created by Net.export_inference
+    """
+
+    def __init__(self, conv_in, res_blocks, value, policy, obs_shape):
+        tf.keras.Model.__init__(self)
+        self.conv_in = conv_in
+        self.res_blocks = res_blocks
+        self.value = value
+        self.policy = policy
+        # with mixed precision policy, inputs are casted to the compute dtype before call
+        self.forward = tf.function(super(InferenceNet, self).call,
+                                   input_signature=[tf.TensorSpec((None,) + tuple(obs_shape),
+                                                                  dtype=self.compute_dtype)])
+
+    def call(self, inputs, training=None, mask=None):
+        return self.forward(inputs)
+
+
+def fold_batch_norm(sequential, inputs):
+    """
+    Copy sequential model, merging every Conv2D -> BatchNormalization pair into single Conv2D with bias:
+    w' = w * gamma / sqrt(var + eps), b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    :param sequential: tf.keras.Sequential to copy
+    :param inputs: sample input of the model, used to build the copy
+    :return: new tf.keras.Sequential
+    """
+    src_layers = sequential.layers
+    new_layers = []
+    new_weights = []
+    idx = 0
+    while idx < len(src_layers):
+        layer = src_layers[idx]
+        next_layer = src_layers[idx + 1] if idx + 1 < len(src_layers) else None
+        if isinstance(layer, layers.Conv2D) and isinstance(next_layer, layers.BatchNormalization):
+            kernel = layer.kernel.numpy()
+            bias = layer.bias.numpy() if layer.use_bias else np.zeros(kernel.shape[-1], dtype=np.float32)
+            gamma = next_layer.gamma.numpy() if next_layer.scale else 1.0
+            beta = next_layer.beta.numpy() if next_layer.center else 0.0
+            scale = gamma / np.sqrt(next_layer.moving_variance.numpy() + next_layer.epsilon)
+            config = layer.get_config()
+            config['use_bias'] = True
+            new_layers.append(layers.Conv2D.from_config(config))
+            new_weights.append([kernel * scale, (bias - next_layer.moving_mean.numpy()) * scale + beta])
+            idx += 2
+        else:
+            new_layers.append(layer.__class__.from_config(layer.get_config()))
+            new_weights.append(layer.get_weights())
+            idx += 1
+
+    folded = tf.keras.Sequential(new_layers)
+    folded(inputs)
+    for layer, weights in zip(new_layers, new_weights):
+        if weights:
+            layer.set_weights(weights)
+    return folded
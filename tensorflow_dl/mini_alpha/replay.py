@@ -0,0 +1,54 @@
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_dl.mini_alpha import game
+
+
+class ReplayBuffer:
+    """
+    Replay buffer of AlphaZero self-play positions kept in preallocated arrays.
+    Boards are stored in their binary form as uint64 words (single word for the default game), so the buffer costs
+    8 * words + 1 + 4 * cols + 4 bytes per position. Behaves like collections.deque(maxlen=capacity)
+    for the (state_int, player, probs, value) items appended by game.play_game
+    """
+
+    def __init__(self, capacity, game_def=None):
+        assert isinstance(capacity, int) and capacity > 0
+        self.game_def = game.DEFAULT_GAME if game_def is None else game_def
+        self.capacity = capacity
+        self.states = np.zeros((capacity, self.game_def.words), dtype=np.uint64)
+        self.players = np.zeros(capacity, dtype=np.uint8)
+        self.probs = np.zeros((capacity, self.game_def.cols), dtype=np.float32)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.pos = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, item):
+        state_int, player, probs, value = item
+        self.states[self.pos] = self.game_def.to_words([state_int])[0]
+        self.players[self.pos] = player
+        self.probs[self.pos] = probs
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size, flip=False):
+        """
+        Sample batch of positions without replacement
+        :param batch_size: size of the batch
+        :param flip: if True, every position is mirrored horizontally with probability 0.5.
+        Connect four is symmetric, so the mirrored position has the mirrored policy and the same value
+        :return: tuple of tensors (states, probs, values)
+        """
+        assert batch_size <= self.size
+        indices = np.random.choice(self.size, batch_size, replace=False)
+        states = self.game_def.encode_states(self.states[indices], self.players[indices])
+        probs = self.probs[indices]
+        if flip:
+            mask = np.random.random(batch_size) < 0.5
+            states[mask] = states[mask, :, :, ::-1]
+            probs[mask] = probs[mask, ::-1]
+        return tf.convert_to_tensor(states), tf.convert_to_tensor(probs), tf.convert_to_tensor(self.values[indices])
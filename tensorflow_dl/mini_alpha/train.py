@@ -1,113 +1,142 @@
-import collections
-import random
 import time
 
 import tensorflow as tf
 
-from tensorflow_dl.mini_alpha import game, model, mcts
+from tensorflow_dl.mini_alpha import arena, game, model, mcts, replay
 
+# field size could be adjusted with game.Game(rows, cols, count_to_win)
+GAME = game.DEFAULT_GAME
 PLAY_EPISODES = 1  # 25
 MCTS_SEARCHES = 10
 MCTS_BATCH_SIZE = 8
+MCTS_NODE_BUDGET = 200000
 REPLAY_BUFFER = 5000  # 30000
 LEARNING_RATE = 0.1
 BATCH_SIZE = 256
 TRAIN_ROUNDS = 10
 MIN_REPLAY_TO_TRAIN = 2000  # 10000
+# mirror sampled positions horizontally
+FLIP_AUGMENTATION = False
 
 BEST_NET_WIN_RATIO = 0.60
 
 EVALUATE_EVERY_STEP = 100
 EVALUATION_ROUNDS = 20
+EVALUATION_PARALLEL_GAMES = 10
 STEPS_BEFORE_TAU_0 = 10
 
-
-def evaluate(net1, net2, rounds):
-    n1_win = n2_win = 0
-    mcts_stores = [mcts.MCTS(), mcts.MCTS()]
-
-    for idx in range(rounds):
-        r, _ = game.play_game(mcts_stores, replay_buffer=None, net1=net1, net2=net2, steps_before_tau_0=0,
-                              mcts_searches=20, mcts_batch_size=16)
-
-        if r < -0.5:
-            n2_win += 1
-        elif r > 0.5:
-            n1_win += 1
-
-    return n1_win / (n1_win + n2_win)
+# bfloat16 compute with float32 weights, pays off on CPUs with AVX512-BF16/AMX
+MIXED_PRECISION = False
+JIT_COMPILE = True
+
+
+class TrainStep:
+    """
+    Compiled training step of the AlphaZero net. Losses are accumulated in variables on the device,
+    so the host reads them only once per training round with result()
+    """
+
+    def __init__(self, net, optimizer, jit_compile=False):
+        self.net = net
+        self.optimizer = optimizer
+        self.sum_loss = tf.Variable(0.0, trainable=False)
+        self.sum_value_loss = tf.Variable(0.0, trainable=False)
+        self.sum_policy_loss = tf.Variable(0.0, trainable=False)
+        self.steps = tf.Variable(0.0, trainable=False)
+        self.step = tf.function(self._step, jit_compile=jit_compile)
+
+    def _step(self, states_v, probs_v, values_v):
+        with tf.GradientTape() as g:
+            out_logits_v, out_values_v = self.net(states_v, training=True)
+            # with mixed precision outputs are in bfloat16, losses are always computed in float32
+            out_logits_v = tf.cast(out_logits_v, tf.float32)
+            out_values_v = tf.cast(out_values_v, tf.float32)
+
+            loss_value_v = tf.keras.losses.MSE(values_v, tf.squeeze(out_values_v, axis=-1))
+            loss_policy_v = -tf.math.log_softmax(out_logits_v, axis=1) * probs_v
+            loss_policy_v = tf.reduce_mean(tf.reduce_sum(loss_policy_v, axis=1))
+
+            loss_v = loss_policy_v + loss_value_v
+
+        gradients = g.gradient(loss_v, self.net.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.net.trainable_variables))
+
+        self.sum_loss.assign_add(loss_v)
+        self.sum_value_loss.assign_add(loss_value_v)
+        self.sum_policy_loss.assign_add(loss_policy_v)
+        self.steps.assign_add(1.0)
+
+    def result(self):
+        """
+        :return: mean (loss, value_loss, policy_loss) since the last call, resets the accumulators
+        """
+        steps = max(self.steps.numpy(), 1.0)
+        res = (self.sum_loss.numpy() / steps, self.sum_value_loss.numpy() / steps,
+               self.sum_policy_loss.numpy() / steps)
+        for v in (self.sum_loss, self.sum_value_loss, self.sum_policy_loss, self.steps):
+            v.assign(0.0)
+        return res
 
 
 if __name__ == '__main__':
-    net = model.Net(actions_n=game.GAME_COLS)
-    best_net = model.Net(actions_n=game.GAME_COLS)
+    if MIXED_PRECISION:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    net = model.Net(actions_n=GAME.cols)
+    best_net = model.Net(actions_n=GAME.cols)
+    # nets are built to export them for inference
+    net(tf.zeros((1,) + GAME.obs_shape))
+    best_net(tf.zeros((1,) + GAME.obs_shape))
+    play_net = best_net.export_inference(GAME.obs_shape)
 
     optimizer = tf.keras.optimizers.Adam(lr=LEARNING_RATE)
+    train_step = TrainStep(net, optimizer, jit_compile=JIT_COMPILE)
 
-    replay_buffer = collections.deque(maxlen=REPLAY_BUFFER)
-    mcts_store = mcts.MCTS()
+    replay_buffer = replay.ReplayBuffer(REPLAY_BUFFER, game_def=GAME)
+    mcts_store = mcts.MCTS(node_budget=MCTS_NODE_BUDGET, game_def=GAME)
     step_idx = 0
     best_idx = 0
 
     while True:
         t = time.time()
-        prev_nodes = len(mcts_store)
+        prev_nodes = mcts_store.nodes_created
         game_steps = 0
         for _ in range(PLAY_EPISODES):
-            _, steps = game.play_game(mcts_store, replay_buffer, best_net, best_net,
+            _, steps = game.play_game(mcts_store, replay_buffer, play_net, play_net,
                                       steps_before_tau_0=STEPS_BEFORE_TAU_0, mcts_searches=MCTS_SEARCHES,
-                                      mcts_batch_size=MCTS_BATCH_SIZE)
+                                      mcts_batch_size=MCTS_BATCH_SIZE, game_def=GAME)
             game_steps += steps
 
-        game_nodes = len(mcts_store) - prev_nodes
+        game_nodes = mcts_store.nodes_created - prev_nodes
         dt = time.time() - t
         speed_steps = game_steps / dt
         speed_nodes = game_nodes / dt
-        print("Step %d, steps %3d, leaves %4d, steps/s %5.2f, leaves/s %6.2f, best_idx %d, replay %d" % (
-            step_idx, game_steps, game_nodes, speed_steps, speed_nodes, best_idx, len(replay_buffer)))
+        print("Step %d, steps %3d, leaves %4d, steps/s %5.2f, leaves/s %6.2f, best_idx %d, replay %d, "
+              "tree %d nodes, %.2f MiB" % (step_idx, game_steps, game_nodes, speed_steps, speed_nodes, best_idx,
+                                           len(replay_buffer), len(mcts_store), mcts_store.nbytes() / 2 ** 20))
         step_idx += 1
 
         if len(replay_buffer) < MIN_REPLAY_TO_TRAIN:
             continue
 
-        sum_loss = 0.0
-        sum_value_loss = 0.0
-        sum_policy_loss = 0.0
-
         for _ in range(TRAIN_ROUNDS):
-            batch = random.sample(replay_buffer, BATCH_SIZE)
-            batch_states, batch_who_moves, batch_probs, batch_values = zip(*batch)
-            batch_states_lists = [game.decode_binary(state) for state in batch_states]
-            states_v = game.state_lists_to_batch(batch_states_lists, batch_who_moves)
-
-            probs_v = tf.convert_to_tensor(batch_probs, dtype=tf.float32)
-            values_v = tf.convert_to_tensor(batch_values, dtype=tf.float32)
-
-            with tf.GradientTape() as g:
-
-                out_logits_v, out_values_v = net(states_v)
-
-                loss_value_v = tf.keras.losses.MSE(values_v, tf.squeeze(out_values_v, axis=-1))
-                loss_policy_v = -tf.math.log_softmax(out_logits_v, axis=1) * probs_v
-                loss_policy_v = tf.reduce_mean(tf.reduce_sum(loss_policy_v, axis=1))
-
-                loss_v = loss_policy_v + loss_value_v
-
-            gradients = g.gradient(loss_v, net.trainable_variables)
-            optimizer.apply_gradients(zip(gradients, net.trainable_variables))
-
-            sum_loss += tf.reduce_mean(loss_v)
-            sum_value_loss += loss_value_v
-            sum_policy_loss += loss_policy_v
+            states_v, probs_v, values_v = replay_buffer.sample(BATCH_SIZE, flip=FLIP_AUGMENTATION)
+            train_step.step(states_v, probs_v, values_v)
+        loss, value_loss, policy_loss = train_step.result()
+        print("Trained, loss %.4f, value loss %.4f, policy loss %.4f" % (loss, value_loss, policy_loss))
 
         if step_idx % EVALUATE_EVERY_STEP == 0:
-            win_ratio = evaluate(net, best_net, rounds=EVALUATION_ROUNDS)
+            better, win_ratio = arena.evaluate(net.export_inference(GAME.obs_shape), play_net,
+                                               max_rounds=EVALUATION_ROUNDS,
+                                               threshold=BEST_NET_WIN_RATIO,
+                                               parallel_games=EVALUATION_PARALLEL_GAMES, game_def=GAME)
             print("Net evaluated, win ratio = %.2f" % win_ratio)
-            if win_ratio > BEST_NET_WIN_RATIO:
+            if better:
                 print("Net is better than cur best, sync")
 
                 best_idx += 1
                 best_net.set_weights(net.get_weights())
+                play_net = best_net.export_inference(GAME.obs_shape)
                 mcts_store.clear()
 
 
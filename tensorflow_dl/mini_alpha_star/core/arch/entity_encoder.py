@@ -22,6 +22,67 @@ def bin_to_dec(b, bits):
     return tf.reduce_sum(mask * b, axis=-1)
 
 
+# raw units for EntityEncoder.preprocess_array, fields are named as the attributes of Entity.
+# missing order progress is NaN
+ENTITY_DTYPE = np.dtype([
+    ('unit_type', np.int64), ('unit_attributes', np.float32, (13,)), ('alliance', np.int64),
+    ('health', np.float64), ('shield', np.float64), ('energy', np.float64),
+    ('cargo_space_taken', np.int64), ('cargo_space_max', np.int64), ('build_progress', np.float64),
+    ('health_max', np.float64), ('shield_max', np.float64), ('energy_max', np.float64),
+    ('display_type', np.int64), ('x', np.int64), ('y', np.int64), ('is_cloaked', np.int64),
+    ('is_powered', np.int64), ('is_hallucination', np.int64), ('is_active', np.int64), ('is_on_screen', np.int64),
+    ('is_in_cargo', np.int64), ('current_minerals', np.float64), ('current_vespene', np.float64),
+    ('mined_minerals', np.float64), ('mined_vespene', np.float64), ('assigned_harvesters', np.int64),
+    ('ideal_harvesters', np.int64), ('weapon_cooldown', np.float64), ('order_length', np.int64),
+    ('order_id_1', np.int64), ('order_id_2', np.int64), ('order_id_3', np.int64), ('order_id_4', np.int64),
+    ('buff_id_1', np.int64), ('buff_id_2', np.int64), ('addon_unit_type', np.int64),
+    ('order_progress_1', np.float64), ('order_progress_2', np.float64),
+    ('attack_upgrade_level', np.int64), ('armor_upgrade_level', np.int64), ('shield_upgrade_level', np.int64),
+    ('is_selected', np.int64), ('is_targeted', np.int64),
+])
+
+
+def _put_one_hot(res, col, indices, depth):
+    """
+    One-hot of the indices into the columns col..col + depth - 1 of res, out of range indices give zeros as tf.one_hot
+    :return: next column
+    """
+    # float values are truncated, as by tf.cast
+    indices = np.asarray(indices).astype(np.int64)
+    rows = np.flatnonzero((indices >= 0) & (indices < depth))
+    res[rows, col + indices[rows]] = 1.0
+    return col + depth
+
+
+def _put_values(res, col, values):
+    """
+    :param values: (rows,) or (rows, width) array
+    :return: next column
+    """
+    values = np.asarray(values).reshape(len(res), -1)
+    res[:, col:col + values.shape[1]] = values
+    return col + values.shape[1]
+
+
+def _put_sqrt_one_hot(res, col, values, max_value):
+    # one-hot of sqrt(min(value, max_value)) with maximum sqrt(max_value), rounding down
+    return _put_one_hot(res, col, np.sqrt(np.minimum(values, max_value)), int(max_value ** 0.5) + 1)
+
+
+def _put_ratio(res, col, values, max_values):
+    has_max = max_values != 0
+    return _put_values(res, col, np.where(has_max, values / np.where(has_max, max_values, 1.0), 0.0))
+
+
+def _put_order_progress(res, col, progress, depth):
+    # progress / 100 and one-hot of (progress / 10), zeros for missing progress
+    known = ~np.isnan(progress)
+    col = _put_values(res, col, np.where(known, progress / 100., 0.0))
+    # the index is truncated after the conversion to float32, as in preprocess
+    indices = np.where(known, np.where(known, progress / 10, 0.0).astype(np.float32), -1.0)
+    return _put_one_hot(res, col, indices, depth)
+
+
 class EntityEncoder(tf.keras.Model):
     def __init__(self, dropout=.1, original_256=AHP.original_256,
                  original_1024=AHP.original_1024,
@@ -91,6 +152,7 @@ class EntityEncoder(tf.keras.Model):
         self.fc1 = layers.Dense(original_256)
 
         self.real_entities_size = 0
+        self._unit_type_index = None
 
     def preprocess(self, entity_list):
         entity_tensor_list = []
@@ -607,6 +669,86 @@ class EntityEncoder(tf.keras.Model):
 
         return all_entities_tensor
 
+    def preprocess_array(self, units, out=None):
+        """
+        The same encoding as preprocess, computed for all entities at once with array operations
+        :param units: structured array of ENTITY_DTYPE, see entities_to_array
+        :param out: (max_entities, embedding_size) float32 array to fill, allocated if None
+        :return: out, rows after the real entities are filled with -1e9
+        """
+        if units.dtype != ENTITY_DTYPE or units.ndim != 1:
+            raise ValueError("units must be 1-D array of ENTITY_DTYPE, got %s of shape %s" % (
+                units.dtype, units.shape))
+        shape = (self.max_entities, AHP.embedding_size)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.dtype != np.float32 or out.shape != shape:
+            raise ValueError("out must be float32 array of shape %s, got %s of shape %s" % (
+                shape, out.dtype, out.shape))
+        units = units[:self.max_entities]
+        self.real_entities_size = len(units)
+        out[len(units):] = -1e9
+        res = out[:len(units)]
+        res[:] = 0.0
+
+        if self._unit_type_index is None:
+            self._unit_type_index = utils.unit_type_index_table()
+        unit_types = units['unit_type']
+        known = (unit_types >= 0) & (unit_types < len(self._unit_type_index))
+        unit_type_index = np.where(known, self._unit_type_index[np.where(known, unit_types, 0)], -1)
+        assert np.all((0 <= unit_type_index) & (unit_type_index <= self.max_unit_type))
+        for name, max_value in (('cargo_space_taken', 8), ('cargo_space_max', 8), ('attack_upgrade_level', 3),
+                                ('armor_upgrade_level', 3), ('shield_upgrade_level', 3)):
+            assert np.all((0 <= units[name]) & (units[name] <= max_value))
+
+        col = _put_one_hot(res, 0, unit_type_index, self.max_unit_type)
+        col = _put_values(res, col, units['unit_attributes'])
+        assert np.all((0 <= units['alliance']) & (units['alliance'] < self.max_alliance))
+        col = _put_one_hot(res, col, units['alliance'], self.max_alliance)
+        col = _put_one_hot(res, col, units['display_type'], self.max_display_type)
+        for name in ('x', 'y'):
+            col = _put_values(res, col, np.unpackbits(units[name].astype(np.uint8)[:, np.newaxis], axis=1))
+        col = _put_sqrt_one_hot(res, col, units['health'], self.max_health)
+        col = _put_sqrt_one_hot(res, col, units['shield'], self.max_shield)
+        col = _put_sqrt_one_hot(res, col, units['energy'], self.max_energy)
+        col = _put_one_hot(res, col, units['cargo_space_taken'], self.max_cargo_space_used)
+        col = _put_one_hot(res, col, units['cargo_space_max'], self.max_cargo_space_maximum)
+        col = _put_values(res, col, units['build_progress'])
+        col = _put_ratio(res, col, units['health'], units['health_max'])
+        col = _put_ratio(res, col, units['shield'], units['shield_max'])
+        col = _put_ratio(res, col, units['energy'], units['energy_max'])
+        col = _put_one_hot(res, col, units['is_cloaked'], self.max_cloakState)
+        col = _put_one_hot(res, col, units['is_powered'], self.max_is_powered)
+        col = _put_one_hot(res, col, units['is_hallucination'], self.max_is_hallucination)
+        col = _put_one_hot(res, col, units['is_active'], self.max_is_active)
+        col = _put_one_hot(res, col, units['is_on_screen'], self.max_is_on_screen)
+        col = _put_one_hot(res, col, units['is_in_cargo'], self.max_is_in_cargo)
+        col = _put_one_hot(res, col, units['current_minerals'] / 100, self.max_current_minerals)
+        col = _put_one_hot(res, col, units['current_vespene'] / 100, self.max_current_vespene)
+        col = _put_sqrt_one_hot(res, col, units['mined_minerals'], self.max_mined_minerals)
+        col = _put_sqrt_one_hot(res, col, units['mined_vespene'], self.max_mined_vespene)
+        col = _put_one_hot(res, col, units['assigned_harvesters'], self.max_assigned_harvesters)
+        col = _put_one_hot(res, col, units['ideal_harvesters'], self.max_ideal_harvesters)
+        col = _put_one_hot(res, col, units['weapon_cooldown'], self.max_weapon_cooldown)
+        col = _put_one_hot(res, col, units['order_length'], self.max_order_queue_length)
+        col = _put_one_hot(res, col, units['order_id_1'], self.max_order_ids)
+        if AHP != MAHP:
+            for name in ('order_id_2', 'order_id_3', 'order_id_4'):
+                col = _put_one_hot(res, col, units[name], self.max_order_ids)
+        col = _put_one_hot(res, col, units['buff_id_1'], self.max_buffer_ids)
+        if AHP != MAHP:
+            col = _put_one_hot(res, col, units['buff_id_2'], self.max_buffer_ids)
+            col = _put_one_hot(res, col, units['addon_unit_type'], self.max_add_on_type)
+        col = _put_order_progress(res, col, units['order_progress_1'], self.max_order_progress)
+        col = _put_order_progress(res, col, units['order_progress_2'], self.max_order_progress)
+        col = _put_one_hot(res, col, units['attack_upgrade_level'], self.max_weapon_upgrades)
+        col = _put_one_hot(res, col, units['armor_upgrade_level'], self.max_armor_upgrades)
+        col = _put_one_hot(res, col, units['shield_upgrade_level'], self.max_shield_upgrades)
+        col = _put_one_hot(res, col, units['is_selected'], self.max_was_selected)
+        col = _put_one_hot(res, col, units['is_targeted'], self.max_was_targeted)
+        assert col == AHP.embedding_size
+        return out
+
     def call(self, inputs, training=None, mask=None):
         # assert the input shape is : batch_seq_size x entities_size x embeding_size
         # note: because the feature size of entity is not equal to 256, so it can not fed into transformer directly.
@@ -705,6 +847,20 @@ class Entity(object):
             self.health)
 
 
+def entities_to_array(entity_list):
+    """
+    :param entity_list: list of Entity
+    :return: structured array of ENTITY_DTYPE for EntityEncoder.preprocess_array
+    """
+    units = np.zeros(len(entity_list), dtype=ENTITY_DTYPE)
+    for name in ENTITY_DTYPE.names:
+        values = [getattr(entity, name) for entity in entity_list]
+        if name in ('order_progress_1', 'order_progress_2'):
+            values = [np.nan if v is None else v for v in values]
+        units[name] = values
+    return units
+
+
 def test():
     print(tf.convert_to_tensor(np.unpackbits(np.array([25], np.uint8))))
     batch_size = 2
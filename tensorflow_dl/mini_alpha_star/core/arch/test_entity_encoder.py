@@ -0,0 +1,197 @@
+"""
+EntityEncoder.preprocess_array must encode the local Entity objects exactly as EntityEncoder.preprocess.
+pysc2 and matplotlib (imported by libs.utils) are replaced by minimal fake modules when they are not installed
+"""
+import enum
+import importlib
+import importlib.util
+import sys
+import types
+
+import numpy as np
+import pytest
+
+PACKAGE = 'tensorflow_dl.mini_alpha_star'
+# sizes of the fake pysc2 give the embedding size of MiniStar_Arch_Hyper_Parameters: 250 unit types + 573 actions
+FAKE_RAW_FUNCTIONS = 573
+# unit type 500 belongs to Neutral and Zerg, 1001 is an alias in Neutral
+FAKE_UNITS = {
+    'Neutral': list(range(1000, 1059)) + [500],
+    'Protoss': [311, 4] + list(range(60, 118)),
+    'Terran': list(range(1, 4)) + list(range(118, 175)),
+    'Zerg': [500, 1908] + list(range(2000, 2068)),
+}
+SHARED_UNIT_TYPE = 500
+
+
+def fake_modules():
+    """
+    :return: dict module name -> fake module, for pysc2 and matplotlib if they are not installed
+    """
+    res = {}
+
+    def add(name, **attrs):
+        res[name] = types.ModuleType(name)
+        res[name].__dict__.update(attrs)
+
+    if importlib.util.find_spec('matplotlib') is None:
+        add('matplotlib')
+        add('matplotlib.pyplot')
+    if importlib.util.find_spec('pysc2') is None:
+        races = {name: enum.IntEnum(name, [('U%d' % v, v) for v in values]) for name, values in FAKE_UNITS.items()}
+        races['Neutral'] = enum.IntEnum('Neutral', [('U%d' % v, v) for v in FAKE_UNITS['Neutral']] + [('Alias', 1001)])
+        minimap = types.SimpleNamespace(**{name: types.SimpleNamespace(index=idx) for idx, name in enumerate(
+            ['height_map', 'visibility_map', 'camera', 'player_relative', 'selected'])})
+        add('pysc2')
+        add('pysc2.lib')
+        add('pysc2.env')
+        add('pysc2.lib.units', **races)
+        add('pysc2.lib.actions', RAW_FUNCTIONS=list(range(FAKE_RAW_FUNCTIONS)), FUNCTIONS=[])
+        add('pysc2.lib.upgrades', Upgrades=enum.IntEnum('Upgrades', [('A', 1)]))
+        add('pysc2.lib.features', Effects=enum.IntEnum('Effects', [('E%d' % i, i) for i in range(1, 13)]),
+            MINIMAP_FEATURES=minimap)
+        add('pysc2.env.sc2_env', Dimensions=lambda **kwargs: kwargs)
+    return res
+
+
+@pytest.fixture(scope='module')
+def modules():
+    """
+    entity_encoder, utils and hyper_params imported over the fake modules. The fakes and the modules imported
+    with them are removed from sys.modules after the tests of this file
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        fakes = fake_modules()
+        for name, module in fakes.items():
+            mp.setitem(sys.modules, name, module)
+        imported_before = set(sys.modules)
+        res = types.SimpleNamespace(ee=importlib.import_module(PACKAGE + '.core.arch.entity_encoder'),
+                                    utils=importlib.import_module(PACKAGE + '.libs.utils'),
+                                    hyper_params=importlib.import_module(PACKAGE + '.libs.hyper_params'),
+                                    fake_pysc2='pysc2' in fakes)
+        mp.setattr(res.utils, 'debug', False)
+        yield res
+        if fakes:
+            for name in set(sys.modules) - imported_before:
+                if name.startswith(PACKAGE):
+                    del sys.modules[name]
+
+
+def unit_types(utils):
+    return [e.value for race in (utils.Neutral, utils.Protoss, utils.Terran, utils.Zerg) for e in race]
+
+
+def random_entity(modules, rng, types_list):
+    max_order_ids = modules.hyper_params.StarCraft_Hyper_Parameters.max_order_ids
+    return modules.ee.Entity(
+        unit_type=int(rng.choice(types_list)), unit_attributes=list(rng.randint(2, size=13)),
+        alliance=int(rng.randint(5)), health=float(rng.uniform(0, 2000)),
+        shield=float(rng.choice([0, rng.uniform(0, 1200)])), energy=float(rng.uniform(0, 300)),
+        cargo_space_taken=int(rng.randint(9)), cargo_space_max=int(rng.randint(9)), build_progress=float(rng.rand()),
+        health_max=float(rng.choice([0, rng.uniform(1, 2000)])), shield_max=float(rng.choice([0, 100])),
+        energy_max=float(rng.choice([0, 250])), display_type=int(rng.randint(7)), x=int(rng.randint(256)),
+        y=int(rng.randint(256)), is_cloaked=int(rng.randint(7)), is_powered=bool(rng.randint(2)),
+        is_hallucination=bool(rng.randint(2)), is_active=bool(rng.randint(2)), is_on_screen=bool(rng.randint(2)),
+        is_in_cargo=bool(rng.randint(2)), current_minerals=int(rng.randint(0, 2500)),
+        current_vespene=int(rng.randint(0, 3000)), mined_minerals=float(rng.uniform(0, 2000)),
+        mined_vespene=int(rng.randint(0, 2600)), assigned_harvesters=int(rng.randint(30)),
+        ideal_harvesters=int(rng.randint(20)), weapon_cooldown=float(rng.uniform(0, 40)),
+        attack_upgrade_level=int(rng.randint(4)), armor_upgrade_level=int(rng.randint(4)),
+        shield_upgrade_level=int(rng.randint(4)), is_selected=bool(rng.randint(2)),
+        is_targeted=bool(rng.randint(2)), order_length=int(rng.randint(11)),
+        order_id_0=int(rng.randint(max_order_ids + 5)), order_id_1=int(rng.randint(600)),
+        order_id_2=int(rng.randint(600)), order_id_3=int(rng.randint(600)),
+        order_progress_0=rng.choice([None, float(rng.randint(0, 101)), float(rng.uniform(0, 100)), 100.0]),
+        order_progress_1=rng.choice([None, float(rng.randint(0, 101)), 30.000000000000004]),
+        buff_id_0=int(rng.randint(310)), buff_id_1=int(rng.randint(310)), addon_unit_type=int(rng.randint(55)))
+
+
+def edge_entities(modules):
+    """
+    Entities with missing order progress, one-hot indices out of range, clipped values and the unit type
+    shared by two races
+    """
+    ee = modules.ee
+    res = [
+        ee.Entity(order_progress_0=None, order_progress_1=None),
+        # indices at and over the one-hot maximum give zeros, as tf.one_hot
+        ee.Entity(display_type=5, is_cloaked=9, current_minerals=1900, current_vespene=5000, assigned_harvesters=25,
+                  ideal_harvesters=40, weapon_cooldown=32.5, order_length=9, buff_id_0=300, buff_id_1=1000,
+                  addon_unit_type=50, order_progress_0=100.0, order_progress_1=150.0),
+        # values over the maximum of the sqrt buckets are clipped
+        ee.Entity(health=10000, shield=5000, energy=1000, mined_minerals=100000, mined_vespene=100000,
+                  health_max=0, shield_max=0, energy_max=0),
+    ]
+    types_list = unit_types(modules.utils)
+    shared = [v for v in types_list if types_list.count(v) > 1]
+    if shared:
+        res.append(ee.Entity(unit_type=shared[0]))
+    return res
+
+
+def encode(modules, encoder, entity_list):
+    """
+    :return: encodings of preprocess and preprocess_array
+    """
+    expected = encoder.preprocess(entity_list).numpy()
+    expected_size = encoder.real_entities_size
+    out = np.zeros_like(expected)
+    actual = encoder.preprocess_array(modules.ee.entities_to_array(entity_list), out=out)
+    assert actual is out
+    assert encoder.real_entities_size == expected_size
+    return expected, actual
+
+
+def test_unit_type_table(modules):
+    table = modules.utils.unit_type_index_table()
+    for unit_type in set(unit_types(modules.utils)):
+        assert table[unit_type] == modules.utils.unit_type_to_unit_type_idx(unit_type)
+
+
+def test_edge_values(modules):
+    if modules.fake_pysc2:
+        # the shared unit type is indexed as the Neutral one
+        assert edge_entities(modules)[-1].unit_type == SHARED_UNIT_TYPE
+        assert modules.utils.unit_type_to_unit_type_idx(SHARED_UNIT_TYPE) == \
+            FAKE_UNITS['Neutral'].index(SHARED_UNIT_TYPE)
+    expected, actual = encode(modules, modules.ee.EntityEncoder(), edge_entities(modules))
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('count', [1, 50, 512, 542])
+def test_random_entities(modules, count):
+    encoder = modules.ee.EntityEncoder()
+    rng = np.random.RandomState(count)
+    types_list = unit_types(modules.utils)
+    expected, actual = encode(modules, encoder, [random_entity(modules, rng, types_list) for _ in range(count)])
+    assert actual.shape == (encoder.max_entities, modules.ee.AHP.embedding_size)
+    assert np.array_equal(actual, expected)
+    # padding rows after the real entities
+    assert np.all(actual[min(count, encoder.max_entities):] == -1e9)
+
+
+def test_full_fields(modules, monkeypatch):
+    # order_2..4, buff_id_2 and addon_unit_type are encoded only by the full AlphaStar field set
+    hp = modules.hyper_params
+    scp = hp.StarCraft_Hyper_Parameters
+    width = modules.ee.AHP.embedding_size + 3 * scp.max_order_ids + scp.max_buffer_ids + scp.max_add_on_type
+    monkeypatch.setattr(modules.ee, 'AHP', hp.AlphaStar_Arch_Hyper_Parameters._replace(
+        embedding_size=width, original_256=32, original_1024=32, original_128=16))
+    rng = np.random.RandomState(1)
+    entity_list = edge_entities(modules) + [random_entity(modules, rng, unit_types(modules.utils)) for _ in range(100)]
+    expected, actual = encode(modules, modules.ee.EntityEncoder(), entity_list)
+    assert np.array_equal(actual, expected)
+
+
+def test_wrong_input(modules):
+    ee = modules.ee
+    encoder = ee.EntityEncoder()
+    units = ee.entities_to_array([ee.Entity()])
+    with pytest.raises(ValueError):
+        encoder.preprocess_array(np.zeros(1, dtype=[('unit_type', np.int64)]))
+    with pytest.raises(ValueError):
+        encoder.preprocess_array(units.reshape(1, 1))
+    with pytest.raises(ValueError):
+        encoder.preprocess_array(units, out=np.zeros((encoder.max_entities, 10), dtype=np.float32))
+    with pytest.raises(ValueError):
+        encoder.preprocess_array(units, out=np.zeros((encoder.max_entities, ee.AHP.embedding_size)))
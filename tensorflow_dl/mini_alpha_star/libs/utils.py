@@ -69,6 +69,21 @@ def get_unit_type_index(unit_type_name, race):
     return -1
 
 
+def unit_type_index_table():
+    """
+    Vectorized form of unit_type_to_unit_type_idx
+    :return: array of unit index in one hot by the unique unit type in sc2, -1 for unknown unit types
+    """
+    races = (Neutral, Protoss, Terran, Zerg)
+    begin_indices = np.cumsum([0] + [len(race) for race in races[:-1]])
+    table = np.full(max(e.value for race in races for e in race) + 1, -1, dtype=np.int64)
+    # unit type found in several races belongs to the first one, as in get_unit_type_name_and_race
+    for race, begin_index in reversed(list(zip(races, begin_indices))):
+        for i, e in enumerate(list(race)):
+            table[e.value] = i + begin_index
+    return table
+
+
 def unpack_bits_for_large_number(x, num_bits):
     if np.issubdtype(x.dtype, np.floating):
         raise ValueError('numpy data type need to be int-like')
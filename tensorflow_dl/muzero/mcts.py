@@ -0,0 +1,183 @@
+"""
+Batched MuZero tree search over many games at once.
+Tree statistics of all games are kept in numpy arrays indexed [game, node], latent states of all the expanded nodes
+live in one preallocated variable indexed by game * max_nodes + node. Every simulation selects one leaf in every game
+and expands all of them with a single recurrent_inference call.
+Search is done for the single player environments (like CartPole): values are not negated between the levels.
+"""
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_dl.muzero import models
+
+
+class MinMaxStats:
+    """
+    Min and max of the values seen in every game's tree, used to normalize Q values into [0, 1]
+    """
+
+    def __init__(self, num_games):
+        self.maximum = np.full(num_games, -np.inf, dtype=np.float32)
+        self.minimum = np.full(num_games, np.inf, dtype=np.float32)
+
+    def reset(self):
+        self.maximum.fill(-np.inf)
+        self.minimum.fill(np.inf)
+
+    def update(self, games, values):
+        np.maximum.at(self.maximum, games, values)
+        np.minimum.at(self.minimum, games, values)
+
+    def normalize(self, games, values):
+        """
+        :param games: (batch,) game indices
+        :param values: (batch, ...) values of these games
+        """
+        shape = (-1,) + (1,) * (values.ndim - 1)
+        maximum = self.maximum[games].reshape(shape)
+        minimum = self.minimum[games].reshape(shape)
+        scale = np.where(maximum > minimum, maximum - minimum, 1.0)
+        return np.where(maximum > minimum, (values - minimum) / scale, values)
+
+
+class BatchedMCTS:
+    def __init__(self, net, num_games, num_simulations, action_space_size, encoding_size, support_size,
+                 discount=0.997, pb_c_base=19652, pb_c_init=1.25, root_dirichlet_alpha=0.25,
+                 root_exploration_fraction=0.25):
+        """
+        :param net: muzero net with compiled_init_inference and compiled_recurrent_inference
+        :param num_games: amount of games searched at once
+        :param num_simulations: simulations per search, tree of every game has num_simulations + 1 nodes max
+        :param action_space_size: amount of actions
+        :param encoding_size: size of the latent state
+        :param support_size: value and reward are categorical over 2 * support_size + 1 bins
+        """
+        self.net = net
+        self.num_games = num_games
+        self.num_simulations = num_simulations
+        self.action_space_size = action_space_size
+        self.support_size = support_size
+        self.discount = discount
+        self.pb_c_base = pb_c_base
+        self.pb_c_init = pb_c_init
+        self.root_dirichlet_alpha = root_dirichlet_alpha
+        self.root_exploration_fraction = root_exploration_fraction
+
+        self.max_nodes = num_simulations + 1
+        self.latent_pool = tf.Variable(tf.zeros((num_games * self.max_nodes, encoding_size)), trainable=False)
+        self.children = np.full((num_games, self.max_nodes, action_space_size), -1, dtype=np.int32)
+        self.prior = np.zeros((num_games, self.max_nodes, action_space_size), dtype=np.float32)
+        self.visit_count = np.zeros((num_games, self.max_nodes), dtype=np.int32)
+        self.value_sum = np.zeros((num_games, self.max_nodes), dtype=np.float32)
+        self.reward = np.zeros((num_games, self.max_nodes), dtype=np.float32)
+        self.min_max_stats = MinMaxStats(num_games)
+        self._games = np.arange(num_games)
+
+    def _reset(self):
+        self.children.fill(-1)
+        self.prior.fill(0.0)
+        self.visit_count.fill(0)
+        self.value_sum.fill(0.0)
+        self.reward.fill(0.0)
+        self.min_max_stats.reset()
+
+    def _store_latent(self, nodes, states):
+        rows = self._games * self.max_nodes + nodes
+        self.latent_pool.scatter_nd_update(rows[:, np.newaxis], states)
+
+    def _node_value(self, games, nodes):
+        visits = self.visit_count[games, nodes]
+        return np.where(visits > 0, self.value_sum[games, nodes] / np.maximum(visits, 1), 0.0)
+
+    def _ucb_scores(self, games, nodes):
+        """
+        pUCT scores of all the actions of the nodes
+        :return: (batch, actions) array
+        """
+        children = self.children[games, nodes]
+        has_child = children >= 0
+        children = np.maximum(children, 0)
+        child_games = games[:, np.newaxis]
+        child_visits = np.where(has_child, self.visit_count[child_games, children], 0)
+        parent_visits = self.visit_count[games, nodes][:, np.newaxis]
+
+        pb_c = np.log((parent_visits + self.pb_c_base + 1) / self.pb_c_base) + self.pb_c_init
+        pb_c = pb_c * np.sqrt(parent_visits) / (child_visits + 1)
+        prior_score = pb_c * self.prior[games, nodes]
+
+        q = self.reward[child_games, children] + self.discount * self._node_value(child_games, children)
+        value_score = np.where(child_visits > 0, self.min_max_stats.normalize(games, q), 0.0)
+        # random tie breaking, otherwise the first action is always taken in unvisited nodes
+        return prior_score + value_score + np.random.uniform(0, 1e-6, size=prior_score.shape)
+
+    def _select(self):
+        """
+        Descend in all the trees until an unexpanded child
+        :return: tuple (parents, actions, path). path is the list of (games, nodes) for every depth
+        """
+        node = np.zeros(self.num_games, dtype=np.int32)
+        parents = np.zeros(self.num_games, dtype=np.int32)
+        actions = np.zeros(self.num_games, dtype=np.int32)
+        path = [(self._games, node.copy())]
+        games = self._games
+        while len(games) > 0:
+            scores = self._ucb_scores(games, node[games])
+            action = np.argmax(scores, axis=1).astype(np.int32)
+            child = self.children[games, node[games], action]
+            parents[games] = node[games]
+            actions[games] = action
+            expanded = child >= 0
+            games = games[expanded]
+            node[games] = child[expanded]
+            if len(games) > 0:
+                path.append((games, node[games]))
+        return parents, actions, path
+
+    def _backup(self, path, values):
+        for games, nodes in reversed(path):
+            self.value_sum[games, nodes] += values[games]
+            self.visit_count[games, nodes] += 1
+            reward = self.reward[games, nodes]
+            self.min_max_stats.update(games, reward + self.discount * self._node_value(games, nodes))
+            values[games] = reward + self.discount * values[games]
+
+    def run(self, observations, add_exploration_noise=True):
+        """
+        Search from the observations of all games
+        :param observations: (num_games, ...) observations batch
+        :param add_exploration_noise: add Dirichlet noise to the root priors
+        :return: tuple (visit_counts, root_values): (num_games, actions) visits of the root children
+        and (num_games,) root values
+        """
+        self._reset()
+        observations = tf.convert_to_tensor(observations, dtype=tf.float32)
+        value, _, policy_logits, encoded_state = self.net.compiled_init_inference(observations)
+        self._store_latent(np.zeros(self.num_games, dtype=np.int32), encoded_state)
+        root_prior = tf.nn.softmax(policy_logits, axis=1).numpy()
+        if add_exploration_noise:
+            noise = np.random.dirichlet([self.root_dirichlet_alpha] * self.action_space_size, size=self.num_games)
+            frac = self.root_exploration_fraction
+            root_prior = root_prior * (1 - frac) + noise * frac
+        self.prior[:, 0] = root_prior
+        root_value = models.support_to_scalar(value, self.support_size).numpy()
+
+        for sim in range(self.num_simulations):
+            parents, actions, path = self._select()
+            new_nodes = np.full(self.num_games, sim + 1, dtype=np.int32)
+            self.children[self._games, parents, actions] = new_nodes
+
+            parent_states = tf.gather(self.latent_pool, self._games * self.max_nodes + parents)
+            value, reward, policy_logits, encoded_state = self.net.compiled_recurrent_inference(parent_states,
+                                                                                               actions)
+            self._store_latent(new_nodes, encoded_state)
+            self.reward[self._games, new_nodes] = models.support_to_scalar(reward, self.support_size).numpy()
+            self.prior[self._games, new_nodes] = tf.nn.softmax(policy_logits, axis=1).numpy()
+
+            path.append((self._games, new_nodes))
+            self._backup(path, models.support_to_scalar(value, self.support_size).numpy())
+
+        visit_counts = self.visit_count[self._games[:, np.newaxis], np.maximum(self.children[:, 0], 0)]
+        visit_counts = np.where(self.children[:, 0] >= 0, visit_counts, 0)
+        root_values = np.where(self.visit_count[:, 0] > 0, self._node_value(self._games, np.zeros_like(self._games)),
+                               root_value)
+        return visit_counts, root_values
@@ -8,10 +8,52 @@ def mlp(input_shape, layer_shapes, output_shape, output_activation=tf.identity,
     layers = []
     for i in range(len(sizes) - 1):
         act = activation if i < len(sizes) - 2 else output_activation
-        layers += [tf.keras.layers.Dense(input_shape=sizes[i], units=sizes[i + 1]), act()]
+        layers += [tf.keras.layers.Dense(input_shape=(sizes[i],), units=sizes[i + 1]), tf.keras.layers.Activation(act)]
     return tf.keras.Sequential([*layers])
 
 
+def normalize_encoded_state(encoded_state):
+    """
+    Scale every encoded state of the batch into [0, 1], graph compatible
+    :param encoded_state: (batch, ...) tensor
+    """
+    axis = list(range(1, len(encoded_state.shape)))
+    min_encoded_state = tf.reduce_min(encoded_state, axis=axis, keepdims=True)
+    max_encoded_state = tf.reduce_max(encoded_state, axis=axis, keepdims=True)
+    scale_encoded_state = tf.maximum(max_encoded_state - min_encoded_state, 1e-5)
+    return (encoded_state - min_encoded_state) / scale_encoded_state
+
+
+def scalar_to_support(x, support_size, eps=0.001):
+    """
+    Convert scalars into categorical representation over [-support_size, support_size] after the invertible
+    transform h(x) = sign(x) * (sqrt(|x| + 1) - 1) + eps * x. Transformed value is split between two neighbour bins
+    :param x: tensor of any shape, for example (batch, K + 1) unroll targets
+    :return: tensor of shape x.shape + (2 * support_size + 1,)
+    """
+    x = tf.convert_to_tensor(x, dtype=tf.float32)
+    x = tf.sign(x) * (tf.sqrt(tf.abs(x) + 1) - 1) + eps * x
+    x = tf.clip_by_value(x, -support_size, support_size)
+    floor = tf.floor(x)
+    prob = x - floor
+    index = tf.cast(floor, tf.int32) + support_size
+    # upper bin is out of the support only when prob is zero, one_hot gives zeros for it
+    return tf.one_hot(index, 2 * support_size + 1) * tf.expand_dims(1 - prob, -1) + \
+        tf.one_hot(index + 1, 2 * support_size + 1) * tf.expand_dims(prob, -1)
+
+
+def support_to_scalar(logits, support_size, eps=0.001):
+    """
+    Convert categorical representation over [-support_size, support_size] into scalars, inverting h(x)
+    :param logits: tensor of shape (..., 2 * support_size + 1)
+    :return: tensor of shape logits.shape[:-1]
+    """
+    probs = tf.nn.softmax(tf.cast(logits, tf.float32), axis=-1)
+    support = tf.range(-support_size, support_size + 1, dtype=tf.float32)
+    x = tf.reduce_sum(probs * support, axis=-1)
+    return tf.sign(x) * (tf.square((tf.sqrt(1 + 4 * eps * (tf.abs(x) + 1 + eps)) - 1) / (2 * eps)) - 1)
+
+
 class AbstractNet(ABC, tf.keras.Model):
     def __init__(self):
         super(AbstractNet, self).__init__()
@@ -77,37 +119,36 @@ class MuZeroFullyConnectedNet(AbstractNet):
             self.full_support_size
         )
 
+        # compiled entry points with fixed signatures: traced once for any batch size and reused by the search
+        stacked_obs_shape = (obs_shape[0] * (stacked_observations + 1) + stacked_observations,
+                             obs_shape[1], obs_shape[2])
+        self.compiled_init_inference = tf.function(
+            self.init_inference,
+            input_signature=[tf.TensorSpec(shape=(None,) + stacked_obs_shape, dtype=tf.float32)])
+        self.compiled_recurrent_inference = tf.function(
+            self.recurrent_inference,
+            input_signature=[tf.TensorSpec(shape=(None, encoding_shape), dtype=tf.float32),
+                             tf.TensorSpec(shape=(None,), dtype=tf.int32)])
+
     def prediction(self, encoded_state):
         policy_logits = self.prediction_policy_network(encoded_state)
         value = self.prediction_value_network(encoded_state)
         return policy_logits, value
 
     def representation(self, observation):
-        encoded_state = self.representation_network(tf.reshape(observation, shape=(observation.shape[0], -1)))
-        min_encoded_state = tf.reduce_min(encoded_state, axis=1, keepdims=True)
-        max_encoded_state = tf.reduce_max(encoded_state, axis=1, keepdims=True)
-        scale_encoded_state = max_encoded_state - min_encoded_state
-        scale_encoded_state[scale_encoded_state < 1e-5] += 1e-5
-        encoded_state_normalized = (encoded_state - min_encoded_state) / scale_encoded_state
-        return encoded_state_normalized
+        encoded_state = self.representation_network(tf.reshape(observation, shape=(tf.shape(observation)[0], -1)))
+        return normalize_encoded_state(encoded_state)
 
     def dynamics(self, encoded_state, action):
-        # Stack encoded_state with a game specific one hot encoded action (See paper appendix)
-        action_one_hot = (tf.zeros(shape=(action.shape[0], self.action_space_size), dtype=tf.float32))
-        tf.tensor_scatter_nd_update(action_one_hot, [1], 1.0)
+        # Stack encoded_state with a game specific one hot encoded action (See paper appendix), action is (batch,)
+        action_one_hot = tf.one_hot(tf.reshape(action, shape=(-1,)), self.action_space_size, dtype=tf.float32)
         x = tf.concat([encoded_state, action_one_hot], axis=1)
 
         next_encoded_state = self.dynamics_encoded_state_network(x)
         reward = self.dynamics_reward_network(next_encoded_state)
 
         # Scale encoded state between 0, 1
-        min_next_encoded_state = tf.reduce_min(next_encoded_state, axis=1)
-        max_next_encoded_state = tf.reduce_max(next_encoded_state, axis=1)
-        scale_next_encoded_state = max_next_encoded_state - min_next_encoded_state
-        scale_next_encoded_state[scale_next_encoded_state < 1e-5] += 1e-5
-        next_encoded_state_normalized = (next_encoded_state - min_next_encoded_state) / scale_next_encoded_state
-
-        return next_encoded_state_normalized, reward
+        return normalize_encoded_state(next_encoded_state), reward
 
     def init_inference(self, observation):
         encoded_state = self.representation(observation)
@@ -115,11 +156,7 @@ class MuZeroFullyConnectedNet(AbstractNet):
 
         # reward  equal to 0 for consistency
         reward = tf.math.log(
-            tf.repeat(
-                tf.tensor_scatter_nd_update(tf.zeros(shape=(1, self.full_support_size)),
-                                            tf.convert_to_tensor([[self.full_support_size // 2]], dtype=tf.int64), 1.0),
-                len(observation), axis=1
-            )
+            tf.one_hot(tf.fill([tf.shape(observation)[0]], self.full_support_size // 2), self.full_support_size)
         )
 
         return value, reward, policy_logits, encoded_state
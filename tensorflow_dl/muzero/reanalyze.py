@@ -0,0 +1,112 @@
+"""
+Background reanalysis of the replay buffer: worker threads repeat the search on stored observations with the latest
+weights and replace stale root values and policy targets. TF ops release the GIL, so the workers run alongside
+the learner and self-play without stalling them.
+"""
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_dl.muzero import mcts
+
+
+class WeightsStore:
+    """
+    Latest weights published by the learner, with version increased on every publish
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.weights = None
+        self.version = 0
+
+    def publish(self, weights):
+        with self.lock:
+            self.weights = weights
+            self.version += 1
+
+    def get(self):
+        with self.lock:
+            return self.weights, self.version
+
+
+class ReanalyzeWorker(threading.Thread):
+    def __init__(self, replay_buffer, weights_store, net_factory, batch_size, num_simulations, encoding_size,
+                 support_size, discount):
+        """
+        :param replay_buffer: replay.ReplayBuffer to refresh
+        :param weights_store: WeightsStore with the learner weights
+        :param net_factory: callable creating the network of the same architecture as the learner's
+        :param batch_size: amount of positions searched at once
+        """
+        super(ReanalyzeWorker, self).__init__(daemon=True)
+        self.replay_buffer = replay_buffer
+        self.weights_store = weights_store
+        self.batch_size = batch_size
+        self.stop_event = threading.Event()
+        self.positions_done = 0
+
+        self.net = net_factory()
+        # build the variables to be able to set weights
+        obs = tf.zeros((1,) + replay_buffer.observations.shape[1:], dtype=tf.float32)
+        _, _, _, encoded_state = self.net.compiled_init_inference(obs)
+        self.net.compiled_recurrent_inference(encoded_state, tf.zeros((1,), dtype=tf.int32))
+        self.search = mcts.BatchedMCTS(self.net, num_games=batch_size, num_simulations=num_simulations,
+                                       action_space_size=replay_buffer.action_space_size,
+                                       encoding_size=encoding_size, support_size=support_size, discount=discount)
+        self.version = 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            weights, version = self.weights_store.get()
+            if weights is None:
+                self.stop_event.wait(0.1)
+                continue
+            if version != self.version:
+                self.net.set_weights(weights)
+                self.version = version
+
+            positions, game_ids = self.replay_buffer.claim_stale_positions(self.batch_size, version)
+            if len(positions) == 0:
+                # everything is fresh, wait for the new weights
+                self.stop_event.wait(0.1)
+                continue
+            # search is done for the fixed amount of games, the batch is padded with the first position
+            positions_count = len(positions)
+            positions = np.pad(positions, (0, self.batch_size - positions_count), mode='edge')
+            game_ids = np.pad(game_ids, (0, self.batch_size - positions_count), mode='edge')
+            observations = self.replay_buffer.observations[positions]
+            visit_counts, root_values = self.search.run(observations, add_exploration_noise=False)
+            self.replay_buffer.update_targets(positions[:positions_count], game_ids[:positions_count],
+                                              visit_counts[:positions_count].astype(np.float32),
+                                              root_values[:positions_count])
+            self.positions_done += positions_count
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class ReanalyzePool:
+    def __init__(self, workers_count, replay_buffer, net_factory, **worker_kwargs):
+        self.weights_store = WeightsStore()
+        self.workers = [ReanalyzeWorker(replay_buffer, self.weights_store, net_factory, **worker_kwargs)
+                        for _ in range(workers_count)]
+
+    def __enter__(self):
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def __exit__(self, *args):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def publish(self, weights):
+        self.weights_store.publish(weights)
+
+    @property
+    def positions_done(self):
+        return sum(worker.positions_done for worker in self.workers)
@@ -0,0 +1,203 @@
+"""
+MuZero replay buffer. Positions of all the games are kept in columnar preallocated arrays (ring buffer),
+every game occupies a contiguous range of positions. Targets for the unroll of K steps are built with array indexing
+over (batch, K + 1) windows, so sampling has no python loops over the positions.
+"""
+import collections
+import threading
+
+import numpy as np
+
+Batch = collections.namedtuple('Batch', field_names=[
+    'indices', 'observations', 'actions', 'target_values', 'target_rewards', 'target_policies', 'mask', 'weights'
+])
+
+
+class GameHistory:
+    """
+    Data of a single game collected during self-play.
+    rewards[t] is the reward received after actions[t] was taken in observations[t]
+    """
+
+    def __init__(self):
+        self.observations = []
+        self.actions = []
+        self.rewards = []
+        self.root_values = []
+        self.child_visits = []
+
+    def __len__(self):
+        return len(self.actions)
+
+    def store(self, observation, action, reward, visit_counts, root_value):
+        self.observations.append(observation)
+        self.actions.append(action)
+        self.rewards.append(reward)
+        self.child_visits.append(visit_counts / max(np.sum(visit_counts), 1))
+        self.root_values.append(root_value)
+
+
+class ReplayBuffer:
+    def __init__(self, capacity, obs_shape, action_space_size, num_unroll_steps, td_steps, discount,
+                 alpha=1.0, beta=1.0):
+        """
+        :param capacity: amount of positions kept
+        :param obs_shape: shape of single observation
+        :param num_unroll_steps: K, amount of dynamics steps unrolled from every sampled position
+        :param td_steps: n of the n-step value target, bootstrapped from the root values
+        :param alpha: priority exponent, 0 for uniform sampling
+        :param beta: importance sampling exponent
+        """
+        self.capacity = capacity
+        self.action_space_size = action_space_size
+        self.num_unroll_steps = num_unroll_steps
+        self.td_steps = td_steps
+        self.discount = discount
+        self.alpha = alpha
+        self.beta = beta
+
+        self.observations = np.zeros((capacity,) + tuple(obs_shape), dtype=np.float32)
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.root_values = np.zeros(capacity, dtype=np.float32)
+        self.child_visits = np.zeros((capacity, action_space_size), dtype=np.float32)
+        # end (exclusive) of the game the position belongs to
+        self.game_end = np.zeros(capacity, dtype=np.int64)
+        # id of the game, used to detect positions overwritten during reanalysis
+        self.game_id = np.full(capacity, -1, dtype=np.int64)
+        # version of the weights root values and child visits were computed with
+        self.version = np.zeros(capacity, dtype=np.int64)
+        # zero priority positions are never sampled (unused or overwritten)
+        self.priorities = np.zeros(capacity, dtype=np.float32)
+
+        self.write_pos = 0
+        self.games_saved = 0
+        self.lock = threading.Lock()
+        self._discounts = discount ** np.arange(td_steps, dtype=np.float32)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.priorities))
+
+    def save_game(self, history, version=0):
+        """
+        Store the game, initial priorities are the errors of the root values against n-step targets
+        :param history: GameHistory
+        :param version: version of the weights used in self-play
+        :return: id of the game
+        """
+        length = len(history)
+        assert 0 < length <= self.capacity
+        with self.lock:
+            if self.write_pos + length > self.capacity:
+                # tail is dropped to keep games contiguous
+                self.priorities[self.write_pos:] = 0.0
+                self.game_id[self.write_pos:] = -1
+                self.write_pos = 0
+            start, end = self.write_pos, self.write_pos + length
+            game_id = self.games_saved
+            self.observations[start:end] = history.observations
+            self.actions[start:end] = history.actions
+            self.rewards[start:end] = history.rewards
+            self.root_values[start:end] = history.root_values
+            self.child_visits[start:end] = history.child_visits
+            self.game_end[start:end] = end
+            self.game_id[start:end] = game_id
+            self.version[start:end] = version
+            positions = np.arange(start, end)
+            errors = np.abs(self.root_values[positions] - self._value_targets(positions))
+            self.priorities[start:end] = np.maximum(errors, 1e-6)
+            self.write_pos = end % self.capacity
+            self.games_saved += 1
+        return game_id
+
+    def _value_targets(self, positions):
+        """
+        n-step value targets: discounted rewards plus discounted root value td_steps later, if it is in the game
+        :param positions: array of positions of any shape
+        """
+        steps = positions[..., np.newaxis] + np.arange(self.td_steps)
+        ends = self.game_end[np.minimum(positions, self.capacity - 1)][..., np.newaxis]
+        rewards = np.where(steps < ends, self.rewards[np.minimum(steps, self.capacity - 1)], 0.0)
+        values = np.sum(rewards * self._discounts, axis=-1)
+        bootstrap = positions + self.td_steps
+        has_bootstrap = bootstrap < ends[..., 0]
+        values += np.where(has_bootstrap, self.root_values[np.minimum(bootstrap, self.capacity - 1)], 0.0) * \
+            self.discount ** self.td_steps
+        return values
+
+    def sample(self, batch_size):
+        """
+        Sample stored positions proportional to priority ** alpha and build the unroll targets
+        :return: Batch with arrays
+        indices (B,), observations (B, obs), actions (B, K), target_values, target_rewards (B, K + 1),
+        target_policies (B, K + 1, actions), mask (B, K + 1) - False for unroll steps after the game end,
+        weights (B,) - importance sampling weights normalized by the max
+        """
+        with self.lock:
+            # unused and dropped slots have zero priority, 0 ** 0 would give them the weight of the stored ones
+            live = np.flatnonzero(self.priorities > 0)
+            if len(live) == 0:
+                raise ValueError("Can't sample from the empty replay buffer")
+            probs = self.priorities[live] ** self.alpha
+            probs /= probs.sum()
+            choice = np.random.choice(len(live), batch_size, p=probs)
+            indices = live[choice]
+            weights = (len(live) * probs[choice]) ** -self.beta
+            weights /= weights.max()
+
+            unroll = indices[:, np.newaxis] + np.arange(self.num_unroll_steps + 1)
+            mask = unroll < self.game_end[indices][:, np.newaxis]
+            clipped = np.where(mask, unroll, indices[:, np.newaxis])
+
+            # actions past the end of the game are random, as in the paper
+            random_actions = np.random.randint(self.action_space_size, size=(batch_size, self.num_unroll_steps))
+            actions = np.where(mask[:, :-1], self.actions[clipped[:, :-1]], random_actions)
+            target_values = np.where(mask, self._value_targets(clipped), 0.0).astype(np.float32)
+            # there is no reward before the initial position, reward of the last action is kept after the game end
+            target_rewards = np.zeros(mask.shape, dtype=np.float32)
+            target_rewards[:, 1:] = np.where(mask[:, :-1], self.rewards[clipped[:, :-1]], 0.0)
+            target_policies = np.where(mask[..., np.newaxis], self.child_visits[clipped], 0.0).astype(np.float32)
+
+            return Batch(indices=indices, observations=self.observations[indices], actions=actions,
+                         target_values=target_values, target_rewards=target_rewards, target_policies=target_policies,
+                         mask=mask, weights=weights.astype(np.float32))
+
+    def update_priorities(self, indices, priorities):
+        with self.lock:
+            live = self.priorities[indices] > 0
+            self.priorities[indices[live]] = np.maximum(priorities[live], 1e-6)
+
+    def claim_stale_positions(self, count, version):
+        """
+        Take up to count live positions with the oldest targets, older than version. Positions are marked with
+        the version right away, so concurrent workers don't take them again
+        :return: (positions, game_ids)
+        """
+        with self.lock:
+            versions = np.where(self.priorities > 0, self.version, np.iinfo(np.int64).max)
+            count = min(count, self.capacity)
+            positions = np.argpartition(versions, count - 1)[:count]
+            positions = positions[versions[positions] < version]
+            self.version[positions] = version
+            return positions, self.game_id[positions].copy()
+
+    def update_targets(self, positions, game_ids, child_visits, root_values):
+        """
+        Replace search statistics of positions with fresh ones, skipping positions overwritten since they were taken.
+        Priorities of the positions and of the positions bootstrapping from their root values are recomputed
+        the same way as in save_game
+        """
+        with self.lock:
+            keep = self.game_id[positions] == game_ids
+            positions = positions[keep]
+            visits = child_visits[keep]
+            self.child_visits[positions] = visits / np.maximum(visits.sum(axis=1, keepdims=True), 1)
+            self.root_values[positions] = root_values[keep]
+
+            # value target of the position td_steps earlier in the same game uses the new root value
+            earlier = positions - self.td_steps
+            same_game = (earlier >= 0) & (self.game_id[np.maximum(earlier, 0)] == self.game_id[positions])
+            changed = np.unique(np.concatenate([positions, earlier[same_game]]))
+            changed = changed[self.priorities[changed] > 0]
+            errors = np.abs(self.root_values[changed] - self._value_targets(changed))
+            self.priorities[changed] = np.maximum(errors, 1e-6)
@@ -0,0 +1,99 @@
+import time
+
+import gym
+import numpy as np
+
+from tensorflow_dl.muzero import mcts, models, reanalyze, replay
+
+GAMES = 16
+NUM_SIMULATIONS = 50
+ENCODING_SIZE = 8
+SUPPORT_SIZE = 10
+DISCOUNT = 0.997
+TEMPERATURE = 1.0
+REPORT_EVERY_STEP = 10
+
+REPLAY_SIZE = 100000
+NUM_UNROLL_STEPS = 5
+TD_STEPS = 10
+REANALYZE_WORKERS = 2
+REANALYZE_BATCH = 32
+
+
+def select_actions(visit_counts, temperature):
+    """
+    Sample actions from the root visit counts, greedy for zero temperature
+    :param visit_counts: (games, actions) array
+    :return: (games,) actions
+    """
+    if temperature == 0:
+        return np.argmax(visit_counts, axis=1)
+    probs = visit_counts ** (1.0 / temperature)
+    probs = probs / probs.sum(axis=1, keepdims=True)
+    return np.array([np.random.choice(len(p), p=p) for p in probs])
+
+
+if __name__ == '__main__':
+    envs = [gym.make("CartPole-v1") for _ in range(GAMES)]
+    obs_size = envs[0].observation_space.shape[0]
+    actions_n = envs[0].action_space.n
+
+    def make_net():
+        return models.MuZeroFullyConnectedNet(obs_shape=(1, 1, obs_size), stacked_observations=0,
+                                              action_space_shape=actions_n, encoding_shape=ENCODING_SIZE,
+                                              fc_reward_layers=[16], fc_value_layers=[16], fc_policy_layers=[16],
+                                              fc_representation_layers=[16], fc_dynamics_layers=[16],
+                                              supper_shape=SUPPORT_SIZE)
+
+    net = make_net()
+    search = mcts.BatchedMCTS(net, num_games=GAMES, num_simulations=NUM_SIMULATIONS, action_space_size=actions_n,
+                              encoding_size=ENCODING_SIZE, support_size=SUPPORT_SIZE, discount=DISCOUNT)
+
+    replay_buffer = replay.ReplayBuffer(REPLAY_SIZE, obs_shape=(1, 1, obs_size), action_space_size=actions_n,
+                                        num_unroll_steps=NUM_UNROLL_STEPS, td_steps=TD_STEPS, discount=DISCOUNT)
+    histories = [replay.GameHistory() for _ in envs]
+
+    obs = np.array([e.reset() for e in envs], dtype=np.float32)
+    episode_rewards = np.zeros(GAMES)
+    total_rewards = []
+    step_idx = 0
+    ts = time.time()
+    simulations = 0
+    reanalyzed = 0
+
+    with reanalyze.ReanalyzePool(REANALYZE_WORKERS, replay_buffer, make_net, batch_size=REANALYZE_BATCH,
+                                 num_simulations=NUM_SIMULATIONS, encoding_size=ENCODING_SIZE,
+                                 support_size=SUPPORT_SIZE, discount=DISCOUNT) as reanalyze_pool:
+        while True:
+            visit_counts, root_values = search.run(obs.reshape(GAMES, 1, 1, obs_size))
+            simulations += GAMES * NUM_SIMULATIONS
+            actions = select_actions(visit_counts, TEMPERATURE)
+
+            for idx, (e, action) in enumerate(zip(envs, actions)):
+                next_obs, reward, done, _ = e.step(int(action))
+                histories[idx].store(obs[idx].reshape(1, 1, obs_size), action, reward, visit_counts[idx],
+                                     root_values[idx])
+                episode_rewards[idx] += reward
+                if done:
+                    replay_buffer.save_game(histories[idx], version=reanalyze_pool.weights_store.version)
+                    histories[idx] = replay.GameHistory()
+                    total_rewards.append(episode_rewards[idx])
+                    episode_rewards[idx] = 0.0
+                    next_obs = e.reset()
+                obs[idx] = next_obs
+
+            step_idx += 1
+            if step_idx % REPORT_EVERY_STEP == 0:
+                dt = time.time() - ts
+                speed = simulations / dt
+                reanalyze_speed = (reanalyze_pool.positions_done - reanalyzed) / dt
+                mean_reward = np.mean(total_rewards[-100:]) if total_rewards else 0.0
+                print("%d: done %d episodes, mean reward %.2f, root value %.3f, %.2f simulations/s, "
+                      "replay %d, reanalyzed %.2f positions/s" % (
+                          step_idx, len(total_rewards), mean_reward, np.mean(root_values), speed,
+                          len(replay_buffer), reanalyze_speed))
+                # the learner publishes its weights the same way, positions searched with older ones are refreshed
+                reanalyze_pool.publish(net.get_weights())
+                ts = time.time()
+                simulations = 0
+                reanalyzed = reanalyze_pool.positions_done
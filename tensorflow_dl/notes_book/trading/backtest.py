@@ -0,0 +1,211 @@
+"""
+Backtest of the greedy feed-forward policy over whole instruments.
+The model sees only the price window and the position features: while there is no position the features are zero,
+after the position is opened at price P they are (1, close / P - 1) for every next bar. So the Q values of all
+the flat bars are computed in one batched pass, and after every Buy the bars of the position are evaluated
+in batches until the first Close. The number of model calls depends on the number of trades, not of bars.
+Rules are the ones of environment.State with reset_on_close=False: one episode over the whole instrument.
+"""
+import argparse
+import collections
+import multiprocessing as mp
+import os
+
+import numpy as np
+import tensorflow as tf
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+
+from tensorflow_dl.notes_book.trading import environment, data, models
+
+mpl.use("Agg")
+
+BATCH_SIZE = 4096
+
+Trade = collections.namedtuple('Trade', field_names=['open_offset', 'close_offset', 'open_price', 'close_price',
+                                                     'profit_perc'])
+Result = collections.namedtuple('Result', field_names=['name', 'equity', 'trades', 'stats'])
+
+
+def encode_batch(windows, offsets, have_position, rel_profit, bars_count, state_1d):
+    """
+    Observations for the offsets, the same as State.encode or State1D.encode
+    :param windows: environment.price_windows of the instrument
+    :param have_position: position flag, the same for all the offsets
+    :param rel_profit: (len(offsets),) relative profit of the position
+    """
+    starts = offsets - bars_count + 1
+    fields = len(windows)
+    if state_1d:
+        res = np.empty((len(offsets), fields + 2, bars_count), dtype=np.float32)
+        for field_idx, field_windows in enumerate(windows):
+            res[:, field_idx] = field_windows[starts]
+        res[:, fields] = float(have_position)
+        res[:, fields + 1] = rel_profit[:, np.newaxis]
+    else:
+        res = np.empty((len(offsets), fields * bars_count + 2), dtype=np.float32)
+        bars = res[:, :-2].reshape(len(offsets), bars_count, fields)
+        for field_idx, field_windows in enumerate(windows):
+            bars[:, :, field_idx] = field_windows[starts]
+        res[:, -2] = float(have_position)
+        res[:, -1] = rel_profit
+    return res
+
+
+def greedy_actions(infer, obs):
+    """
+    :param infer: models.compiled_inference of the net
+    """
+    actions = []
+    for ofs in range(0, len(obs), BATCH_SIZE):
+        _, actions_v = infer(tf.convert_to_tensor(obs[ofs:ofs + BATCH_SIZE]))
+        actions.append(actions_v.numpy())
+    return np.concatenate(actions) if actions else np.zeros(0, dtype=np.int32)
+
+
+def summary_stats(equity, trades):
+    drawdown = np.maximum.accumulate(np.concatenate([[0.0], equity]))[1:] - equity
+    profits = np.array([t.profit_perc for t in trades])
+    return {
+        'steps': len(equity),
+        'total_reward': float(equity[-1]) if len(equity) else 0.0,
+        'max_drawdown': float(drawdown.max()) if len(drawdown) else 0.0,
+        'trades': len(trades),
+        'win_rate': float(np.mean(profits > 0)) if len(profits) else 0.0,
+        'mean_trade_profit': float(np.mean(profits)) if len(profits) else 0.0,
+    }
+
+
+def backtest(net, prices, name="", bars_count=environment.DEFAULT_BARS_COUNT,
+             commission=environment.DEFAULT_COMMISSION_PERC, state_1d=False, reward_on_close=False, volumes=False,
+             infer=None):
+    """
+    Run the greedy policy of the net over the whole instrument
+    :param prices: data.PriceFeatures or relative prices, as used by TradingEnv
+    :param infer: models.compiled_inference of the net, pass it to avoid tracing on every instrument
+    :return: Result: equity - cumulative reward after every step, trades - list of Trade (the last one
+    has close_offset None if the position is still open at the end), stats - dict of summary values
+    """
+    if isinstance(prices, data.PriceFeatures):
+        real_close = prices['close']
+        prices = prices.relative()
+    else:
+        real_close = environment.real_close(prices)
+    assert isinstance(prices, data.Prices)
+    windows = environment.price_windows(prices, bars_count, volumes)
+    # decision is taken at every offset, as in TradingEnv reset without random offset
+    offsets = np.arange(bars_count, len(real_close) - 1)
+    steps = len(offsets)
+    rewards = np.zeros(steps, dtype=np.float64)
+    trades = []
+
+    flat_obs = encode_batch(windows, offsets, False, np.zeros(steps, dtype=np.float32), bars_count, state_1d)
+    if infer is None:
+        infer = models.compiled_inference(net, flat_obs.shape[1:])
+    flat_actions = greedy_actions(infer, flat_obs)
+
+    step = 0
+    while step < steps:
+        buys = np.flatnonzero(flat_actions[step:] == environment.Actions.Buy.value)
+        if len(buys) == 0:
+            break
+        step += buys[0]
+        open_step = step
+        open_price = real_close[offsets[open_step]]
+        rewards[open_step] -= commission
+
+        # bars of the position are evaluated in batches until the first Close
+        close_step = None
+        ofs = open_step + 1
+        while ofs < steps and close_step is None:
+            chunk = offsets[ofs:ofs + BATCH_SIZE]
+            rel_profit = (real_close[chunk] - open_price) / open_price
+            actions = greedy_actions(infer, encode_batch(windows, chunk, True, rel_profit, bars_count, state_1d))
+            closes = np.flatnonzero(actions == environment.Actions.Close.value)
+            if len(closes) > 0:
+                close_step = ofs + closes[0]
+            ofs += len(chunk)
+
+        end_step = steps if close_step is None else close_step
+        if not reward_on_close:
+            held = offsets[open_step:end_step]
+            rewards[open_step:end_step] += 100.0 * (real_close[held + 1] - real_close[held]) / real_close[held]
+        if close_step is None:
+            trades.append(Trade(open_offset=int(offsets[open_step]), close_offset=None, open_price=float(open_price),
+                                close_price=float(real_close[-1]),
+                                profit_perc=float(100.0 * (real_close[-1] - open_price) / open_price)))
+            break
+        close_price = real_close[offsets[close_step]]
+        rewards[close_step] -= commission
+        if reward_on_close:
+            rewards[close_step] += 100.0 * (close_price - open_price) / open_price
+        trades.append(Trade(open_offset=int(offsets[open_step]), close_offset=int(offsets[close_step]),
+                            open_price=float(open_price), close_price=float(close_price),
+                            profit_perc=float(100.0 * (close_price - open_price) / open_price)))
+        step = close_step + 1
+
+    equity = np.cumsum(rewards)
+    return Result(name=name, equity=equity, trades=trades, stats=summary_stats(equity, trades))
+
+
+_worker_net = None
+_worker_infer = None
+
+
+def _init_worker(net_class, weights, obs_shape):
+    global _worker_net, _worker_infer
+    _worker_net = net_class()
+    _worker_net(tf.zeros((1,) + tuple(obs_shape)))
+    _worker_net.set_weights(weights)
+    _worker_infer = models.compiled_inference(_worker_net, obs_shape)
+
+
+def _backtest_file(args):
+    file_name, kwargs = args
+    return backtest(_worker_net, data.load_features(file_name), name=file_name, infer=_worker_infer, **kwargs)
+
+
+def backtest_files(net, files, workers=None, **kwargs):
+    """
+    Backtest the net over many instruments in worker processes, every worker builds the copy of the net
+    :param net: net of class constructed without arguments (SimpleFFDQN, DQNConv1D)
+    :param kwargs: arguments of backtest
+    :return: list of Result in the order of files
+    """
+    state_cls = environment.State1D if kwargs.get('state_1d') else environment.State
+    obs_shape = state_cls(kwargs.get('bars_count', environment.DEFAULT_BARS_COUNT), 0.0, False,
+                          volumes=kwargs.get('volumes', False)).shape
+    # tensorflow is not fork safe, workers are started in the fresh interpreters
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(type(net), net.get_weights(), obs_shape)) as pool:
+        return pool.map(_backtest_file, [(file_name, kwargs) for file_name in files])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--data", required=True, help="CSV file or directory with quotes to run the model")
+    parser.add_argument("-m", "--model", help="Saved model to take the weights from")
+    parser.add_argument("-b", "--bars", type=int, default=50, help="Count of bars to feed into the model")
+    parser.add_argument("-n", "--name", default="out", help="Name to use in output images")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Worker processes, all cores by default")
+    parser.add_argument("--commission", type=float, default=0.1, help="Commission size in percent, default=0.1")
+    parser.add_argument("--conv", default=False, action="store_true", help="Use convolution model instead of FF")
+    args = parser.parse_args()
+
+    files = data.price_files(args.data) if os.path.isdir(args.data) else [args.data]
+    net = models.DQNConv1D() if args.conv else models.SimpleFFDQN()
+    state_cls = environment.State1D if args.conv else environment.State
+    net(tf.zeros((1,) + state_cls(args.bars, args.commission, False, volumes=False).shape))
+    if args.model:
+        net.set_weights(tf.keras.models.load_model(args.model).get_weights())
+
+    results = backtest_files(net, files, workers=args.workers, bars_count=args.bars, commission=args.commission,
+                             state_1d=args.conv, volumes=False)
+    plt.clf()
+    for res in results:
+        print("%s: %s" % (res.name, ", ".join("%s=%.3f" % (k, v) for k, v in res.stats.items())))
+        plt.plot(res.equity, label=os.path.basename(res.name))
+    plt.title("Total reward, data=%s" % args.name)
+    plt.ylabel("Reward, %")
+    plt.legend()
+    plt.savefig("rewards-%s.png" % args.name)
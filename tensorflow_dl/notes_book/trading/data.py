@@ -1,11 +1,20 @@
 import os
 import csv
 import glob
+import json
+import hashlib
+import warnings
 import numpy as np
 import collections
+import collections.abc
+import multiprocessing as mp
 
 Prices = collections.namedtuple('Prices', field_names=['open', 'high', 'low', 'close', 'volume'])
 
+# cache directory created next to the CSV files
+CACHE_DIR = '.prices_cache'
+MANIFEST_NAME = 'manifest.json'
+
 
 def read_csv(file_name, sep=',', filter_data=True, fix_open_price=False):
     print("Reading", file_name)
@@ -13,7 +22,7 @@ def read_csv(file_name, sep=',', filter_data=True, fix_open_price=False):
         reader = csv.reader(fd, delimiter=sep)
         h = next(reader)
         if '<OPEN>' not in h and sep == ',':
-            return read_csv(file_name, ';')
+            return read_csv(file_name, ';', filter_data=filter_data, fix_open_price=fix_open_price)
         indices = [h.index(s) for s in ('<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOL>')]
         o, h, l, c, v = [], [], [], [], []
         count_out = 0
@@ -52,6 +61,142 @@ def read_csv(file_name, sep=',', filter_data=True, fix_open_price=False):
                   volume=np.array(v, dtype=np.float32))
 
 
+def read_csv_bulk(file_name, sep=',', filter_data=True, fix_open_price=False):
+    """
+    Same as read_csv, but the whole file is parsed at once and filtering and open price fixing are done
+    with array operations. Result and counters are identical to read_csv
+    """
+    print("Reading", file_name)
+    with open(file_name, 'rt', encoding='utf-8') as fd:
+        h = next(csv.reader(fd, delimiter=sep))
+        if '<OPEN>' not in h and sep == ',':
+            return read_csv_bulk(file_name, ';', filter_data=filter_data, fix_open_price=fix_open_price)
+        indices = [h.index(s) for s in ('<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOL>')]
+        # values are compared in float64 like python floats of read_csv, converted to float32 at the end
+        with warnings.catch_warnings():
+            # file with the header only is valid, it gives empty prices
+            warnings.filterwarnings('ignore', message='.*input contained no data', category=UserWarning)
+            vals = np.loadtxt(fd, delimiter=sep, usecols=indices, dtype=np.float64, ndmin=2).reshape(-1, 5)
+    count_total = len(vals)
+    if filter_data:
+        keep = ~np.all(np.abs(vals[:, :4] - vals[:, :1]) < 1e-8, axis=1)
+        vals = vals[keep]
+    po, ph, pl, pc, pv = vals.T.copy()
+    count_fixed = 0
+    if fix_open_price and len(vals) > 1:
+        # open price of the bar is set to the close of the previous bar left after the filtering
+        prev_close = vals[:-1, 3]
+        fixed = np.flatnonzero(np.abs(po[1:] - prev_close) > 1e-8) + 1
+        count_fixed = len(fixed)
+        po[fixed] = prev_close[fixed - 1]
+        pl[fixed] = np.minimum(pl[fixed], po[fixed])
+        ph[fixed] = np.maximum(ph[fixed], po[fixed])
+    print("Read done, got %d rows, %d filtered, %d open prices adjusted" % (
+        count_total, count_total - len(vals), count_fixed))
+    return Prices(open=po.astype(np.float32),
+                  high=ph.astype(np.float32),
+                  low=pl.astype(np.float32),
+                  close=pc.astype(np.float32),
+                  volume=pv.astype(np.float32))
+
+
+def file_hash(file_name):
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PriceCache:
+    """
+    Columnar binary cache of the parsed price files. Every entry is .npy of shape (fields, rows) float32, for example
+    open, high, low, close, volume of Prices. Entries are memory-mapped, so the returned fields are zero-copy views.
+    Manifest records size, mtime and hash of the source file, entry is rebuilt only when the source content changes
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+
+    def _read_manifest(self):
+        # unreadable manifest only makes the entries rebuilt
+        try:
+            with open(self.manifest_path, 'rt', encoding='utf-8') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def _update_manifest(self, key, entry):
+        # manifest is re-read before the update and replaced atomically, so readers never see a partial file.
+        # Entry lost by concurrent writers is only rebuilt on the next load
+        manifest = self._read_manifest()
+        manifest[key] = entry
+        tmp_path = "%s.%d.tmp" % (self.manifest_path, os.getpid())
+        with open(tmp_path, 'wt', encoding='utf-8') as fd:
+            json.dump(manifest, fd, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _open(path, rows, wrap):
+        # empty array can't be memory-mapped
+        return wrap(np.load(path, mmap_mode='r' if rows > 0 else None))
+
+    def load(self, file_name, variant, builder, wrap=Prices._make):
+        """
+        Get prices of the file from the cache, building and storing them if needed. If the cache can't be written
+        (read-only directory), built prices are returned uncached
+        :param file_name: source file
+        :param variant: name of the conversion done by builder, entries of different variants are independent
+        :param builder: function file_name -> Prices or other sequence of the field arrays
+        :param wrap: function (fields, rows) array -> result
+        """
+        file_name = os.path.abspath(file_name)
+        key = "%s:%s" % (variant, file_name)
+        stat = os.stat(file_name)
+        entry = self._read_manifest().get(key)
+        digest = None
+        if entry is not None and os.path.exists(os.path.join(self.cache_dir, entry['file'])):
+            path = os.path.join(self.cache_dir, entry['file'])
+            if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                return self._open(path, entry['rows'], wrap)
+            # file was touched, but the content may be the same
+            digest = file_hash(file_name)
+            if digest == entry['sha1']:
+                entry['mtime'] = stat.st_mtime
+                try:
+                    self._update_manifest(key, entry)
+                except OSError:
+                    pass
+                return self._open(path, entry['rows'], wrap)
+
+        if digest is None:
+            digest = file_hash(file_name)
+        arr = np.stack([np.asarray(field, dtype=np.float32) for field in builder(file_name)])
+        name_hash = hashlib.sha1(file_name.encode('utf-8')).hexdigest()[:8]
+        entry_file = "%s-%s-%s.npy" % (os.path.splitext(os.path.basename(file_name))[0], name_hash, variant)
+        path = os.path.join(self.cache_dir, entry_file)
+        rows = arr.shape[1]
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, 'wb') as fd:
+                np.save(fd, arr)
+            os.replace(tmp_path, path)
+            self._update_manifest(key, {'file': entry_file, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                        'sha1': digest, 'rows': rows})
+        except OSError as e:
+            print("Can't write the price cache %s, %s is not cached: %s" % (self.cache_dir, file_name, e))
+            return wrap(arr)
+        return self._open(path, rows, wrap)
+
+
+def _cache_for(file_name, cache_dir):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_name)), CACHE_DIR)
+    return PriceCache(cache_dir)
+
+
 def prices_to_relative(prices):
     """
     Convert prices to relative in respect to open price
@@ -64,8 +209,200 @@ def prices_to_relative(prices):
     return Prices(open=prices.open, high=rh, low=rl, close=rc, volume=prices.volume)
 
 
-def load_relative(csv_file):
-    return prices_to_relative(read_csv(csv_file))
+class PriceFeatures:
+    """
+    Features of one instrument kept in one growable (fields, bars) float32 block: prices relative to the open price
+    (see prices_to_relative), absolute prices and optional indicators:
+    ret_N - return of the close price over N bars, vol_N - std of the one bar returns over the last N bars.
+    The first rows are laid out as the relative Prices, so relative() is a zero-copy view.
+    Indicators are 0 until the instrument has enough history. New bars are appended without touching the history,
+    rolling sums of the returns make every indicator O(1) per bar.
+    Block can be memory-mapped from the PriceCache or shared (see SharedPrices), it is copied on the first append.
+    Arrays returned by the accessors are views, they are valid until the next append grows the capacity
+    """
+    BASE_FIELDS = ('open', 'rel_high', 'rel_low', 'rel_close', 'volume', 'high', 'low', 'close')
+
+    def __init__(self, return_windows=(), volatility_windows=(), capacity=1024, block=None):
+        """
+        :param block: (len(fields), bars) array to use as the features of the bars without copying
+        """
+        self.return_windows = tuple(return_windows)
+        self.volatility_windows = tuple(volatility_windows)
+        self.fields = self.field_names(self.return_windows, self.volatility_windows)
+        self._rows = {name: idx for idx, name in enumerate(self.fields)}
+        self._relative = None
+        # cumulative sums of the one bar returns and their squares, _cum[t + 1] covers bars 0..t.
+        # For the given block they are computed on the first append
+        if block is None:
+            self.size = 0
+            self.capacity = max(capacity, 1)
+            self._block = np.zeros((len(self.fields), self.capacity), dtype=np.float32)
+            self._cum_r = np.zeros(self.capacity + 1, dtype=np.float64)
+            self._cum_r2 = np.zeros(self.capacity + 1, dtype=np.float64)
+        else:
+            assert block.shape[0] == len(self.fields)
+            self.size = self.capacity = block.shape[1]
+            self._block = block
+            self._cum_r = self._cum_r2 = None
+
+    @classmethod
+    def field_names(cls, return_windows=(), volatility_windows=()):
+        return cls.BASE_FIELDS + tuple("ret_%d" % n for n in return_windows) + \
+            tuple("vol_%d" % n for n in volatility_windows)
+
+    @classmethod
+    def from_prices(cls, prices, **kwargs):
+        """
+        :param prices: Prices with absolute values, as returned by read_csv
+        """
+        assert isinstance(prices, Prices)
+        res = cls(capacity=len(prices.close), **kwargs)
+        res.extend(prices)
+        return res
+
+    @classmethod
+    def from_relative(cls, prices, **kwargs):
+        """
+        :param prices: relative Prices, as returned by prices_to_relative. They are kept as is,
+        absolute prices are restored from them
+        """
+        assert isinstance(prices, Prices)
+        res = cls(capacity=len(prices.close), **kwargs)
+        res.size = len(prices.close)
+        res._block[:len(Prices._fields), :res.size] = np.stack(prices)
+        o = res['open']
+        # the same float32 math as environment.real_close
+        for name in ('high', 'low', 'close'):
+            res._block[res._rows[name], :res.size] = o * (np.float32(1.0) + res['rel_' + name])
+        res._update_indicators(0, res.size)
+        return res
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self._block[self._rows[name], :self.size]
+
+    @property
+    def block(self):
+        """
+        :return: (len(fields), len(self)) view of the features
+        """
+        return self._block[:, :self.size]
+
+    @property
+    def nbytes(self):
+        return self.block.nbytes
+
+    def _reserve(self, size):
+        if self._cum_r is None:
+            returns = self._returns(np.arange(self.size))
+            self._cum_r = np.concatenate([[0.0], np.cumsum(returns)])
+            self._cum_r2 = np.concatenate([[0.0], np.cumsum(returns * returns)])
+        if size <= self.capacity:
+            return
+        # given block is never written, it is full and copied here
+        capacity = max(size, 2 * self.capacity)
+        block = np.zeros((len(self.fields), capacity), dtype=np.float32)
+        block[:, :self.size] = self._block[:, :self.size]
+        self._block = block
+        for name in ('_cum_r', '_cum_r2'):
+            arr = np.zeros(capacity + 1, dtype=np.float64)
+            arr[:self.size + 1] = getattr(self, name)[:self.size + 1]
+            setattr(self, name, arr)
+        self.capacity = capacity
+
+    def _returns(self, idx):
+        # return of the first bar is 0, there is no previous close
+        close = self._block[self._rows['close']]
+        return np.where(idx > 0, close[idx].astype(np.float64) / close[np.maximum(idx - 1, 0)] - 1.0, 0.0)
+
+    def append(self, open, high, low, close, volume):
+        """
+        Append single bar
+        """
+        self.extend(Prices(open=np.array([open], dtype=np.float32), high=np.array([high], dtype=np.float32),
+                           low=np.array([low], dtype=np.float32), close=np.array([close], dtype=np.float32),
+                           volume=np.array([volume], dtype=np.float32)))
+
+    def extend(self, prices):
+        """
+        Append bars, only the features of the new bars are computed
+        :param prices: Prices with absolute values
+        """
+        count = len(prices.close)
+        start, end = self.size, self.size + count
+        self._reserve(end)
+        block, rows = self._block, self._rows
+        for name in Prices._fields:
+            block[rows[name], start:end] = getattr(prices, name)
+        o = block[rows['open'], start:end]
+        # the same float32 math as prices_to_relative
+        for name in ('high', 'low', 'close'):
+            block[rows['rel_' + name], start:end] = (block[rows[name], start:end] - o) / o
+        self.size = end
+        self._relative = None
+        self._update_indicators(start, end)
+
+    def _update_indicators(self, start, end):
+        # only the closes of the new bars and the bars behind the windows are read
+        block = self._block
+        close = block[self._rows['close']]
+        idx = np.arange(start, end)
+        cur = close[idx].astype(np.float64)
+        returns = self._returns(idx)
+        self._cum_r[start + 1:end + 1] = self._cum_r[start] + np.cumsum(returns)
+        self._cum_r2[start + 1:end + 1] = self._cum_r2[start] + np.cumsum(returns * returns)
+
+        for n in self.return_windows:
+            base = idx - n
+            block[self._rows["ret_%d" % n], start:end] = np.where(
+                base >= 0, cur / close[np.maximum(base, 0)] - 1.0, 0.0)
+        for n in self.volatility_windows:
+            # window of n returns ending at the bar, the first defined return is of bar 1
+            lo = idx + 1 - n
+            valid = lo >= 1
+            lo = np.maximum(lo, 0)
+            mean = (self._cum_r[idx + 1] - self._cum_r[lo]) / n
+            mean2 = (self._cum_r2[idx + 1] - self._cum_r2[lo]) / n
+            block[self._rows["vol_%d" % n], start:end] = np.where(
+                valid, np.sqrt(np.maximum(mean2 - mean * mean, 0.0)), 0.0)
+
+    def relative(self):
+        """
+        :return: Prices relative to the open price, the same as prices_to_relative. The same object is returned
+        until the next append
+        """
+        if self._relative is None:
+            self._relative = Prices(*self._block[:len(Prices._fields), :self.size])
+        return self._relative
+
+
+def load_relative(csv_file, use_cache=False, cache_dir=None):
+    """
+    Read the file and convert prices to relative, see prices_to_relative
+    :param use_cache: take converted prices from the PriceCache, CSV is parsed only if it was changed
+    :param cache_dir: directory of the cache, CACHE_DIR next to the file by default
+    """
+    if not use_cache:
+        return prices_to_relative(read_csv_bulk(csv_file))
+    return _cache_for(csv_file, cache_dir).load(csv_file, 'relative',
+                                                lambda f: prices_to_relative(read_csv_bulk(f)))
+
+
+def load_features(csv_file, return_windows=(), volatility_windows=(), use_cache=False, cache_dir=None):
+    """
+    Read the file into PriceFeatures, see PriceFeatures for the windows
+    :param use_cache: take the features memory-mapped from the PriceCache, CSV is parsed only if it was changed
+    :param cache_dir: directory of the cache, CACHE_DIR next to the file by default
+    """
+    windows = dict(return_windows=return_windows, volatility_windows=volatility_windows)
+    if not use_cache:
+        return PriceFeatures.from_prices(read_csv_bulk(csv_file), **windows)
+    variant = "features-r%s-v%s" % ("_".join(map(str, return_windows)), "_".join(map(str, volatility_windows)))
+    return _cache_for(csv_file, cache_dir).load(csv_file, variant,
+                                                lambda f: PriceFeatures.from_prices(read_csv_bulk(f), **windows).block,
+                                                lambda block: PriceFeatures(block=block, **windows))
 
 
 def price_files(dir_name):
@@ -75,9 +412,150 @@ def price_files(dir_name):
     return result
 
 
-def load_year_data(year, basedir='data'):
+def prices_nbytes(prices):
+    """
+    :param prices: Prices or PriceFeatures
+    """
+    if isinstance(prices, PriceFeatures):
+        return prices.nbytes
+    return sum(field.nbytes for field in prices)
+
+
+class PriceStore(collections.abc.Mapping):
+    """
+    Dict-like store of instrument prices, keyed by the file name. Files are only indexed on creation, prices are
+    loaded as PriceFeatures on the first access. Least recently used instruments are
+    dropped from the store when the loaded prices exceed the memory budget, with all their features
+    """
+
+    def __init__(self, files, memory_budget=None, loader=load_features):
+        """
+        :param files: list of price files
+        :param memory_budget: max bytes of the loaded prices, unlimited if None
+        :param loader: function file_name -> PriceFeatures or Prices
+        """
+        self.files = list(files)
+        self._index = set(self.files)
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self._loaded = collections.OrderedDict()
+        self.loaded_bytes = 0
+
+    @classmethod
+    def from_dir(cls, dir_name, **kwargs):
+        return cls(price_files(dir_name), **kwargs)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        if key not in self._index:
+            raise KeyError(key)
+        prices = self._loaded.get(key)
+        if prices is not None:
+            self._loaded.move_to_end(key)
+            return prices
+        prices = self.loader(key)
+        self._loaded[key] = prices
+        self.loaded_bytes += prices_nbytes(prices)
+        if self.memory_budget is not None:
+            # the instrument just loaded is kept even if it doesn't fit alone
+            while self.loaded_bytes > self.memory_budget and len(self._loaded) > 1:
+                _, evicted = self._loaded.popitem(last=False)
+                self.loaded_bytes -= prices_nbytes(evicted)
+        return prices
+
+
+class SharedPrices(collections.abc.Mapping):
+    """
+    Read-only dict-like prices of many instruments published once into the shared memory. Pass it to the worker
+    processes as an argument of Process or Pool initializer: the memory is not copied, environments of all the workers
+    use zero-copy views, so N workers hold one copy of the prices.
+    Values are PriceFeatures, relative Prices are published as PriceFeatures.from_relative.
+    Features of all instruments are concatenated in one (fields, total rows) float32 block with the rows of
+    PriceFeatures.fields, instrument i occupies the columns starts[i]..starts[i] + lengths[i] - 1
+    """
+
+    def __init__(self, prices, names=None, lengths=None, raw=None, return_windows=(), volatility_windows=()):
+        """
+        :param prices: dict or PriceStore name -> PriceFeatures or Prices to publish, None if raw is given
+        :param return_windows: windows of the features in raw, taken from the prices otherwise
+        :param volatility_windows: windows of the features in raw, taken from the prices otherwise
+        """
+        if raw is None:
+            names = list(prices.keys())
+            lengths = []
+            # instruments of PriceStore are loaded one by one
+            for name in names:
+                value = prices[name]
+                if isinstance(value, PriceFeatures):
+                    lengths.append(len(value))
+                    return_windows, volatility_windows = value.return_windows, value.volatility_windows
+                else:
+                    lengths.append(len(value.close))
+        self.return_windows = tuple(return_windows)
+        self.volatility_windows = tuple(volatility_windows)
+        self.fields = PriceFeatures.field_names(self.return_windows, self.volatility_windows)
+        size = len(self.fields) * int(sum(lengths))
+        if raw is None:
+            raw = mp.RawArray('f', max(size, 1))
+            block = np.frombuffer(raw, dtype=np.float32)[:size].reshape(len(self.fields), -1)
+            start = 0
+            for name, length in zip(names, lengths):
+                value = prices[name]
+                if not isinstance(value, PriceFeatures):
+                    value = PriceFeatures.from_relative(value, return_windows=self.return_windows,
+                                                        volatility_windows=self.volatility_windows)
+                assert value.fields == self.fields
+                block[:, start:start + length] = value.block
+                start += length
+        self.names = list(names)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.lengths)[:-1]]).astype(np.int64)
+        self.raw = raw
+        self.block = np.frombuffer(raw, dtype=np.float32)[:size].reshape(len(self.fields), -1)
+        self.block.flags.writeable = False
+        self._prices = {name: PriceFeatures(self.return_windows, self.volatility_windows,
+                                            block=self.block[:, start:start + length])
+                        for name, start, length in zip(self.names, self.starts, self.lengths)}
+
+    def __reduce__(self):
+        return SharedPrices, (None, self.names, self.lengths.tolist(), self.raw, self.return_windows,
+                              self.volatility_windows)
+
+    @property
+    def nbytes(self):
+        return self.block.nbytes
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, key):
+        return key in self._prices
+
+    def __getitem__(self, key):
+        return self._prices[key]
+
+
+def load_year_data(year, basedir='data', lazy=False, memory_budget=None):
+    """
+    :param lazy: return PriceStore, prices are loaded on the first access
+    :return: dict-like file name -> PriceFeatures
+    """
     y = str(year)[-2:]
+    paths = glob.glob(os.path.join(basedir, "*_%s*.csv" % y))
+    if lazy:
+        return PriceStore(paths, memory_budget=memory_budget)
     result = {}
-    for path in glob.glob(os.path.join(basedir, "*_%s*.csv" % y)):
-        result[path] = load_relative(path)
+    for path in paths:
+        result[path] = load_features(path)
     return result
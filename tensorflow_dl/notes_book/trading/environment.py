@@ -14,6 +14,25 @@ class Actions(enum.Enum):
     Close = 2
 
 
+def price_windows(prices, bars_count, volumes):
+    """
+    Zero-copy sliding windows over the price fields used in observations
+    :return: list of (len - bars_count + 1, bars_count) views for high, low, close (and volume),
+    row i holds bars i..i + bars_count - 1
+    """
+    fields = [prices.high, prices.low, prices.close]
+    if volumes:
+        fields.append(prices.volume)
+    return [np.lib.stride_tricks.sliding_window_view(field, bars_count) for field in fields]
+
+
+def real_close(prices):
+    """
+    Absolute close prices from relative prices
+    """
+    return prices.open * (np.float32(1.0) + prices.close)
+
+
 class State:
     def __init__(self, bars_count, commission_perc, reset_on_close, reward_on_close=True, volumes=True):
         assert isinstance(bars_count, int)
@@ -27,14 +46,25 @@ class State:
         self.reset_on_close = reset_on_close
         self.reward_on_close = reward_on_close
         self.volumes = volumes
+        self._windows_prices = None
 
-    def reset(self, prices, offset):
+    def reset(self, prices, offset, close=None):
+        """
+        :param close: absolute close prices, for example of data.PriceFeatures.
+        real_close of the prices is computed when the prices change if None
+        """
         assert isinstance(prices, data.Prices)
         assert offset >= self.bars_count - 1
         self.have_position = False
         self.open_price = 0.0
         self._prices = prices
         self._offset = offset
+        if prices is not self._windows_prices:
+            self._windows_prices = prices
+            self._windows = price_windows(prices, self.bars_count, self.volumes)
+            self._real_close = real_close(prices) if close is None else close
+        elif close is not None:
+            self._real_close = close
 
     @property
     def shape(self):
@@ -44,37 +74,30 @@ class State:
         else:
             return (3 * self.bars_count + 1 + 1,)
 
-    def encode(self):
+    def encode(self, out=None):
         """
         Convert current state into numpy array.
+        :param out: optional buffer of self.shape to write into, new array is returned if None.
+        Observations returned by the env are stored by the experience sources, so the env doesn't pass the buffer
         """
-        res = np.ndarray(shape=self.shape, dtype=np.float32)
-        shift = 0
-        for bar_idx in range(-self.bars_count + 1, 1):
-            res[shift] = self._prices.high[self._offset + bar_idx]
-            shift += 1
-            res[shift] = self._prices.low[self._offset + bar_idx]
-            shift += 1
-            res[shift] = self._prices.close[self._offset + bar_idx]
-            shift += 1
-            if self.volumes:
-                res[shift] = self._prices.volume[self._offset + bar_idx]
-                shift += 1
-        res[shift] = float(self.have_position)
-        shift += 1
+        res = np.empty(shape=self.shape, dtype=np.float32) if out is None else out
+        # [h, l, c(, v)] of every bar are interleaved, every field is written with one strided copy
+        bars = res[:-2].reshape(self.bars_count, -1)
+        start = self._offset - self.bars_count + 1
+        for field_idx, windows in enumerate(self._windows):
+            bars[:, field_idx] = windows[start]
+        res[-2] = float(self.have_position)
         if not self.have_position:
-            res[shift] = 0.0
+            res[-1] = 0.0
         else:
-            res[shift] = (self._cur_close() - self.open_price) / self.open_price
+            res[-1] = (self._cur_close() - self.open_price) / self.open_price
         return res
 
     def _cur_close(self):
         """
         Calculate real close price for the current bar
         """
-        open = self._prices.open[self._offset]
-        rel_close = self._prices.close[self._offset]
-        return open * (1.0 + rel_close)
+        return self._real_close[self._offset]
 
     def step(self, action):
         """
@@ -121,20 +144,17 @@ class State1D(State):
         else:
             return 5, self.bars_count
 
-    def encode(self):
-        res = np.zeros(shape=self.shape, dtype=np.float32)
-        ofs = self.bars_count-1
-        res[0] = self._prices.high[self._offset-ofs:self._offset+1]
-        res[1] = self._prices.low[self._offset-ofs:self._offset+1]
-        res[2] = self._prices.close[self._offset-ofs:self._offset+1]
-        if self.volumes:
-            res[3] = self._prices.volume[self._offset-ofs:self._offset+1]
-            dst = 4
-        else:
-            dst = 3
+    def encode(self, out=None):
+        res = np.empty(shape=self.shape, dtype=np.float32) if out is None else out
+        start = self._offset - self.bars_count + 1
+        for field_idx, windows in enumerate(self._windows):
+            res[field_idx] = windows[start]
+        dst = len(self._windows)
         if self.have_position:
             res[dst] = 1.0
             res[dst+1] = (self._cur_close() - self.open_price) / self.open_price
+        else:
+            res[dst:] = 0.0
         return res
 
 
@@ -144,7 +164,7 @@ class TradingEnv(gym.Env):
     def __init__(self, prices, bars_count=DEFAULT_BARS_COUNT,
                  commission=DEFAULT_COMMISSION_PERC, reset_on_close=True, state_1d=False,
                  random_ofs_on_reset=True, reward_on_close=False, volumes=False):
-        assert isinstance(prices, dict)
+        assert isinstance(prices, (dict, data.PriceStore, data.SharedPrices))
         self._prices = prices
         if state_1d:
             self._state = State1D(bars_count, commission, reset_on_close, reward_on_close=reward_on_close,
@@ -161,12 +181,17 @@ class TradingEnv(gym.Env):
         # make selection of the instrument and it's offset. Then reset the state
         self._instrument = self.np_random.choice(list(self._prices.keys()))
         prices = self._prices[self._instrument]
+        close = None
+        # absolute close is stored with the features, it is not recomputed
+        if isinstance(prices, data.PriceFeatures):
+            close = prices['close']
+            prices = prices.relative()
         bars = self._state.bars_count
         if self.random_ofs_on_reset:
             offset = self.np_random.choice(prices.high.shape[0] - bars * 10) + bars
         else:
             offset = bars
-        self._state.reset(prices, offset)
+        self._state.reset(prices, offset, close=close)
         return self._state.encode()
 
     def step(self, action_idx):
@@ -184,10 +209,161 @@ class TradingEnv(gym.Env):
     
     def seed(self, seed=None):
         self.np_random, seed1 = seeding.np_random(seed)
-        seed2 = seeding.hash_seed(seed1 + 1) % 2 ** 31
-        return [seed1, seed2]
+        return [seed1]
 
     @classmethod
-    def from_dir(cls, data_dir, **kwargs):
-        prices = {file: data.load_relative(file) for file in data.price_files(data_dir)}
+    def from_dir(cls, data_dir, memory_budget=None, **kwargs):
+        """
+        Env over all the CSV files of the directory, prices are loaded lazily by data.PriceStore
+        :param memory_budget: max bytes of the prices kept loaded, unlimited if None
+        """
+        prices = data.PriceStore.from_dir(data_dir, memory_budget=memory_budget)
         return TradingEnv(prices, **kwargs)
+
+
+class BatchTradingEnv:
+    """
+    N independent trading episodes stepped in lockstep. Every episode follows the same rules as TradingEnv with
+    the same arguments: positions, open prices and offsets of all episodes are arrays, prices of all instruments
+    are concatenated as data.PriceFeatures, so observations of all episodes are gathered from one precomputed windows
+    view and the close prices are read from the features. data.SharedPrices are already concatenated and used
+    without copying, so envs of many worker processes share one copy of the prices.
+    Finished episodes are reset automatically, their observations returned by step are the new initial ones
+    """
+
+    def __init__(self, prices, n_envs, bars_count=DEFAULT_BARS_COUNT,
+                 commission=DEFAULT_COMMISSION_PERC, reset_on_close=True, state_1d=False,
+                 random_ofs_on_reset=True, reward_on_close=False, volumes=False, seeds=None):
+        """
+        :param seeds: list of n_envs seeds, episode i makes the same random choices as TradingEnv seeded with seeds[i]
+        """
+        assert isinstance(prices, (dict, data.PriceStore, data.SharedPrices))
+        assert isinstance(bars_count, int)
+        assert bars_count > 0
+        assert isinstance(commission, float)
+        assert commission >= 0.0
+        self.n_envs = n_envs
+        self.bars_count = bars_count
+        self.commission_perc = commission
+        self.reset_on_close = reset_on_close
+        self.state_1d = state_1d
+        self.random_ofs_on_reset = random_ofs_on_reset
+        self.reward_on_close = reward_on_close
+        self.volumes = volumes
+
+        if isinstance(prices, data.SharedPrices):
+            self.instruments = list(prices.names)
+            self._lengths = prices.lengths
+            self._block = prices.block
+        else:
+            self.instruments = list(prices.keys())
+            instrument_features = [prices[name] for name in self.instruments]
+            instrument_features = [f if isinstance(f, data.PriceFeatures) else data.PriceFeatures.from_relative(f)
+                                   for f in instrument_features]
+            self._lengths = np.array([len(f) for f in instrument_features], dtype=np.int64)
+            rows = len(data.PriceFeatures.BASE_FIELDS)
+            self._block = np.concatenate([f.block[:rows] for f in instrument_features], axis=1)
+        self._starts = np.concatenate([[0], np.cumsum(self._lengths)[:-1]]).astype(np.int64)
+        self._close_row = data.PriceFeatures.BASE_FIELDS.index('close')
+        # rows rel_high, rel_low, rel_close (and volume) of the features block
+        features = self._block[1:5 if volumes else 4]
+        # (bars, fields, bars_count), windows crossing the instruments bounds are never used
+        self._windows = np.lib.stride_tricks.sliding_window_view(features, bars_count, axis=1).transpose(1, 0, 2)
+
+        if state_1d:
+            state = State1D(bars_count, commission, reset_on_close, reward_on_close=reward_on_close, volumes=volumes)
+        else:
+            state = State(bars_count, commission, reset_on_close, reward_on_close=reward_on_close, volumes=volumes)
+        self.action_space = gym.spaces.Discrete(n=len(Actions))
+        self.observation_space = gym.spaces.Box(low=-np.inf, high=np.inf, shape=state.shape, dtype=np.float32)
+
+        self._instrument = np.zeros(n_envs, dtype=np.int64)
+        self._offset = np.zeros(n_envs, dtype=np.int64)
+        self.have_position = np.zeros(n_envs, dtype=bool)
+        self.open_price = np.zeros(n_envs, dtype=np.float32)
+        self.seed(seeds)
+
+    def seed(self, seeds=None):
+        if seeds is None:
+            seeds = [None] * self.n_envs
+        assert len(seeds) == self.n_envs
+        self.np_randoms = [seeding.np_random(seed)[0] for seed in seeds]
+
+    def _reset_envs(self, indices):
+        bars = self.bars_count
+        for idx in indices:
+            rng = self.np_randoms[idx]
+            instrument = rng.choice(len(self.instruments))
+            if self.random_ofs_on_reset:
+                offset = rng.choice(self._lengths[instrument] - bars * 10) + bars
+            else:
+                offset = bars
+            self._instrument[idx] = instrument
+            self._offset[idx] = offset
+        self.have_position[indices] = False
+        self.open_price[indices] = 0.0
+
+    def _cur_close(self):
+        return self._block[self._close_row, self._starts[self._instrument] + self._offset]
+
+    def encode(self):
+        """
+        :return: (n_envs,) + observation shape array
+        """
+        pos = self._starts[self._instrument] + self._offset - self.bars_count + 1
+        windows = self._windows[pos]
+        fields = windows.shape[1]
+        rel_profit = np.where(self.have_position,
+                              (self._cur_close() - self.open_price) / np.where(self.have_position, self.open_price, 1),
+                              0.0)
+        res = np.empty((self.n_envs,) + self.observation_space.shape, dtype=np.float32)
+        if self.state_1d:
+            res[:, :fields] = windows
+            res[:, fields] = self.have_position[:, np.newaxis]
+            res[:, fields + 1] = rel_profit[:, np.newaxis]
+        else:
+            res[:, :-2] = windows.transpose(0, 2, 1).reshape(self.n_envs, -1)
+            res[:, -2] = self.have_position
+            res[:, -1] = rel_profit
+        return res
+
+    def reset(self):
+        self._reset_envs(np.arange(self.n_envs))
+        return self.encode()
+
+    def step(self, actions):
+        """
+        :param actions: (n_envs,) action indices
+        :return: tuple (obs, rewards, dones, info), info has instrument indices and offsets before the resets
+        """
+        actions = np.asarray(actions)
+        rewards = np.zeros(self.n_envs, dtype=np.float64)
+        close = self._cur_close()
+
+        buy = (actions == Actions.Buy.value) & ~self.have_position
+        self.have_position[buy] = True
+        self.open_price[buy] = close[buy]
+        rewards[buy] -= self.commission_perc
+
+        sell = (actions == Actions.Close.value) & self.have_position
+        rewards[sell] -= self.commission_perc
+        dones = sell & self.reset_on_close
+        if self.reward_on_close:
+            rewards[sell] += 100.0 * (close[sell] - self.open_price[sell]) / self.open_price[sell]
+        self.have_position[sell] = False
+        self.open_price[sell] = 0.0
+
+        self._offset += 1
+        prev_close = close
+        close = self._cur_close()
+        dones |= self._offset >= self._lengths[self._instrument] - 1
+
+        if not self.reward_on_close:
+            have = self.have_position
+            rewards[have] += 100.0 * (close[have] - prev_close[have]) / prev_close[have]
+
+        info = {"instrument": self._instrument.copy(), "offset": self._offset.copy()}
+        done_indices = np.flatnonzero(dones)
+        if len(done_indices) > 0:
+            self._reset_envs(done_indices)
+        return self.encode(), rewards, dones, info
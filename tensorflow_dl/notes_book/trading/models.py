@@ -2,6 +2,8 @@ import tensorflow as tf
 import tensorflow.keras.layers as layers
 import numpy as np
 
+from tensorflow_dl.notes_book.trading import environment
+
 
 class NoisyLinear(tf.keras.layers.Dense):
     def __init__(self, in_features, out_features, sigma_init=0.017, bias=True):
@@ -29,7 +31,7 @@ class NoisyLinear(tf.keras.layers.Dense):
 
 
 class SimpleFFDQN(tf.keras.Model):
-    def __init__(self):
+    def __init__(self, actions_n=len(environment.Actions)):
         super(SimpleFFDQN, self).__init__()
 
         self.fc_val = tf.keras.Sequential([
@@ -41,7 +43,7 @@ class SimpleFFDQN(tf.keras.Model):
         self.fc_adv = tf.keras.Sequential([
             layers.Dense(512, activation="relu"),
             layers.Dense(512, activation="relu"),
-            layers.Dense(1)
+            layers.Dense(actions_n)
         ])
 
     def call(self, x, training=None, mask=None):
@@ -54,7 +56,7 @@ class SimpleFFDQN(tf.keras.Model):
 
 
 class DQNConv1D(tf.keras.Model):
-    def __init__(self):
+    def __init__(self, actions_n=len(environment.Actions)):
         super(DQNConv1D, self).__init__()
 
         self.conv = tf.keras.Sequential([
@@ -71,11 +73,13 @@ class DQNConv1D(tf.keras.Model):
         self.fc_adv = tf.keras.Sequential([
             layers.Dense(512, activation="relu"),
             layers.Dense(512, activation="relu"),
-            layers.Dense(1)
+            layers.Dense(actions_n)
         ])
 
     def call(self, x, training=None, mask=None):
-        conv_out = tf.reshape(self.conv(x), shape=(-1,))
+        # observations are (batch, channels, bars), keras convolutions expect channels last
+        x = tf.transpose(x, perm=(0, 2, 1))
+        conv_out = tf.reshape(self.conv(x), shape=(tf.shape(x)[0], -1))
         val = self.fc_val(conv_out)
         adv = self.fc_adv(conv_out)
         return val + adv - tf.reduce_mean(adv, axis=1, keepdims=True)
@@ -85,7 +89,7 @@ class DQNConv1D(tf.keras.Model):
 
 
 class DQNConv1DLarge(tf.keras.Model):
-    def __init__(self):
+    def __init__(self, actions_n=len(environment.Actions)):
         super(DQNConv1DLarge, self).__init__()
 
         self.conv = tf.keras.Sequential([
@@ -110,14 +114,28 @@ class DQNConv1DLarge(tf.keras.Model):
         self.fc_adv = tf.keras.Sequential([
             layers.Dense(512, activation="relu"),
             layers.Dense(512, activation="relu"),
-            layers.Dense(1)
+            layers.Dense(actions_n)
         ])
 
     def call(self, x, training=None, mask=None):
-        conv_out = tf.reshape(self.conv(x), shape=(-1,))
+        # observations are (batch, channels, bars), keras convolutions expect channels last
+        x = tf.transpose(x, perm=(0, 2, 1))
+        conv_out = tf.reshape(self.conv(x), shape=(tf.shape(x)[0], -1))
         val = self.fc_val(conv_out)
         adv = self.fc_adv(conv_out)
         return val + adv - tf.reduce_mean(adv, axis=1, keepdims=True)
 
     def get_config(self):
         return super(DQNConv1DLarge, self).get_config()
+
+
+def compiled_inference(net, obs_shape):
+    """
+    Compiled forward pass with the fixed signature (None,) + obs_shape, traced once for any batch size
+    :return: function obs -> (q_values, greedy actions)
+    """
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None,) + tuple(obs_shape), dtype=tf.float32)])
+    def infer(obs):
+        q_values = net(obs, training=False)
+        return q_values, tf.argmax(q_values, axis=1, output_type=tf.int32)
+    return infer
@@ -23,7 +23,7 @@ if __name__ == "__main__":
     args.bars = 50
     args.name = "out"
 
-    prices = data.load_relative(args.data)
+    prices = data.load_features(args.data)
     env = environment.TradingEnv({"TEST": prices}, bars_count=args.bars, reset_on_close=False,
                                  commission=args.commission,
                                  state_1d=args.conv, random_ofs_on_reset=False, reward_on_close=False, volumes=False)
@@ -31,6 +31,7 @@ if __name__ == "__main__":
         net = models.DQNConv1D()
     else:
         net = models.SimpleFFDQN()
+    infer = models.compiled_inference(net, env.observation_space.shape)
 
     # net.load_state_dict(torch.load(args.model, map_location=lambda storage, loc: storage))
 
@@ -44,8 +45,7 @@ if __name__ == "__main__":
     while True:
         step_idx += 1
         obs_v = tf.convert_to_tensor([obs])
-        out_v = net(obs_v)
-        action_idx = tf.argmax(out_v, axis=1).numpy()
+        action_idx = int(infer(obs_v)[1][0])
         if np.random.random() < EPSILON:
             action_idx = env.action_space.sample()
         # noinspection PyArgumentList
@@ -0,0 +1,111 @@
+"""
+BatchTradingEnv episode i must follow TradingEnv seeded with seeds[i]: the same instruments, offsets,
+observations, rewards and done flags for the same actions
+"""
+import itertools
+
+import numpy as np
+import pytest
+
+from tensorflow_dl.notes_book.trading import data, environment
+
+N_ENVS = 8
+STEPS = 2000
+SEEDS = list(range(100, 100 + N_ENVS))
+
+
+def random_walk_prices(lengths=(700, 1100, 400), seed=0, relative=True):
+    """
+    Prices of random walk instruments, keyed as the price files
+    :param relative: convert prices with prices_to_relative
+    """
+    rng = np.random.RandomState(seed)
+    res = {}
+    for idx, length in enumerate(lengths):
+        close = (100.0 * np.exp(np.cumsum(rng.normal(0, 0.01, size=length)))).astype(np.float32)
+        o = np.concatenate([[close[0]], close[:-1]]).astype(np.float32)
+        h = (np.maximum(o, close) * (1 + rng.uniform(0, 0.005, size=length))).astype(np.float32)
+        l = (np.minimum(o, close) * (1 - rng.uniform(0, 0.005, size=length))).astype(np.float32)
+        v = rng.randint(1, 1000, size=length).astype(np.float32)
+        prices = data.Prices(open=o, high=h, low=l, close=close, volume=v)
+        res["INSTR%d.csv" % idx] = data.prices_to_relative(prices) if relative else prices
+    return res
+
+
+@pytest.fixture(scope='module')
+def prices():
+    return random_walk_prices()
+
+
+def make_envs(prices, **kwargs):
+    batch_env = environment.BatchTradingEnv(prices, N_ENVS, seeds=SEEDS, **kwargs)
+    envs = [environment.TradingEnv(prices, **kwargs) for _ in SEEDS]
+    for env, seed in zip(envs, SEEDS):
+        env.seed(seed)
+    return batch_env, envs
+
+
+def step_envs(envs, actions):
+    """
+    Step every scalar env with its action, finished envs are reset as BatchTradingEnv does
+    :return: obs, rewards, dones, instruments and offsets before the resets
+    """
+    res = []
+    for env, action in zip(envs, actions):
+        obs, reward, done, info = env.step(int(action))
+        if done:
+            obs = env.reset()
+        res.append((obs, reward, done, info['instrument'], info['offset']))
+    obs, rewards, dones, instruments, offsets = zip(*res)
+    return np.array(obs), np.array(rewards), np.array(dones), list(instruments), np.array(offsets)
+
+
+def run_lockstep(batch_env, envs, steps=STEPS):
+    """
+    :return: count of the finished episodes
+    """
+    obs = batch_env.reset()
+    np.testing.assert_allclose(obs, np.array([env.reset() for env in envs]), rtol=1e-6, atol=1e-6)
+    rng = np.random.RandomState(1)
+    dones_count = 0
+    for step_idx in range(steps):
+        actions = rng.randint(len(environment.Actions), size=N_ENVS)
+        obs, rewards, dones, info = batch_env.step(actions)
+        expected_obs, expected_rewards, expected_dones, instruments, offsets = step_envs(envs, actions)
+        assert [batch_env.instruments[idx] for idx in info['instrument']] == instruments, step_idx
+        assert np.array_equal(info['offset'], offsets), step_idx
+        assert np.array_equal(dones, expected_dones), step_idx
+        np.testing.assert_allclose(rewards, expected_rewards, rtol=1e-5, atol=1e-5, err_msg=str(step_idx))
+        np.testing.assert_allclose(obs, expected_obs, rtol=1e-6, atol=1e-6, err_msg=str(step_idx))
+        dones_count += int(np.sum(dones))
+    return dones_count
+
+
+@pytest.mark.parametrize('state_1d,volumes,reset_on_close,reward_on_close,random_ofs_on_reset',
+                         list(itertools.product((False, True), repeat=5)))
+def test_same_as_trading_env(prices, state_1d, volumes, reset_on_close, reward_on_close, random_ofs_on_reset):
+    batch_env, envs = make_envs(prices, bars_count=10, commission=0.1, state_1d=state_1d, volumes=volumes,
+                                reset_on_close=reset_on_close, reward_on_close=reward_on_close,
+                                random_ofs_on_reset=random_ofs_on_reset)
+    assert batch_env.observation_space.shape == envs[0].observation_space.shape
+    run_lockstep(batch_env, envs)
+
+
+def test_price_features():
+    absolute = random_walk_prices(seed=4, relative=False)
+    prices = {name: data.PriceFeatures.from_prices(p) for name, p in absolute.items()}
+    batch_env, envs = make_envs(prices, bars_count=10, commission=0.1, reset_on_close=False, reward_on_close=False)
+    run_lockstep(batch_env, envs, steps=500)
+    # close of the features is used as is
+    state = envs[0]._state
+    assert any(np.shares_memory(state._real_close, p.block) for p in prices.values())
+
+
+def test_shared_prices():
+    prices = data.SharedPrices(random_walk_prices(seed=3))
+    batch_env, envs = make_envs(prices, bars_count=20, commission=0.1, reset_on_close=True)
+    # episodes are finished and reset during the run
+    assert run_lockstep(batch_env, envs) > 0
+    # prices and closes of the shared block are not copied by the envs
+    assert np.shares_memory(batch_env._windows, prices.block)
+    assert np.shares_memory(envs[0]._state._real_close, prices.block)
@@ -0,0 +1,209 @@
+"""
+read_csv_bulk must give the same prices, bit for bit, and print the same counters as read_csv.
+PriceFeatures appended bar by bar must equal the bulk ones, loaders and stores serve them
+"""
+import os
+import time
+import warnings
+
+import numpy as np
+import pytest
+
+from tensorflow_dl.notes_book.trading import data
+
+HEADER = ['<DATE>', '<TIME>', '<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOL>']
+# rows of the opt-in large file test, it is run only if the variable is set, for example to 10000000
+LARGE_ROWS_ENV = 'TRADING_LARGE_CSV_ROWS'
+
+
+def synthetic_bars(count, seed=0):
+    """
+    Random walk bars as (count, 7) array of date, time, open, high, low, close, volume. Prices are whole cents,
+    about 20% of the bars have all OHLC prices equal (filtered out by read_csv) and half of the bars open away
+    from the previous close (fixed by read_csv)
+    """
+    rng = np.random.RandomState(seed)
+    gap = np.where(rng.rand(count) < 0.5, 0, rng.randint(-100, 101, size=count))
+    body = rng.randint(-200, 201, size=count)
+    flat = rng.rand(count) < 0.2
+    body[flat] = 0
+    close = 10000 + np.cumsum(gap + body)
+    o = close - body
+    h = np.maximum(o, close) + np.where(flat, 0, rng.randint(0, 101, size=count))
+    l = np.minimum(o, close) - np.where(flat, 0, rng.randint(0, 101, size=count))
+    idx = np.arange(count)
+    return np.stack([20150101 + idx // 100, 1000 + idx % 100, o / 100, h / 100, l / 100, close / 100,
+                     rng.randint(1, 1000, size=count)], axis=1)
+
+
+def write_csv(path, bars, sep=','):
+    np.savetxt(path, np.asarray(bars, dtype=np.float64).reshape(-1, len(HEADER)),
+               fmt=['%d', '%d', '%.2f', '%.2f', '%.2f', '%.2f', '%d'], delimiter=sep,
+               header=sep.join(HEADER), comments='')
+    return str(path)
+
+
+def read(reader, path, capsys, **kwargs):
+    """
+    :return: prices and the printed counters
+    """
+    capsys.readouterr()
+    prices = reader(path, **kwargs)
+    return prices, capsys.readouterr().out
+
+
+def assert_identical(actual, expected):
+    for name in data.Prices._fields:
+        act, exp = getattr(actual, name), getattr(expected, name)
+        assert act.dtype == exp.dtype == np.float32, name
+        assert act.shape == exp.shape and act.tobytes() == exp.tobytes(), name
+
+
+FLAGS = [dict(filter_data=f, fix_open_price=o) for f in (False, True) for o in (False, True)]
+FILES = {
+    'random': lambda: synthetic_bars(2000),
+    'single_row': lambda: synthetic_bars(1, seed=2),
+    'single_flat_row': lambda: [[20150101, 1000, 100.0, 100.0, 100.0, 100.0, 10]],
+    'all_flat_rows': lambda: [[20150101, 1000 + i, 100.0 + i, 100.0 + i, 100.0 + i, 100.0 + i, 10] for i in range(5)],
+    'header_only': lambda: [],
+}
+
+
+@pytest.mark.parametrize('flags', FLAGS, ids=lambda f: "filter%d-fix%d" % (f['filter_data'], f['fix_open_price']))
+@pytest.mark.parametrize('sep', [',', ';'])
+@pytest.mark.parametrize('file_name', sorted(FILES))
+def test_bulk_same_as_rows(tmp_path, capsys, file_name, sep, flags):
+    path = write_csv(tmp_path / 'prices.csv', FILES[file_name](), sep=sep)
+    expected, expected_log = read(data.read_csv, path, capsys, **flags)
+    with warnings.catch_warnings():
+        # empty file must not warn
+        warnings.simplefilter('error')
+        actual, actual_log = read(data.read_csv_bulk, path, capsys, **flags)
+    assert actual_log == expected_log
+    assert_identical(actual, expected)
+
+
+def test_bulk_counters(tmp_path, capsys):
+    bars = synthetic_bars(1000, seed=3)
+    path = write_csv(tmp_path / 'prices.csv', bars)
+    prices, log = read(data.read_csv_bulk, path, capsys, filter_data=True, fix_open_price=True)
+    flat = np.all(bars[:, 2:6] == bars[:, 2:3], axis=1)
+    assert len(prices.close) == len(bars) - np.count_nonzero(flat)
+    assert "got 1000 rows, %d filtered" % np.count_nonzero(flat) in log
+    # open of every bar is the close of the previous bar left after the filtering
+    assert np.array_equal(prices.open[1:], prices.close[:-1])
+    assert np.all(prices.low <= prices.open) and np.all(prices.open <= prices.high)
+
+
+@pytest.mark.skipif(not os.environ.get(LARGE_ROWS_ENV), reason="set %s to run on the large file" % LARGE_ROWS_ENV)
+def test_bulk_large_file(tmp_path, capsys):
+    rows = int(os.environ[LARGE_ROWS_ENV])
+    path = write_csv(tmp_path / 'large.csv', synthetic_bars(rows, seed=4))
+    flags = dict(filter_data=True, fix_open_price=True)
+    t_start = time.time()
+    expected, expected_log = read(data.read_csv, path, capsys, **flags)
+    rows_time = time.time() - t_start
+    t_start = time.time()
+    actual, actual_log = read(data.read_csv_bulk, path, capsys, **flags)
+    bulk_time = time.time() - t_start
+    with capsys.disabled():
+        print("\n%d rows: read_csv %.1f s, read_csv_bulk %.1f s, x%.1f" % (
+            rows, rows_time, bulk_time, rows_time / bulk_time))
+    assert actual_log == expected_log
+    assert_identical(actual, expected)
+    assert bulk_time < rows_time
+
+
+def absolute_prices(count, seed=0):
+    bars = synthetic_bars(count, seed=seed)
+    return data.Prices(*bars[:, 2:].T.astype(np.float32))
+
+
+def test_features_append_same_as_bulk():
+    prices = absolute_prices(500)
+    windows = dict(return_windows=(1, 5), volatility_windows=(3, 20))
+    bulk = data.PriceFeatures.from_prices(prices, **windows)
+    by_bar = data.PriceFeatures(capacity=1, **windows)
+    for bar in zip(*prices):
+        by_bar.append(*bar)
+    by_chunk = data.PriceFeatures(capacity=7, **windows)
+    for start in range(0, 500, 37):
+        by_chunk.extend(data.Prices(*(field[start:start + 37] for field in prices)))
+    assert len(bulk) == len(by_bar) == len(by_chunk) == 500
+    assert np.array_equal(by_bar.block, bulk.block)
+    assert np.array_equal(by_chunk.block, bulk.block)
+
+
+def test_features_values():
+    prices = absolute_prices(300, seed=1)
+    features = data.PriceFeatures.from_prices(prices, return_windows=(4,), volatility_windows=(10,))
+    relative = data.prices_to_relative(prices)
+    for actual, expected in zip(features.relative(), relative):
+        assert actual.tobytes() == expected.tobytes()
+    assert features.relative() is features.relative()
+    assert np.array_equal(features['close'], prices.close)
+
+    close = prices.close.astype(np.float64)
+    expected_ret = np.zeros(len(close))
+    expected_ret[4:] = close[4:] / close[:-4] - 1.0
+    np.testing.assert_allclose(features['ret_4'], expected_ret, rtol=1e-6, atol=1e-7)
+    returns = np.concatenate([[0.0], close[1:] / close[:-1] - 1.0])
+    expected_vol = np.zeros(len(close))
+    expected_vol[10:] = [np.std(returns[t - 9:t + 1]) for t in range(10, len(close))]
+    np.testing.assert_allclose(features['vol_10'], expected_vol, rtol=1e-4, atol=1e-6)
+
+
+def test_features_from_relative():
+    relative = data.prices_to_relative(absolute_prices(200, seed=2))
+    features = data.PriceFeatures.from_relative(relative)
+    # relative prices are kept bit for bit, absolute close is restored as open * (1 + rel_close)
+    for actual, expected in zip(features.relative(), relative):
+        assert actual.tobytes() == expected.tobytes()
+    assert np.array_equal(features['close'], relative.open * (np.float32(1.0) + relative.close))
+
+
+def test_load_features_cache(tmp_path, capsys):
+    path = write_csv(tmp_path / 'prices.csv', synthetic_bars(400, seed=5))
+    windows = dict(return_windows=(2,), volatility_windows=(5,))
+    expected = data.load_features(path, **windows)
+    assert not os.path.exists(tmp_path / data.CACHE_DIR)
+    data.load_features(path, use_cache=True, **windows)
+    cached = data.load_features(path, use_cache=True, **windows)
+    assert isinstance(cached['close'], np.memmap)
+    assert np.array_equal(cached.block, expected.block)
+
+    # appended bars don't touch the memory-mapped history
+    new_bars = absolute_prices(50, seed=6)
+    cached.extend(new_bars)
+    expected.extend(new_bars)
+    assert np.array_equal(cached.block, expected.block)
+    assert np.array_equal(data.load_features(path, use_cache=True, **windows).block, expected.block[:, :-50])
+
+
+def test_price_cache_not_writable(tmp_path, capsys):
+    path = write_csv(tmp_path / 'prices.csv', synthetic_bars(100, seed=7))
+    (tmp_path / 'file').write_text('')
+    features = data.load_features(path, use_cache=True, cache_dir=str(tmp_path / 'file' / 'cache'))
+    assert "is not cached" in capsys.readouterr().out
+    assert np.array_equal(features.block, data.load_features(path).block)
+
+
+def test_price_store_budget(tmp_path):
+    paths = [write_csv(tmp_path / ('P%d.csv' % idx), synthetic_bars(100, seed=idx)) for idx in range(3)]
+    sizes = [data.load_features(path).nbytes for path in paths]
+    store = data.PriceStore(paths, memory_budget=sizes[1] + sizes[2])
+    for path in paths:
+        assert isinstance(store[path], data.PriceFeatures)
+    # the least recently used instrument is dropped with its features
+    assert list(store._loaded) == paths[1:]
+    assert store.loaded_bytes == sizes[1] + sizes[2]
+
+
+def test_shared_prices_features():
+    relative = {'A': data.prices_to_relative(absolute_prices(50)), 'B': data.prices_to_relative(absolute_prices(70))}
+    shared = data.SharedPrices(relative)
+    assert shared.block.shape == (len(data.PriceFeatures.BASE_FIELDS), 120)
+    for name, prices in relative.items():
+        expected = data.PriceFeatures.from_relative(prices)
+        assert np.array_equal(shared[name].block, expected.block)
+        assert np.shares_memory(shared[name]['close'], shared.block)
@@ -5,7 +5,7 @@ import argparse
 
 import tensorflow as tf
 
-from tensorflow_dl.notes_book.trading import environment, data, models
+from tensorflow_dl.notes_book.trading import environment, data, models, validation
 from tensorflow_dl.libs import actions, agent, experience, common
 
 BATCH_SIZE = 32
@@ -32,23 +32,30 @@ EPSILON_STEPS = 1000000
 
 CHECKPOINT_EVERY_STEP = 1000000
 VALIDATION_EVERY_STEP = 100000
+VALIDATION_TIME_BUDGET = 30.0
 
 if __name__ == '__main__':
     data_path = os.path.join(os.getcwd(), "data", "YNDX_160101_161231.csv")
     val_path = os.path.join(os.getcwd(), "data", "YNDX_150101_151231.csv")
     saves_path = ""
-    stock_data = {"YNDX": data.load_relative(data_path)}
+    stock_data = {"YNDX": data.load_features(data_path)}
     env = environment.TradingEnv(stock_data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=False, volumes=False)
     env_tst = environment.TradingEnv(stock_data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=False)
 
     env = gym.wrappers.TimeLimit(env, max_episode_steps=1000)
 
-    val_data = {"YNDX": data.load_relative(val_path)}
+    val_data = {"YNDX": data.load_features(val_path)}
     env_val = environment.TradingEnv(val_data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=False)
 
     summary = tf.summary.create_file_writer("summary")
     net = models.SimpleFFDQN()
     tgt_net = models.SimpleFFDQN()
+    net(tf.zeros((1,) + env.observation_space.shape))
+
+    # validation runs in the separate process on the snapshots of the weights
+    validator = validation.Validator(net, {"test": [data_path], "val": [val_path]},
+                                     time_budget=VALIDATION_TIME_BUDGET, bars_count=BARS_COUNT,
+                                     reset_on_close=True, state_1d=False)
 
     selector = actions.EpsilonGreedyActionSelector(EPSILON_START)
     train_agent = agent.DQNAgent(net, selector)
@@ -103,5 +110,9 @@ if __name__ == '__main__':
                 idx = step_idx // CHECKPOINT_EVERY_STEP
                 net.save(saves_path)
 
-            # if step_idx % VALIDATION_EVERY_STEP == 0:
-            #     res =
\ No newline at end of file
+            if step_idx % VALIDATION_EVERY_STEP == 0:
+                validator.submit(step_idx, net.get_weights())
+            for val_step_idx, name, res in validator.poll():
+                with summary.as_default():
+                    for key, val in res.items():
+                        tf.summary.scalar(key + "_" + name, val, val_step_idx)
@@ -0,0 +1,143 @@
+"""
+Validation of the trading net in the separate process. The learner submits snapshots of the weights, the validator
+plays them on the batch env of every validation data set within the time budget and sends back the statistics,
+so the training loop never waits for the validation.
+"""
+import multiprocessing as mp
+import queue
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_dl.notes_book.trading import environment, data, models
+
+VALIDATION_ENVS = 64
+EPSILON = 0.02
+
+
+def run_val(env, net, time_budget, epsilon=EPSILON, max_episodes=None, infer=None):
+    """
+    Play the greedy (with epsilon random actions) policy in all episodes of the batch env
+    :param env: environment.BatchTradingEnv
+    :param infer: models.compiled_inference of the net, pass it to avoid tracing on every call
+    :param time_budget: seconds, started episodes are not finished after the budget is spent
+    :return: dict of means of episode_reward, episode_steps, order_profits, order_steps and total orders count
+    """
+    stats = {'episode_reward': [], 'episode_steps': [], 'order_profits': [], 'order_steps': []}
+    if infer is None:
+        infer = models.compiled_inference(net, env.observation_space.shape)
+    obs = env.reset()
+    episode_rewards = np.zeros(env.n_envs)
+    episode_steps = np.zeros(env.n_envs, dtype=np.int64)
+    order_steps = np.zeros(env.n_envs, dtype=np.int64)
+    deadline = time.time() + time_budget
+
+    while time.time() < deadline:
+        actions = infer(tf.convert_to_tensor(obs))[1].numpy()
+        random_mask = np.random.random(env.n_envs) < epsilon
+        actions[random_mask] = np.random.randint(env.action_space.n, size=random_mask.sum())
+
+        have_position = env.have_position.copy()
+        open_price = env.open_price.copy()
+        close_price = env._cur_close()
+        buys = (actions == environment.Actions.Buy.value) & ~have_position
+        sells = (actions == environment.Actions.Close.value) & have_position
+
+        obs, rewards, dones, _ = env.step(actions)
+        episode_rewards += rewards
+        episode_steps += 1
+        order_steps += have_position
+
+        # positions open at the episode end are closed by the last price
+        closed = sells | (dones & have_position)
+        if closed.any():
+            price, position = close_price[closed], open_price[closed]
+            profit = price - position - (price + position) * env.commission_perc / 100
+            stats['order_profits'].extend(100.0 * profit / position)
+            stats['order_steps'].extend(order_steps[closed])
+        order_steps[closed | buys] = 0
+
+        if dones.any():
+            stats['episode_reward'].extend(episode_rewards[dones])
+            stats['episode_steps'].extend(episode_steps[dones])
+            episode_rewards[dones] = 0.0
+            episode_steps[dones] = 0
+            if max_episodes is not None and len(stats['episode_reward']) >= max_episodes:
+                break
+
+    res = {key: float(np.mean(vals)) if vals else 0.0 for key, vals in stats.items()}
+    res['orders'] = len(stats['order_profits'])
+    res['episodes'] = len(stats['episode_reward'])
+    return res
+
+
+def _validator_func(net_class, obs_shape, datasets, env_kwargs, n_envs, time_budget, snapshot_queue, result_queue):
+    # learner keeps the rest of the cores
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    net = net_class()
+    net(tf.zeros((1,) + tuple(obs_shape)))
+    infer = models.compiled_inference(net, obs_shape)
+    envs = {name: environment.BatchTradingEnv({path: data.load_features(path) for path in files}, n_envs,
+                                              **env_kwargs)
+            for name, files in datasets.items()}
+
+    while True:
+        snapshot = snapshot_queue.get()
+        if snapshot is None:
+            break
+        step_idx, weights = snapshot
+        net.set_weights(weights)
+        for name, env in envs.items():
+            result_queue.put((step_idx, name, run_val(env, net, time_budget / len(envs), infer=infer)))
+
+
+class Validator:
+    """
+    Validation process. submit() never blocks: if the previous snapshot is not taken yet, the new one is dropped
+    """
+
+    def __init__(self, net, datasets, n_envs=VALIDATION_ENVS, time_budget=30.0, **env_kwargs):
+        """
+        :param net: net of class constructed without arguments
+        :param datasets: dict name -> list of CSV files, for example validation years
+        :param time_budget: seconds for the validation of one snapshot over all the data sets
+        :param env_kwargs: arguments of BatchTradingEnv, the same as of the validation TradingEnv
+        """
+        state_cls = environment.State1D if env_kwargs.get('state_1d') else environment.State
+        obs_shape = state_cls(env_kwargs.get('bars_count', environment.DEFAULT_BARS_COUNT), 0.0, False,
+                              volumes=env_kwargs.get('volumes', False)).shape
+        # tensorflow is not fork safe, validator is started in the fresh interpreter
+        ctx = mp.get_context('spawn')
+        self.snapshot_queue = ctx.Queue(maxsize=1)
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=_validator_func, daemon=True,
+                                   args=(type(net), obs_shape, datasets, env_kwargs, n_envs, time_budget,
+                                         self.snapshot_queue, self.result_queue))
+        self.process.start()
+
+    def submit(self, step_idx, weights):
+        """
+        :return: True if the snapshot was queued
+        """
+        try:
+            self.snapshot_queue.put_nowait((step_idx, weights))
+            return True
+        except queue.Full:
+            return False
+
+    def poll(self):
+        """
+        :return: list of (step_idx, dataset name, stats dict) ready so far
+        """
+        res = []
+        while True:
+            try:
+                res.append(self.result_queue.get_nowait())
+            except queue.Empty:
+                return res
+
+    def close(self):
+        self.snapshot_queue.put(None)
+        self.process.join()